@@ -1,20 +1,47 @@
 import os
 import io
-import pandas as pd
+import itertools
 import threading
+import pandas as pd
 import time
+import uuid
 import numpy as np
 import getpass
 import psycopg2
 from google.cloud import bigquery, secretmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, session, get_flashed_messages
 from werkzeug.utils import secure_filename
 from datetime import datetime
 from db import close_pg_pool
+from import_pipeline import (
+    read_import_chunks, describe_dialect, save_upload_hashed,
+    staging_path, purge_staging, stage_chunks, load_staged_file, publish_staged, fetch_staged,
+)
+from cleaning import CleaningPlan
+from batch_import import (
+    BATCH_LOAD_CONCURRENCY, IMPORT_EXTENSIONS, batch_folder, discard_batch, expand_uploads, read_header,
+    match_table, schema_fields, parse_files, in_upload_order, publish_batch, unique_path,
+)
+from jobs import job_queue, bp_jobs, MemoryJobStore, PgJobStore
+from progress import progress_hub, bp_progress
+from gcp_client import get_bq_client, warm_up_bq_client, bp_gcp
+from http_cache import versioned_json, table_version
+from exports import (
+    EXPORT_FORMATS, export_query, query_batches, export_response, xlsx_file, frame_batches, send_temp_file, XLSX_MIMETYPE,
+)
+from export_cache import export_cache, bp_export_cache
+from sync_engine import (
+    UPSERT_KEYS, upsert_key, keyed_chunks, describe_dropped, temp_table_id, upsert_staged_file, discard_manifest,
+    table_changed,
+)
 
 # Import des blueprints
-from detail_emplacement import bp_detail_emplacement   # ✅ page Détail Emplacement
+from detail_emplacement import bp_detail_emplacement, edit_buffer   # ✅ page Détail Emplacement
+from edit_buffer import MemoryEditJournal, PgEditJournal
+from emplacement_snapshot import emplacement_snapshot
 from routes import bp_routes                           # ✅ page Routes
+from travel_graph import bp_travel                     # ✅ distances / durées entre emplacements
 
 
 # ================================
@@ -48,7 +75,8 @@ PG_PASSWORD = get_secret(PG_SECRET_ID)
 # ================================
 # 📊 Connexion BigQuery
 # ================================
-client = bigquery.Client(project=PROJECT_ID)
+# Client partagé résolu à chaque appel (get_bq_client) : set_bq_client le remplace partout
+warm_up_bq_client()
 
 
 # ================================
@@ -60,10 +88,19 @@ ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls', 'txt'}
 app = Flask(__name__)
 app.secret_key = "votre_cle_secrete"
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.jinja_env.globals["UPSERT_KEYS"] = UPSERT_KEYS
 
 # Enregistrement des blueprints
 app.register_blueprint(bp_detail_emplacement)
 app.register_blueprint(bp_routes)
+app.register_blueprint(bp_travel)
+app.register_blueprint(bp_jobs)
+app.register_blueprint(bp_progress)
+app.register_blueprint(bp_gcp)
+app.register_blueprint(bp_export_cache)
+
+# 🗂️ Instantané TblEmplacement chargé en arrière-plan (pages emplacements / routes)
+emplacement_snapshot.warm_up()
 
 #-----------------------------------
 # Test si google secret est connecté
@@ -91,6 +128,7 @@ current_user = getpass.getuser()
 
 # 🔎 Récupère uniquement les tables actives
 def get_active_tables():
+    client = get_bq_client()
     query = f"""
         SELECT NomTable
         FROM {PROJECT_ID}.{DATASET_ID}.TblChargementAutomatique
@@ -100,6 +138,95 @@ def get_active_tables():
     return [row.NomTable for row in results]
 
 
+# 📜 Colonnes ajoutées à TblHistoriqueImport au fil des versions (créées si absentes)
+HISTORIQUE_EXTRA_COLUMNS = {
+    "Dialecte": "STRING",   # encodage / séparateur / BOM détectés pour les CSV
+    "IdJob": "STRING",      # job de synchronisation asynchrone (cf. /api/jobs/<id>)
+    "NbInseres": "INT64",   # import différentiel : lignes nouvelles
+    "NbModifies": "INT64",  # import différentiel : lignes modifiées
+    "NbInchanges": "INT64", # import différentiel : lignes ignorées (identiques)
+    "NbConvertis": "INT64", # nettoyage : valeurs converties (virgule décimale, date FR...)
+    "NbRejetes": "INT64",   # nettoyage : valeurs invalides remplacées par NULL
+    "NbSansCle": "INT64",   # tables à clé : lignes écartées (clé vide ou incomplète)
+    "IdLot": "STRING",      # import par lot : une ligne par fichier du lot
+    "HashFichier": "STRING",# SHA-256 du fichier importé (détection des réimports identiques)
+}
+RESULTAT_EN_COURS = "En cours (job)"
+RESULTAT_IGNORE = "Ignoré (identique)"
+_historique_columns_ready = False
+
+
+def ensure_historique_columns():
+    """Ajoute une seule fois par worker les colonnes manquantes de TblHistoriqueImport."""
+    global _historique_columns_ready
+    if _historique_columns_ready:
+        return
+    client = get_bq_client()
+    add_cols = ",\n            ".join(
+        f"ADD COLUMN IF NOT EXISTS {name} {ftype}" for name, ftype in HISTORIQUE_EXTRA_COLUMNS.items()
+    )
+    client.query(f"""
+        ALTER TABLE `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
+            {add_cols}
+    """).result()
+    _historique_columns_ready = True
+
+
+def log_import(table_name, resultat, detail, nb_lignes, fichier, **extra):
+    """Insère une ligne dans TblHistoriqueImport (extra : colonnes de HISTORIQUE_EXTRA_COLUMNS)."""
+    log_import_rows([dict(extra, NomTable=table_name, Resultat=resultat, DetailErreur=detail,
+                          NombreLignes=nb_lignes, NomFichier=fichier)])
+
+
+def log_import_rows(rows):
+    """Insère plusieurs lignes dans TblHistoriqueImport en une seule requête (import par lot)."""
+    client = get_bq_client()
+    ensure_historique_columns()
+    base_types = {"NomTable": "STRING", "Resultat": "STRING", "DetailErreur": "STRING",
+                  "NombreLignes": "INT64", "NomFichier": "STRING"}
+    columns = dict(base_types)
+    for row in rows:
+        columns.update({k: HISTORIQUE_EXTRA_COLUMNS[k] for k in row if k in HISTORIQUE_EXTRA_COLUMNS})
+
+    values, params = [], [bigquery.ScalarQueryParameter("user", "STRING", current_user)]
+    for i, row in enumerate(rows):
+        values.append("(CURRENT_TIMESTAMP(), @user, " + ", ".join(f"@{c}_{i}" for c in columns) + ")")
+        params += [bigquery.ScalarQueryParameter(f"{c}_{i}", ftype, row.get(c)) for c, ftype in columns.items()]
+
+    query_log = f"""
+        INSERT INTO {PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport
+        (DateHeure, Utilisateur, {", ".join(columns)})
+        VALUES {", ".join(values)}
+    """
+    client.query(query_log, job_config=bigquery.QueryJobConfig(query_parameters=params)).result()
+
+
+def find_identical_import(table_name, file_hash):
+    """
+    Dernier import de la table (hors imports ignorés) s'il porte la même empreinte
+    et a réussi ou est encore en cours ; sinon None.
+    """
+    client = get_bq_client()
+    ensure_historique_columns()
+    query = f"""
+        SELECT Resultat, HashFichier,
+               FORMAT_TIMESTAMP('%d/%m/%Y %H:%M:%S', DateHeure, 'Europe/Paris') AS DateHeureFr
+        FROM `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
+        WHERE NomTable = @table
+          AND Resultat != @ignore
+        ORDER BY DateHeure DESC
+        LIMIT 1
+    """
+    params = [
+        bigquery.ScalarQueryParameter("table", "STRING", table_name),
+        bigquery.ScalarQueryParameter("ignore", "STRING", RESULTAT_IGNORE),
+    ]
+    rows = list(client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params)).result())
+    if rows and rows[0].HashFichier == file_hash and rows[0].Resultat in ("Succès", RESULTAT_EN_COURS):
+        return rows[0]
+    return None
+
+
 # ==========================
 # ROUTE ACCUEIL
 # ==========================
@@ -109,134 +236,125 @@ def index():
 
 
 # ============================================================
-# 🔄 SYNCHRONISATION AVANCÉE TblEmplacement (MERGE conditionnel)
+# 🔄 SYNCHRONISATION PAR CLÉ (MERGE conditionnel, cf. sync_engine.py)
 # ============================================================
-def sync_tbl_emplacement_background(df, client, PROJECT_ID, DATASET_ID, filename):
-    """Synchronisation asynchrone de TblEmplacement :
-       - Nettoyage des doublons / lignes vides
-       - MERGE intelligent (mise à jour conditionnelle)
+def settle_pending_edits(table_name):
+    """Avant un import ou un export de TblEmplacement : saisies différées de la grille
+    écrites d'abord (cf. edit_buffer.settle) ; elles ne repasseront pas après l'import,
+    et l'export (comme sa clé de cache, cf. table_version) les inclut."""
+    if table_name == "TblEmplacement":
+        edit_buffer.settle()
+
+
+def sync_table_background(client, PROJECT_ID, DATASET_ID, table_name, filename, job_id, staged_file, delta=False,
+                          note=None):
+    """Synchronisation asynchrone d'une table à clé (UPSERT_KEYS) :
+       - Mode delta : seules les lignes nouvelles / modifiées depuis la dernière
+         synchronisation (manifeste d'empreintes) sont envoyées
+       - Chargement du fichier Parquet de transit dans une table temporaire propre au job
+       - Dédoublonnage sur la clé, dernière ligne du fichier gagnante
+       - MERGE généré pour la table (mise à jour conditionnelle)
+       Exécutée comme job (cf. jobs.py) : rejouable sur toute instance tant que le
+       fichier de transit publié (cf. import_pipeline.publish_staged) existe.
+       note : remarque de la mise en transit (lignes écartées...), gardée dans l'historique.
     """
+    report = progress_hub.reporter(job_id)
     try:
-        import pandas as pd
-
-        print("🔹 Démarrage de la synchronisation avancée TblEmplacement")
-
-        # 🔸 Nettoyage de base
-        if "Zone" in df.columns:
-            before = len(df)
-            df = df[df["Zone"].notna() & (df["Zone"].astype(str).str.strip() != "")]
-            print(f"🧹 {before - len(df)} lignes supprimées (Zone vide).")
-
-        # 🔸 Suppression des doublons sur combinaison clé (Zone, Allee, Deplacement, Niveau)
-        key_cols = ["Zone", "Allee", "Deplacement", "Niveau"]
-        key_cols = [c for c in key_cols if c in df.columns]
-        if key_cols:
-            before = len(df)
-            df = df.drop_duplicates(subset=key_cols, keep="last")
-            print(f"🧹 {before - len(df)} doublons supprimés sur {key_cols}.")
-
-        nb_lignes = len(df)
-
-        # 🔸 Charger dans une table temporaire
-        temp_table = f"{PROJECT_ID}.{DATASET_ID}._Temp_TblEmplacement"
-        target_table = f"{PROJECT_ID}.{DATASET_ID}.TblEmplacement"
-
-        print("⏳ Chargement du DataFrame dans la table temporaire...")
-        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-        client.load_table_from_dataframe(df, temp_table, job_config=job_config).result()
-        print(f"✅ Table temporaire chargée ({nb_lignes} lignes).")
-
-        # =========================================================
-        # ⚙️ MERGE conditionnel (mise à jour sélective et typée)
-        # =========================================================
-        merge_query = f"""
-            MERGE `{target_table}` AS T
-            USING `{temp_table}` AS S
-            ON T.Zone = S.Zone
-            AND T.Allee = S.Allee
-            AND T.Deplacement = S.Deplacement
-            AND T.Niveau = S.Niveau
-
-            WHEN MATCHED THEN
-              UPDATE SET
-                -- ✅ Mise à jour standard si valeur présente
-                T.PoidsLimiteTotal   = COALESCE(S.PoidsLimiteTotal, T.PoidsLimiteTotal),
-                T.Hauteur            = COALESCE(S.Hauteur, T.Hauteur),
-                T.Largeur            = COALESCE(S.Largeur, T.Largeur),
-                T.Profondeur         = COALESCE(S.Profondeur, T.Profondeur),
-
-                -- ✅ Champs mis à jour uniquement si NON NULL et NON VIDE
-                T.PoidsLimiteUnitaire = COALESCE(S.PoidsLimiteUnitaire, T.PoidsLimiteUnitaire),
-                T.X = COALESCE(S.X, T.X),
-                T.Y = COALESCE(S.Y, T.Y),
-                T.Z = COALESCE(S.Z, T.Z),
-
-                -- ✅ Conversion explicite en STRING pour éviter les conflits de type
-                T.Type1 = IFNULL(NULLIF(CAST(S.Type1 AS STRING), ''), T.Type1),
-                T.Type2 = IFNULL(NULLIF(CAST(S.Type2 AS STRING), ''), T.Type2),
-                T.Type3 = IFNULL(NULLIF(CAST(S.Type3 AS STRING), ''), T.Type3),
-
-                T.Palette = COALESCE(S.Palette, T.Palette)
-
-            WHEN NOT MATCHED BY TARGET THEN
-              INSERT (
-                Zone, Allee, Deplacement, Niveau,
-                PoidsLimiteTotal, Hauteur, Largeur, Profondeur,
-                PoidsLimiteUnitaire, X, Y, Z,
-                Type1, Type2, Type3, Palette
-              )
-              VALUES (
-                S.Zone, S.Allee, S.Deplacement, S.Niveau,
-                S.PoidsLimiteTotal, S.Hauteur, S.Largeur, S.Profondeur,
-                S.PoidsLimiteUnitaire, S.X, S.Y, S.Z,
-                CAST(S.Type1 AS STRING), CAST(S.Type2 AS STRING), CAST(S.Type3 AS STRING), S.Palette
-              );
-        """
-
-        print("⚙️ Exécution du MERGE conditionnel...")
-        client.query(merge_query).result()
-        print("✅ MERGE exécuté avec succès.")
-
-        # 🔸 Suppression de la table temporaire
-        client.delete_table(temp_table, not_found_ok=True)
-        print("🧹 Table temporaire supprimée.")
+        print(f"🔹 Démarrage de la synchronisation {table_name}")
+        report("job", f"Synchronisation {table_name} démarrée")
+        key_cols = upsert_key(table_name)
+        if not key_cols:
+            raise ValueError(f"Aucune clé de synchronisation déclarée pour {table_name}")
+
+        settle_pending_edits(table_name)
+        result = upsert_staged_file(
+            client, staged_file,
+            f"{PROJECT_ID}.{DATASET_ID}.{table_name}",
+            temp_table_id(PROJECT_ID, DATASET_ID, table_name, job_id),
+            key_cols, delta=delta, report=report,
+        )
+        counts = result["delta"]
 
-        # =========================================================
         # ✅ Mise à jour du log TblHistoriqueImport
-        # =========================================================
-        query_update = f"""
-            UPDATE `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
-            SET Resultat = 'Succès',
-                DetailErreur = NULL,
-                NombreLignes = @nb_lignes
-            WHERE NomFichier = @fichier
-              AND Resultat = 'En cours (thread)'
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("nb_lignes", "INT64", nb_lignes),
-                bigquery.ScalarQueryParameter("fichier", "STRING", filename),
-            ]
-        )
-        client.query(query_update, job_config=job_config).result()
+        detail = None
+        if counts is not None and result["envoyees"] == 0:
+            detail = "Import différentiel : aucune modification."
+        elif counts is not None:
+            detail = f"Import différentiel : {result['envoyees']} ligne(s) envoyée(s) sur {result['lignes']}."
+        if note:
+            detail = f"{detail} {note}." if detail else f"{note}."
+        update_historique_job(job_id, "Succès", detail, result["lignes"], **_delta_columns(counts))
         print("🟢 Log mis à jour avec succès.")
+        report("termine", f"{table_name} synchronisée ({result['envoyees']} ligne(s) envoyée(s))",
+               lignes=result["lignes"], envoyees=result["envoyees"])
+        return dict(result, table=table_name, fichier=filename)
 
     except Exception as e:
-        print(f"❌ Erreur dans sync_tbl_emplacement_background : {e}")
-        query_err = f"""
-            UPDATE `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
-            SET Resultat = 'Erreur',
-                DetailErreur = @err
-            WHERE NomFichier = @fichier
-              AND Resultat = 'En cours (thread)'
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("err", "STRING", str(e)),
-                bigquery.ScalarQueryParameter("fichier", "STRING", filename),
-            ]
+        print(f"❌ Erreur dans sync_table_background ({table_name}) : {e}")
+        report("erreur", str(e))
+        update_historique_job(job_id, "Erreur", str(e))
+        raise
+
+
+def _delta_columns(counts):
+    """Compteurs d'un import différentiel -> colonnes de TblHistoriqueImport."""
+    if counts is None:
+        return {}
+    return {"NbInseres": counts["inseres"], "NbModifies": counts["modifies"], "NbInchanges": counts["inchanges"]}
+
+
+_historique_lock = threading.Lock()
+
+
+def update_historique_job(job_id, resultat, detail, nb_lignes=None, fichier=None, **extra):
+    """Clôture la ligne TblHistoriqueImport d'un import asynchrone (repérée par IdJob,
+    et par NomFichier pour les lignes d'un import par lot)."""
+    client = get_bq_client()
+    ensure_historique_columns()
+    extra = {k: v for k, v in extra.items() if k in HISTORIQUE_EXTRA_COLUMNS}
+    extra_sets = "".join(f",\n            {k} = @{k}" for k in extra)
+    fichier_filter = "\n          AND NomFichier = @fichier" if fichier else ""
+    query_update = f"""
+        UPDATE `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
+        SET Resultat = @resultat,
+            DetailErreur = @detail,
+            NombreLignes = COALESCE(@nb_lignes, NombreLignes){extra_sets}
+        WHERE IdJob = @job
+          AND Resultat = @en_cours{fichier_filter}
+    """
+    params = [
+        bigquery.ScalarQueryParameter("resultat", "STRING", resultat),
+        bigquery.ScalarQueryParameter("detail", "STRING", detail),
+        bigquery.ScalarQueryParameter("nb_lignes", "INT64", nb_lignes),
+        bigquery.ScalarQueryParameter("job", "STRING", job_id),
+        bigquery.ScalarQueryParameter("en_cours", "STRING", RESULTAT_EN_COURS),
+    ]
+    if fichier:
+        params.append(bigquery.ScalarQueryParameter("fichier", "STRING", fichier))
+    params += [
+        bigquery.ScalarQueryParameter(k, HISTORIQUE_EXTRA_COLUMNS[k], v) for k, v in extra.items()
+    ]
+    # Un UPDATE à la fois sur l'historique (les fichiers d'un lot se terminent en parallèle)
+    with _historique_lock:
+        client.query(query_update, job_config=bigquery.QueryJobConfig(query_parameters=params)).result()
+
+
+def _abandon_sync_table(payload, job_id):
+    update_historique_job(job_id, "Erreur", "Synchronisation interrompue (arrêt de l'instance), à relancer.")
+
+
+@job_queue.task("sync_table", on_abandon=_abandon_sync_table)
+def job_sync_table(payload, job_id):
+    client = get_bq_client()
+    with fetch_staged(payload["staged_file"]) as staged_file:
+        return sync_table_background(
+            client, PROJECT_ID, DATASET_ID, payload.get("table", "TblEmplacement"), payload["filename"],
+            job_id, staged_file, delta=payload.get("delta", False), note=payload.get("note"),
         )
-        client.query(query_err, job_config=job_config).result()
+
+
+# Jobs TblEmplacement soumis avant la généralisation (repris au redémarrage)
+job_queue.task("sync_tbl_emplacement", on_abandon=_abandon_sync_table)(job_sync_table)
 
 
 # ==========================
@@ -244,6 +362,7 @@ def sync_tbl_emplacement_background(df, client, PROJECT_ID, DATASET_ID, filename
 # ==========================
 @app.route('/parametres/import', methods=['GET', 'POST'])
 def param_import():
+    client = get_bq_client()
     _ = get_flashed_messages()
 
     try:
@@ -267,139 +386,351 @@ def param_import():
             filename = secure_filename(file.filename)
             save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            file.save(save_path)
-
+            file_hash = save_upload_hashed(file, save_path)
+
+            # 📡 Canal de progression de l'envoi (choisi par la page ; le job a son propre identifiant)
+            import_id = _import_channel(request.form.get("import_id"))
+            report = progress_hub.reporter(import_id)
+            report("reception", f"Fichier {filename} reçu", octets=os.path.getsize(save_path))
+
+            # ⏭️ Fichier identique au dernier import (réussi ou en cours) de la table : rien à faire
+            if request.form.get("force") != "1":
+                previous = find_identical_import(selected_table, file_hash)
+                if previous:
+                    os.remove(save_path)
+                    report("ignore", "Fichier identique au dernier import : ignoré")
+                    log_import(selected_table, RESULTAT_IGNORE,
+                               f"Fichier identique à l'import du {previous.DateHeureFr} ({previous.Resultat}).",
+                               None, filename, HashFichier=file_hash)
+                    flash(f"⏭️ Fichier identique au dernier import de {selected_table} "
+                          f"({previous.DateHeureFr}, {previous.Resultat}) : import ignoré. "
+                          f"Cochez « Forcer le réimport » pour le relancer.", "info")
+                    return render_template("param_import.html", table_names=table_names, selected_table=selected_table)
+
+            pending_job = None
             try:
-                import numpy as np
-                import pandas as pd
+                table = client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{selected_table}")
+                schema = table.schema
 
                 # ==============================
-                # 📂 Lecture CSV : gestion fiable des encodages Excel
+                # 📂 Lecture par morceaux (CSV : encodage / séparateur détectés sur l'en-tête ;
+                #    Excel : lecture en flux, feuille choisie d'après les colonnes de la table)
                 # ==============================
-                if filename.endswith('.csv'):
-                    df = None
-                    encodings_to_try = ['utf-16', 'utf-8-sig', 'cp1252', 'latin1']
-                    last_err = None
-
-                    for enc in encodings_to_try:
-                        try:
-                            df_try = pd.read_csv(save_path, sep=';', encoding=enc, engine='python', on_bad_lines='skip')
-                            if len(df_try.columns) == 1:
-                                df_try = pd.read_csv(save_path, sep=',', encoding=enc, engine='python', on_bad_lines='skip')
-                            if len(df_try.columns) > 1:
-                                df = df_try
-                                used_enc = enc
-                                break
-                        except Exception as e:
-                            last_err = e
-                            continue
-
-                    if df is None:
-                        flash(f"❌ Impossible de lire le CSV (dernier essai : {last_err})", "danger")
-                        return render_template("param_import.html", table_names=table_names, selected_table=selected_table)
-
-                    flash(f"✅ Lecture réussie avec encodage '{used_enc}'", "info")
-
-                elif filename.endswith(('.xls', '.xlsx')):
-                    df = pd.read_excel(save_path)
-                elif filename.endswith('.txt'):
-                    df = pd.read_csv(save_path, sep='\t', encoding='utf-8-sig', on_bad_lines='skip')
-                else:
-                    flash("❌ Format non supporté", "danger")
-                    return render_template("param_import.html", table_names=table_names)
+                try:
+                    file_format, raw_chunks = read_import_chunks(
+                        save_path, filename, columns={f.name for f in schema})
+                except ValueError as e:
+                    flash(f"❌ {e}", "danger")
+                    return render_template("param_import.html", table_names=table_names, selected_table=selected_table)
+
+                if describe_dialect(file_format):
+                    flash(f"✅ Lecture réussie ({describe_dialect(file_format)})", "info")
+                    report("lecture", f"Format détecté : {describe_dialect(file_format)}")
 
                 # ==============================
-                # 🧹 Nettoyage colonnes
+                # 🧹 Nettoyage colonnes (par morceau, selon le schéma BigQuery)
                 # ==============================
-                df.columns = (
-                    pd.Index(df.columns)
-                    .astype(str)
-                    .str.strip()
-                    .str.replace('[^0-9a-zA-Z_]', '_', regex=True)
-                    .str.replace('_{2,}', '_', regex=True)
-                    .str.strip('_')
-                )
-
-                # ✅ Schéma BigQuery
-                table = client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{selected_table}")
-                known_fields = [field.name for field in table.schema]
-                numeric_fields = [f.name for f in table.schema if f.field_type in ["INTEGER", "FLOAT", "NUMERIC"]]
-                keep_cols = [c for c in df.columns if c in known_fields]
-                if not keep_cols:
+                first_raw = next(iter(raw_chunks), None)
+                if first_raw is None:
+                    flash("❌ Aucune ligne à importer après nettoyage.", "danger")
+                    return render_template("param_import.html", table_names=table_names, selected_table=selected_table)
+
+                # Plan compilé une fois pour la table, appliqué à chaque morceau
+                plan = CleaningPlan(schema)
+                first = plan.clean(first_raw)
+                if first.columns.empty:
                     flash("❌ Aucune colonne du fichier ne correspond au schéma BigQuery.", "danger")
-                    preview = df.head().to_html(classes="table table-striped")
+                    preview = first_raw.head().to_html(classes="table table-striped")
                     return render_template("param_import.html", table_names=table_names, selected_table=selected_table, preview=preview)
-                df = df[keep_cols]
+                del first_raw
 
-                for col in numeric_fields:
-                    if col in df.columns:
-                        df[col] = df[col].replace('', np.nan)
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
+                preview = first.head().to_html(classes="table table-striped")
+                report("nettoyage", f"{len(first.columns)} colonne(s) reconnue(s)", colonnes=list(first.columns))
 
-                for col in df.select_dtypes(include=["object"]).columns:
-                    df[col] = df[col].fillna("").astype(str)
-
-                nb_lignes = len(df)
-                if nb_lignes == 0:
-                    flash("❌ Aucune ligne à importer après nettoyage.", "danger")
-                    preview = df.head().to_html(classes="table table-striped")
-                    return render_template("param_import.html", table_names=table_names, selected_table=selected_table, preview=preview)
-
-                print("==== APERÇU DU DATAFRAME AVANT ENVOI ====")
-                print("Shape:", df.shape)
-                print("Colonnes:", list(df.columns))
-                print(df.head(5).to_string())
+                print("==== APERÇU DU PREMIER MORCEAU AVANT ENVOI ====")
+                print("Shape:", first.shape)
+                print("Colonnes:", list(first.columns))
+                print(first.head(5).to_string())
                 print("==========================================")
 
+                chunks = itertools.chain([first], (plan.clean(c) for c in raw_chunks))
+
                 # ======================================================
-                # ⚙️ CAS SPÉCIAL : TblEmplacement
+                # ⚙️ TABLES À CLÉ : MERGE (UPSERT_KEYS) / AUTRES : REMPLACEMENT
                 # ======================================================
-                if selected_table == "TblEmplacement":
-                    flash("⏳ Synchronisation de TblEmplacement en cours...", "info")
-                    thread = threading.Thread(
-                        target=sync_tbl_emplacement_background,
-                        args=(df, client, PROJECT_ID, DATASET_ID, filename),
-                        daemon=True
-                    )
-                    thread.start()
-                    preview = df.head().to_html(classes="table table-striped")
-                    resultat_log = "En cours (thread)"
-                    detail_log = "Synchronisation asynchrone démarrée."
+                purge_staging()
+                staged_file = staging_path(selected_table)
+                key_cols = upsert_key(selected_table)
+                key_stats = {"sans_cle": 0}
+                mode_upsert = bool(key_cols) and request.form.get("mode", "upsert") == "upsert"
+
+                if mode_upsert:
+                    # Mise en transit locale ; chargement BigQuery + MERGE faits par le job
+                    temp_schema = list(schema) + [bigquery.SchemaField("_Ligne", "INTEGER")]
+                    nb_lignes = stage_chunks(keyed_chunks(chunks, key_cols, stats=key_stats), temp_schema,
+                                             staged_file, report=report)
+                    sans_cle = describe_dropped(key_stats["sans_cle"], key_cols)
+                    if sans_cle:
+                        report("nettoyage", sans_cle, sans_cle=key_stats["sans_cle"])
+                    if nb_lignes == 0:
+                        os.remove(staged_file)
+                        flash("❌ Aucune ligne à importer après nettoyage" + (f" ({sans_cle})" if sans_cle else "") + ".",
+                              "danger")
+                        return render_template("param_import.html", table_names=table_names, selected_table=selected_table, preview=preview)
+
+                    # Fichier relu par le job : rangé là où toute instance le retrouve (bucket)
+                    report("transit", "Publication du fichier de transit...", lignes=nb_lignes)
+                    staged_file = publish_staged(staged_file)
+
+                    # Le job n'est soumis qu'après l'écriture de l'historique qu'il va clôturer ;
+                    # identifiant généré ici, la page suit ensuite le canal du job
+                    pending_job = str(uuid.uuid4())
+                    flash(f"⏳ Synchronisation de {selected_table} en cours... (job {pending_job})", "info")
+                    resultat_log = RESULTAT_EN_COURS
+                    detail_log = f"Synchronisation asynchrone (job {pending_job})."
+                    if sans_cle:
+                        flash(f"⚠️ {sans_cle}, non importée(s).", "warning")
+                        detail_log += f" {sans_cle}."
                 else:
+                    # Fichier Parquet typé puis un seul job de chargement WRITE_TRUNCATE :
+                    # une erreur en cours de route laisse la table cible intacte
                     table_id = f"{PROJECT_ID}.{DATASET_ID}.{selected_table}"
-                    client.load_table_from_dataframe(
-                        df, table_id, job_config=bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-                    ).result()
+                    nb_lignes = stage_chunks(chunks, schema, staged_file, report=report)
+                    if nb_lignes == 0:
+                        os.remove(staged_file)
+                        flash("❌ Aucune ligne à importer après nettoyage.", "danger")
+                        return render_template("param_import.html", table_names=table_names, selected_table=selected_table, preview=preview)
+
+                    report("chargement", f"Chargement de {nb_lignes} lignes dans BigQuery...", lignes=nb_lignes)
+                    settle_pending_edits(selected_table)
+                    load_staged_file(client, staged_file, table_id, schema)
+                    table_changed(selected_table)
+                    report("termine", f"{nb_lignes} lignes importées dans {selected_table}", lignes=nb_lignes)
+                    if key_cols:
+                        discard_manifest(selected_table)
                     flash(f"✅ Données importées dans {selected_table} ({nb_lignes} lignes)", "success")
-                    preview = df.head().to_html(classes="table table-striped")
                     resultat_log = "Succès"
                     detail_log = None
 
+                # 🧮 Bilan du nettoyage (valeurs converties / rejetées)
+                bilan = plan.summary()
+                if bilan:
+                    print(f"🧮 Nettoyage : {bilan}")
+                    flash(f"🧮 Nettoyage : {bilan}", "warning" if plan.nb_rejetes else "info")
+
                 # ✅ Historique import
-                query_log = f"""
-                    INSERT INTO {PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport
-                    (NomTable, DateHeure, Utilisateur, Resultat, DetailErreur, NombreLignes, NomFichier)
-                    VALUES (@table, CURRENT_TIMESTAMP(), @user, @resultat, @detail, @nb_lignes, @fichier)
-                """
-                job_config = bigquery.QueryJobConfig(
-                    query_parameters=[
-                        bigquery.ScalarQueryParameter("table", "STRING", selected_table),
-                        bigquery.ScalarQueryParameter("user", "STRING", current_user),
-                        bigquery.ScalarQueryParameter("resultat", "STRING", resultat_log),
-                        bigquery.ScalarQueryParameter("detail", "STRING", detail_log),
-                        bigquery.ScalarQueryParameter("nb_lignes", "INT64", nb_lignes),
-                        bigquery.ScalarQueryParameter("fichier", "STRING", filename),
-                    ]
-                )
-                client.query(query_log, job_config=job_config).result()
+                log_import(selected_table, resultat_log, detail_log, nb_lignes, filename,
+                           Dialecte=describe_dialect(file_format), IdJob=pending_job,
+                           NbConvertis=plan.nb_convertis, NbRejetes=plan.nb_rejetes,
+                           NbSansCle=key_stats["sans_cle"] if mode_upsert else None,
+                           HashFichier=file_hash)
+                if pending_job:
+                    try:
+                        job_queue.submit("sync_table", {
+                            "table": selected_table, "filename": filename, "staged_file": staged_file,
+                            "delta": request.form.get("delta") == "1", "note": sans_cle,
+                        }, job_id=pending_job)
+                    except Exception as e:
+                        # Ligne « En cours » jamais close sinon : le fichier serait ensuite ignoré comme doublon
+                        update_historique_job(pending_job, "Erreur", f"Synchronisation non lancée : {e}")
+                        raise
+                    report("job", f"Synchronisation confiée au job {pending_job}")
 
             except Exception as e:
+                report("erreur", str(e))
                 flash(f"❌ Erreur import : {e}", "danger")
                 return render_template("param_import.html", table_names=table_names, selected_table=selected_table)
 
+            return render_template("param_import.html", table_names=table_names, selected_table=selected_table,
+                                   preview=preview, progress_channel=pending_job)
+
     return render_template("param_import.html", table_names=table_names, selected_table=selected_table, preview=preview)
 
 
+def _import_channel(value):
+    """Canal de progression de l'envoi, choisi par la page (sinon nouveau).
+    Jamais réutilisé comme identifiant de job ni d'historique."""
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError):
+        return str(uuid.uuid4())
+
+
+
+
+# ==========================
+# IMPORT PAR LOT (fichiers multiples / ZIP)
+# ==========================
+def _load_lot_file(task, parsed, job_id, report):
+    """Charge un fichier du lot déjà mis en transit puis clôture sa ligne d'historique."""
+    client = get_bq_client()
+    table_name, filename = task["table"], task["filename"]
+    target_table = f"{PROJECT_ID}.{DATASET_ID}.{table_name}"
+    try:
+        if "erreur" in parsed:
+            raise ValueError(parsed["erreur"])
+        if parsed["nb_lignes"] == 0:
+            raise ValueError("Aucune ligne à importer après nettoyage" + (f" ({parsed['bilan']})" if parsed["bilan"] else "") + ".")
+
+        extra = {"Dialecte": parsed["dialecte"], "NbConvertis": parsed["convertis"],
+                 "NbRejetes": parsed["rejetes"], "NbSansCle": parsed["sans_cle"] if task["key"] else None}
+        detail = parsed["bilan"]
+        settle_pending_edits(table_name)
+        if task["key"]:
+            result = upsert_staged_file(
+                client, task["staged_file"], target_table,
+                temp_table_id(PROJECT_ID, DATASET_ID, table_name, task["id"]),
+                task["key"], delta=task["delta"],
+            )
+            extra.update(_delta_columns(result["delta"]))
+            nb_lignes = result["lignes"]
+        else:
+            schema = client.get_table(target_table).schema
+            nb_lignes = load_staged_file(client, task["staged_file"], target_table, schema)
+            table_changed(table_name)
+            if upsert_key(table_name):
+                discard_manifest(table_name)
+
+        update_historique_job(job_id, "Succès", detail, nb_lignes, fichier=filename, **extra)
+        report("chargement", f"{filename} → {table_name} : {nb_lignes} ligne(s)", fichier=filename, lignes=nb_lignes)
+        return {"fichier": filename, "table": table_name, "lignes": nb_lignes}
+
+    except Exception as e:
+        print(f"❌ Lot : erreur sur {filename} ({table_name}) : {e}")
+        report("chargement", f"{filename} → {table_name} : erreur ({e})", fichier=filename)
+        update_historique_job(job_id, "Erreur", str(e), fichier=filename)
+        return {"fichier": filename, "table": table_name, "erreur": str(e)}
+
+
+def _load_lot_files(previous, ready, job_id, report):
+    """Fichiers prêts d'une même table, dans l'ordre d'envoi, après le chargement
+    précédent de cette table (soumis plus tôt au même pool, donc déjà démarré)."""
+    if previous is not None:
+        previous.result()
+    return [_load_lot_file(task, parsed, job_id, report) for task, parsed in ready]
+
+
+@job_queue.task("import_lot", on_abandon=_abandon_sync_table)
+def job_import_lot(payload, job_id):
+    """Lecture des fichiers dans un pool de threads, chargement BigQuery en parallèle
+    (BATCH_LOAD_CONCURRENCY) au fur et à mesure que chaque fichier est prêt ;
+    les fichiers d'une même table sont chargés dans leur ordre d'envoi."""
+    client = get_bq_client()
+    files = payload["files"]
+    schemas = {t: schema_fields(client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{t}").schema)
+               for t in {f["table"] for f in files}}
+    # Transit local à l'instance qui exécute le job (les sources, elles, sont publiées)
+    tasks = [dict(f, schema=schemas[f["table"]], staged_file=staging_path(f["table"])) for f in files]
+
+    report = progress_hub.reporter(job_id)
+    report("job", f"Lot {payload['lot']} : lecture de {len(tasks)} fichier(s)")
+    results = []
+    with ThreadPoolExecutor(max_workers=BATCH_LOAD_CONCURRENCY, thread_name_prefix="lot") as loaders:
+        futures, last = [], {}
+        for table, ready in in_upload_order(parse_files(tasks), tasks):
+            for task, parsed in ready:
+                report("transit", f"{task['filename']} mis en transit" + (f" ({parsed['bilan']})" if parsed.get("bilan") else ""),
+                       fichier=task["filename"], lignes=parsed.get("nb_lignes"), sans_cle=parsed.get("sans_cle"))
+            last[table] = loaders.submit(_load_lot_files, last.get(table), ready, job_id, report)
+            futures.append(last[table])
+        for future in as_completed(futures):
+            results.extend(future.result())
+
+    discard_batch(payload["lot"], [f["path"] for f in files])
+    nb_erreurs = sum(1 for r in results if "erreur" in r)
+    print(f"📦 Lot {payload['lot']} terminé : {len(results) - nb_erreurs} fichier(s) importé(s), {nb_erreurs} en erreur.")
+    report("termine", f"Lot terminé : {len(results) - nb_erreurs} fichier(s) importé(s), {nb_erreurs} en erreur")
+    return {"lot": payload["lot"], "fichiers": results, "erreurs": nb_erreurs}
+
+
+@app.route('/parametres/import_lot', methods=['POST'])
+def param_import_lot():
+    client = get_bq_client()
+    _ = get_flashed_messages()
+    uploads = [f for f in request.files.getlist('files') if f and f.filename]
+
+    try:
+        table_names = get_active_tables()
+    except Exception as e:
+        flash(f"Erreur récupération tables actives : {e}", "danger")
+        return render_template("param_import.html", table_names=[])
+
+    if not uploads:
+        flash("❌ Aucun fichier reçu.", "danger")
+        return render_template("param_import.html", table_names=table_names)
+
+    lot_id = uuid.uuid4().hex[:12]
+    job_id = str(uuid.uuid4())
+    folder = batch_folder(lot_id)
+    mode = request.form.get("mode", "upsert")
+    delta = request.form.get("delta") == "1"
+
+    try:
+        saved = []
+        for f in uploads:
+            name = secure_filename(f.filename)
+            if not name.lower().endswith(IMPORT_EXTENSIONS + ('.zip',)):
+                flash(f"⚠️ {name} ignoré (format non supporté)", "danger")
+                continue
+            path = unique_path(folder, name)
+            f.save(path)
+            saved.append((path, name))
+        entries = expand_uploads(saved, folder)
+
+        # 🔗 Rattachement fichier -> table (nom du fichier, sinon en-tête)
+        schemas = {t: client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{t}").schema for t in table_names}
+        known_columns = {f.name for schema in schemas.values() for f in schema}
+        files, rows, remplacees = [], [], set()
+        for path, name in entries:
+            try:
+                table, methode = match_table(name, read_header(path, name, known_columns), schemas)
+            except Exception as e:
+                table, methode = None, None
+                print(f"⚠️ Lot : en-tête illisible pour {name} : {e}")
+
+            key = upsert_key(table) if table and mode == "upsert" else None
+            erreur = None
+            if not table:
+                erreur = "Aucune table correspondante (nom de fichier ou en-tête)."
+            elif not key and table in remplacees:
+                erreur = f"Plusieurs fichiers pour {table} en remplacement complet : seul le premier est importé."
+            if erreur:
+                rows.append({"NomTable": table, "Resultat": "Erreur", "DetailErreur": erreur,
+                             "NomFichier": name, "IdLot": lot_id})
+                flash(f"❌ {name} : {erreur}", "danger")
+                continue
+
+            if not key:
+                remplacees.add(table)
+            files.append({"id": str(uuid.uuid4()), "path": path, "filename": name, "table": table,
+                          "key": key, "delta": delta and bool(key)})
+            rows.append({"NomTable": table, "Resultat": RESULTAT_EN_COURS, "NomFichier": name,
+                         "DetailErreur": f"Import par lot {lot_id} (job {job_id}).",
+                         "IdJob": job_id, "IdLot": lot_id})
+            flash(f"🔗 {name} → {table} (par {methode})", "success")
+
+        if not rows:
+            flash("❌ Aucun fichier importable dans le lot.", "danger")
+            return render_template("param_import.html", table_names=table_names)
+
+        # ✅ Historique : une entrée de lot, une ligne par fichier, puis soumission du job
+        purge_staging()
+        publish_batch(lot_id, files)
+        log_import_rows(rows)
+        if files:
+            try:
+                job_queue.submit("import_lot", {"lot": lot_id, "files": files}, job_id=job_id)
+            except Exception as e:
+                update_historique_job(job_id, "Erreur", f"Import par lot non lancé : {e}")
+                raise
+            progress_hub.publish(job_id, "job", f"Lot {lot_id} soumis ({len(files)} fichier(s))")
+            flash(f"⏳ Lot {lot_id} : {len(files)} fichier(s) en cours d'import (job {job_id})", "success")
+            return render_template("param_import.html", table_names=table_names, progress_channel=job_id)
+
+    except Exception as e:
+        flash(f"❌ Erreur import par lot : {e}", "danger")
+
+    return render_template("param_import.html", table_names=table_names)
 
 
 # ==========================
@@ -407,7 +738,9 @@ def param_import():
 # ==========================
 @app.route("/parametres/hist_import")
 def historique_imports():
+    client = get_bq_client()
     try:
+        ensure_historique_columns()
         query = f"""
             SELECT
                 NomTable,
@@ -417,11 +750,20 @@ def historique_imports():
                 Resultat,
                 DetailErreur,
                 NombreLignes,
-                NomFichier
+                NomFichier,
+                Dialecte,
+                NbInseres,
+                NbModifies,
+                NbInchanges,
+                NbConvertis,
+                NbRejetes,
+                NbSansCle,
+                IdLot
             FROM `{PROJECT_ID}.{DATASET_ID}.TblHistoriqueImport`
             ORDER BY DateHeure DESC
         """
         df = client.query(query).to_dataframe()
+        df = df.astype(object).where(df.notna(), None)  # NA / NaN -> None pour Jinja
 
         return render_template(
             "param_hist_import.html",
@@ -438,6 +780,7 @@ def historique_imports():
 # ==========================
 @app.route("/export_schema/<table_name>/<format>")
 def export_schema(table_name, format):
+    client = get_bq_client()
     query = f"""
         SELECT column_name, data_type
         FROM {PROJECT_ID}.{DATASET_ID}.INFORMATION_SCHEMA.COLUMNS
@@ -446,16 +789,8 @@ def export_schema(table_name, format):
     df = client.query(query).to_dataframe()
 
     if format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="Trame")
-        output.seek(0)
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=f"trame_{table_name}.xlsx",
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+        path, _ = xlsx_file(*frame_batches(df), sheet_name="Trame")
+        return send_temp_file(path, f"trame_{table_name}.xlsx", XLSX_MIMETYPE)
 
     elif format == "csv":
         output = io.StringIO()
@@ -472,32 +807,34 @@ def export_schema(table_name, format):
 
 @app.route("/export_data/<table_name>/<format>")
 def export_data(table_name, format):
-    query = f"SELECT * FROM {PROJECT_ID}.{DATASET_ID}.{table_name} LIMIT 100000"
-    df = client.query(query).to_dataframe()
+    if format not in EXPORT_FORMATS:
+        return "Format non supporté", 400
+    try:
+        query = export_query(table_name)
+    except ValueError as e:
+        return str(e), 400
 
-    if format == "excel":
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="Données")
-        output.seek(0)
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=f"donnees_{table_name}.xlsx",
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+    basename = f"donnees_{table_name}"
+    try:
+        # Saisies de la grille encore en file : écrites avant de calculer la version
+        settle_pending_edits(table_name)
+        key = (table_name, format, table_version(table_name))
+    except Exception as e:
+        print(f"⚠️ Saisies en attente ou version de {table_name} indisponibles, export sans cache : {e}")
+        key = None
 
-    elif format == "csv":
-        output = io.StringIO()
-        df.to_csv(output, index=False, sep=";")
-        return Response(
-            output.getvalue(),
-            mimetype="text/csv",
-            headers={"Content-Disposition": f"attachment;filename=donnees_{table_name}.csv"},
-        )
+    # 🗃️ Même version de la table déjà exportée : fichier en cache (cf. export_cache.py)
+    entry = export_cache.get(key) if key else None
+    if entry is not None:
+        ext, mimetype = EXPORT_FORMATS[format]
+        return export_cache.send(entry, f"{basename}.{ext}", mimetype)
 
-    else:
-        return "Format non supporté", 400
+    # 📤 En flux, toutes les lignes, lot par lot (cf. exports.py) :
+    # csv / parquet / arrow envoyés au fil de l'eau, excel écrit dans un fichier temporaire
+    schema, batches = query_batches(query)
+    if key is None:
+        return export_response(schema, batches, format, basename)
+    return export_cache.export_response(key, schema, batches, format, basename)
 
 
 # ==========================
@@ -663,7 +1000,9 @@ def parametres_types_emplacement():
 
 # --- API : Récupération de toutes les lignes ---
 @app.route("/api/types_emplacement_data")
+@versioned_json("TblTypeEmpla123")
 def api_types_emplacement_data():
+    client = get_bq_client()
     try:
         query = f"SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.TblTypeEmpla123` ORDER BY Type1, Type2, Type3"
         df = client.query(query).to_dataframe()
@@ -676,6 +1015,7 @@ def api_types_emplacement_data():
 # --- API : Récupération d’un type particulier ---
 @app.route("/api/types_emplacement_get")
 def api_types_emplacement_get():
+    client = get_bq_client()
     try:
         type_ = request.args.get("type")
         query = f"""
@@ -697,6 +1037,7 @@ def api_types_emplacement_get():
 # --- API : Ajout / Mise à jour d’un type ---
 @app.route("/api/types_emplacement_add", methods=["POST"])
 def api_types_emplacement_add():
+    client = get_bq_client()
     try:
         data = request.get_json() or {}
 
@@ -736,6 +1077,7 @@ def api_types_emplacement_add():
             VALUES (@t1, @t2, @t3)
         """
         client.query(insert_sql, job_config=job_cfg).result()
+        table_changed("TblTypeEmpla123")
 
         return jsonify({
             "status": "success",
@@ -750,6 +1092,7 @@ def api_types_emplacement_add():
 # --- API : Suppression d’un type ---
 @app.route("/api/types_emplacement_delete", methods=["DELETE"])
 def api_types_emplacement_delete():
+    client = get_bq_client()
     try:
         data = request.get_json()
         type_ = data.get("type")
@@ -759,6 +1102,7 @@ def api_types_emplacement_delete():
             WHERE Type1 = '{type_}'
         """
         client.query(delete_query).result()
+        table_changed("TblTypeEmpla123")
 
         return jsonify({"status": "success", "message": "🗑 Type supprimé."})
     except Exception as e:
@@ -775,6 +1119,7 @@ def groupes_circuit():
     return render_template("groupes_circuit.html", title="🔗 Groupes de circuits")
 
 @app.route('/api/groupes_circuit/data', methods=['GET'])
+@versioned_json("TblGroupeCircuit")
 def api_groupes_circuit_data():
     """
     Retourne la liste des groupes et leurs circuits:
@@ -783,7 +1128,7 @@ def api_groupes_circuit_data():
       ...
     ]
     """
-    client = bigquery.Client(project=PROJECT_ID)
+    client = get_bq_client()
     TABLE = f"{PROJECT_ID}.{DATASET_ID}.TblGroupeCircuit"
 
     q = f"""
@@ -808,7 +1153,7 @@ def api_groupes_circuit_circuits_options():
     - Tous les circuits distincts de TblPicking.Circuit
     - EXCLUANT ceux déjà attribués dans TblGroupeCircuit
     """
-    client = bigquery.Client(project=PROJECT_ID)
+    client = get_bq_client()
     T_PICK = f"{PROJECT_ID}.{DATASET_ID}.TblPicking"
     T_GRP  = f"{PROJECT_ID}.{DATASET_ID}.TblGroupeCircuit"
 
@@ -831,6 +1176,7 @@ def api_groupes_circuit_circuits_options():
 @app.route('/api/groupes_circuit/add', methods=['POST'])
 def api_groupes_circuit_add():
     """Ajoute ou met à jour un groupe de circuits"""
+    client = get_bq_client()
     data = request.get_json()
     groupe = data.get("groupe", "").strip()
     designation = data.get("designation", "").strip()
@@ -892,6 +1238,7 @@ def api_groupes_circuit_add():
             VALUES {values_clause}
         """
         client.query(insert_query).result()
+        table_changed("TblGroupeCircuit")
 
         msg = "✅ Groupe mis à jour." if group_exists else "✅ Groupe créé."
         return jsonify({"status": "success", "message": msg}), 200
@@ -905,7 +1252,7 @@ def api_groupes_circuit_delete():
     Supprime un groupe complet (toutes ses lignes)
     Body JSON: { "groupe": "SEC_01" }
     """
-    client = bigquery.Client(project=PROJECT_ID)
+    client = get_bq_client()
     TABLE = f"{PROJECT_ID}.{DATASET_ID}.TblGroupeCircuit"
 
     data = request.get_json(silent=True) or {}
@@ -918,6 +1265,7 @@ def api_groupes_circuit_delete():
         bigquery.ScalarQueryParameter("g", "STRING", groupe)
     ])
     client.query(q_del, job_config=cfg).result()
+    table_changed("TblGroupeCircuit")
     return jsonify({"status": "success", "message": f"🗑 Groupe « {groupe} » supprimé."}), 200
 
 #-------------------------------------------------------------------
@@ -933,6 +1281,7 @@ def ventes_ref():
 # ============================================================
 @app.route("/api/ventes_exceptionnelles_ref_data")
 def api_ventes_exceptionnelles_ref_data():
+    client = get_bq_client()
     from decimal import Decimal
     import numpy as np
 
@@ -994,6 +1343,7 @@ def api_ventes_exceptionnelles_ref_data():
 # ============================================================
 @app.route("/api/ventes_exceptionnelles_ref_add", methods=["POST"])
 def api_ventes_exceptionnelles_ref_add():
+    client = get_bq_client()
     data = request.get_json()
     ref = data.get("Reference")
     evolution = data.get("Evolution")
@@ -1079,6 +1429,7 @@ def api_ventes_exceptionnelles_ref_add():
 
 @app.route("/api/ventes_exceptionnelles_ref_delete", methods=["DELETE"])
 def api_ventes_exceptionnelles_ref_delete():
+    client = get_bq_client()
     data = request.get_json()
     id_ = data.get("IDEvenementRef")
     if not id_:
@@ -1093,10 +1444,11 @@ def api_ventes_exceptionnelles_ref_delete():
 
 
 @app.route("/api/ventes_exceptionnelles_ref_options")
+@versioned_json("TblHistoriqueStockVente")
 def api_ventes_exceptionnelles_ref_options():
     """Retourne uniquement la liste des TypeFlux disponibles (plus rapide)."""
     from google.cloud import bigquery
-    client = bigquery.Client(project=PROJECT_ID)
+    client = get_bq_client()
     T_HIST = f"{PROJECT_ID}.{DATASET_ID}.TblHistoriqueStockVente"
 
     flux_query = f"""
@@ -1114,6 +1466,7 @@ def api_ventes_exceptionnelles_ref_options():
 # ============================================================
 @app.route("/api/ventes_exceptionnelles_ref_update", methods=["POST"])
 def api_ventes_exceptionnelles_ref_update():
+    client = get_bq_client()
     try:
         data = request.get_json()
         id_ = data.get("IDEvenementRef")
@@ -1176,6 +1529,7 @@ def api_ventes_exceptionnelles_ref_update():
 # ============================================================
 @app.route("/api/ventes_exceptionnelles_ref_get/<int:id>")
 def api_ventes_exceptionnelles_ref_get(id):
+    client = get_bq_client()
     try:
         query = f"""
             SELECT 
@@ -1221,6 +1575,7 @@ def ventes_fournisseur():
 # ============================================================
 @app.route("/api/ventes_fournisseur_data")
 def api_ventes_fournisseur_data():
+    client = get_bq_client()
     try:
         query = f"""
             SELECT 
@@ -1247,6 +1602,7 @@ def api_ventes_fournisseur_data():
 # ============================================================
 @app.route("/api/ventes_fournisseur_add", methods=["POST"])
 def api_ventes_fournisseur_add():
+    client = get_bq_client()
     data = request.get_json()
     n_fournisseur = data.get("NFournisseur")
     nom_fournisseur = data.get("NomFournisseur")
@@ -1314,6 +1670,7 @@ def api_ventes_fournisseur_add():
 # ============================================================
 @app.route("/api/ventes_fournisseur_get/<int:id>")
 def api_ventes_fournisseur_get(id):
+    client = get_bq_client()
     try:
         query = f"""
             SELECT 
@@ -1342,6 +1699,7 @@ def api_ventes_fournisseur_get(id):
 # ============================================================
 @app.route("/api/ventes_fournisseur_update", methods=["POST"])
 def api_ventes_fournisseur_update():
+    client = get_bq_client()
     data = request.get_json()
     id_ = data.get("IDEvenementFournisseur")
     nfourn = data.get("NFournisseur")
@@ -1385,6 +1743,7 @@ def api_ventes_fournisseur_update():
 # ============================================================
 @app.route("/api/ventes_fournisseur_delete", methods=["DELETE"])
 def api_ventes_fournisseur_delete():
+    client = get_bq_client()
     data = request.get_json()
     id_ = data.get("IDEvenementFournisseur")
 
@@ -1401,7 +1760,9 @@ def api_ventes_fournisseur_delete():
 # 🔄 API – Liste des TypeFlux disponibles
 # ============================================================
 @app.route("/api/ventes_fournisseur_options")
+@versioned_json("TblHistoriqueStockVente")
 def api_ventes_fournisseur_options():
+    client = get_bq_client()
     T_HIST = f"{PROJECT_ID}.{DATASET_ID}.TblHistoriqueStockVente"
     query = f"""
         SELECT DISTINCT TRIM(TypeFlux) AS TypeFlux
@@ -1419,6 +1780,7 @@ def api_ventes_fournisseur_options():
 @app.route("/api/ventes_fournisseur_lookup")
 def api_ventes_fournisseur_lookup():
     """Recherche fournisseur par numéro ou nom"""
+    client = get_bq_client()
     term = request.args.get("term", "").strip()
     if not term:
         return jsonify([])
@@ -1441,6 +1803,7 @@ def api_ventes_fournisseur_lookup():
 @app.route("/api/ventes_famille_data")
 def api_ventes_famille_data():
     """Retourne toutes les ventes exceptionnelles par famille produit"""
+    client = get_bq_client()
     try:
         query = f"""
             SELECT IDEvenementFamilleProduit, FamilleDeProduit1, FamilleDeProduit2, FamilleDeProduit3,
@@ -1457,6 +1820,7 @@ def api_ventes_famille_data():
 
 @app.route("/api/ventes_famille_add", methods=["POST"])
 def api_ventes_famille_add():
+    client = get_bq_client()
     data = request.get_json()
 
     try:
@@ -1482,6 +1846,7 @@ def api_ventes_famille_add():
         )
 
         client.query(query, job_config=job_config).result()
+        table_changed("TblEvenementVenteFamilleProduit")
         return jsonify({"status": "success", "message": "✅ Événement ajouté avec succès."})
 
     except Exception as e:
@@ -1492,6 +1857,7 @@ def api_ventes_famille_add():
 @app.route("/api/ventes_famille_update", methods=["POST"])
 def api_ventes_famille_update():
     """Met à jour une ligne existante"""
+    client = get_bq_client()
     try:
         data = request.get_json()
         id_evt = data.get("IDEvenementFamilleProduit")
@@ -1522,6 +1888,7 @@ def api_ventes_famille_update():
             ]
         )
         client.query(query, job_config=job_config).result()
+        table_changed("TblEvenementVenteFamilleProduit")
 
         return jsonify({"status": "success", "message": "✅ Vente par famille produit mise à jour."})
     except Exception as e:
@@ -1530,6 +1897,7 @@ def api_ventes_famille_update():
 
 @app.route("/api/ventes_famille_delete", methods=["DELETE"])
 def api_ventes_famille_delete():
+    client = get_bq_client()
     data = request.get_json()
     id_evt = data.get("IDEvenementFamilleProduit")
 
@@ -1541,6 +1909,7 @@ def api_ventes_famille_delete():
                 WHERE IDEvenementFamilleProduit IS NULL
             """
             client.query(query).result()
+            table_changed("TblEvenementVenteFamilleProduit")
             return jsonify({"status": "success", "message": "🗑️ Lignes sans ID supprimées."})
 
         # 🔹 Cas normal : suppression par ID
@@ -1555,6 +1924,7 @@ def api_ventes_famille_delete():
         )
 
         client.query(query, job_config=job_config).result()
+        table_changed("TblEvenementVenteFamilleProduit")
         return jsonify({"status": "success", "message": f"🗑️ Événement #{id_evt} supprimé."})
 
     except Exception as e:
@@ -1565,6 +1935,7 @@ def api_ventes_famille_delete():
 
 @app.route("/api/ventes_famille_get/<int:id_evt>")
 def api_ventes_famille_get(id_evt):
+    client = get_bq_client()
     try:
         query = f"""
             SELECT *
@@ -1604,8 +1975,10 @@ def api_ventes_famille_get(id_evt):
 
 
 @app.route("/api/ventes_famille_options")
+@versioned_json("TblEvenementVenteFamilleProduit")
 def api_ventes_famille_options():
     """Retourne les options de TypeFlux distincts disponibles"""
+    client = get_bq_client()
     try:
         query = f"""
             SELECT DISTINCT TypeFlux
@@ -1624,7 +1997,9 @@ def page_ventes_famille():
     return render_template("ventes_famille_produit.html")
 
 @app.route("/api/familles_options")
+@versioned_json("TblProduit")
 def api_familles_options():
+    client = get_bq_client()
     query = f"""
         SELECT DISTINCT FamilleDeProduit1, FamilleDeProduit2, FamilleDeProduit3
         FROM `{PROJECT_ID}.{DATASET_ID}.TblProduit`
@@ -1642,8 +2017,46 @@ def api_familles_options():
     })
 
 
+# ==========================
+# ⏱️ FILE DE JOBS (après l'enregistrement de tous les handlers)
+# ==========================
+_services_lock = threading.Lock()
+_services_started = False
+
+
+def start_background_services():
+    """Démarre la file de jobs (exécution, battement de cœur, reprise des jobs orphelins)
+    et le journal des saisies différées de la grille (reprise des saisies orphelines).
+    Une fois par processus serveur, jamais à l'import (le processus parent du reloader
+    de développement réclamerait des jobs sans servir de requêtes) :
+     - gunicorn : hook post_worker_init (cf. gunicorn.conf.py)
+     - python app.py : processus enfant du reloader
+     - sinon (flask run...) : à la première requête (cf. _ensure_background_services)
+    Appels suivants sans effet."""
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        # JOB_STORE=memory : stockage local sans PostgreSQL (tests / développement)
+        memory = os.environ.get("JOB_STORE") == "memory"
+        job_queue.start(MemoryJobStore() if memory else PgJobStore())
+        edit_buffer.start(MemoryEditJournal() if memory else PgEditJournal())
+        edit_buffer.flush_on_sigterm()
+        _services_started = True
+
+
+@app.before_request
+def _ensure_background_services():
+    # Serveur lancé sans hook de démarrage : la file et le journal démarrent avant la première requête
+    if not _services_started:
+        start_background_services()
+
+
 # ==========================
 # LANCEMENT APP
 # ==========================
 if __name__ == "__main__":
+    # Reloader : le parent surveille les fichiers, seul l'enfant (WERKZEUG_RUN_MAIN) sert l'application
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services()
     app.run(debug=True)
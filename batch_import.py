@@ -0,0 +1,200 @@
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from google.cloud import bigquery
+from werkzeug.utils import secure_filename
+
+from cleaning import CleaningPlan, normalize_columns
+from import_pipeline import (
+    read_import_chunks, describe_dialect, stage_chunks, publish_staged, fetch_staged, discard_staged, STAGING_BUCKET,
+)
+from sync_engine import ROW_NUMBER_COL, keyed_chunks, describe_dropped
+
+
+# ============================================================
+# 📦 IMPORT PAR LOT (plusieurs fichiers ou une archive ZIP)
+# ============================================================
+# Chaque fichier est rattaché à une table (nom du fichier, sinon en-tête),
+# publié (bucket de transit, cf. import_pipeline.publish_staged), puis
+# lu / nettoyé / mis en transit Parquet dans un pool de threads et
+# chargé dans BigQuery par le job "import_lot" (cf. app.py) : tables différentes
+# en parallèle, fichiers d'une même table l'un après l'autre dans l'ordre d'envoi.
+
+BATCH_FOLDER = os.path.join('uploads', 'lots')
+BATCH_PARSE_WORKERS = int(os.environ.get("BATCH_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+BATCH_LOAD_CONCURRENCY = int(os.environ.get("BATCH_LOAD_CONCURRENCY", 3))
+IMPORT_EXTENSIONS = ('.csv', '.xlsx', '.xls', '.txt')
+
+# Part minimale des colonnes du fichier présentes dans la table pour un rattachement par en-tête
+HEADER_MATCH_MIN = 0.5
+
+
+def batch_folder(lot_id, folder=BATCH_FOLDER):
+    path = os.path.join(folder, lot_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def publish_batch(lot_id, files, folder=BATCH_FOLDER):
+    """
+    Range les fichiers sources du lot (après extraction des ZIP, cf. expand_uploads)
+    là où le job les retrouvera, même repris par une autre instance :
+    file["path"] devient la référence publiée (gs://.../lots/<lot>/<nom>).
+    """
+    for f in files:
+        f["path"] = publish_staged(f["path"], prefix=f"lots/{lot_id}")
+    if STAGING_BUCKET:
+        # Copies locales inutiles (fichiers écartés compris) : disque de l'instance en mémoire
+        shutil.rmtree(os.path.join(folder, lot_id), ignore_errors=True)
+
+
+def discard_batch(lot_id, refs=(), folder=BATCH_FOLDER):
+    """Fichiers sources d'un lot terminé (les fichiers de transit restent pour audit)."""
+    for ref in refs:
+        try:
+            discard_staged(ref)
+        except Exception as e:
+            print(f"⚠️ Fichier source du lot {lot_id} non supprimé ({ref}) : {e}")
+    shutil.rmtree(os.path.join(folder, lot_id), ignore_errors=True)
+
+
+def unique_path(folder, name):
+    """Chemin libre dans le dossier du lot : nom, sinon 1_nom, 2_nom..."""
+    path, n = os.path.join(folder, name), 0
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(folder, f"{n}_{name}")
+    return path
+
+
+def expand_uploads(saved, folder):
+    """
+    [(chemin, nom)] envoyés -> [(chemin, nom)] importables : les archives ZIP
+    sont extraites à plat dans le dossier du lot (sous-dossiers ignorés).
+    """
+    entries = []
+    for path, name in saved:
+        if not name.lower().endswith('.zip'):
+            entries.append((path, name))
+            continue
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                member_name = secure_filename(os.path.basename(member.filename))
+                if member.is_dir() or member.filename.startswith('__MACOSX') \
+                        or not member_name.lower().endswith(IMPORT_EXTENSIONS):
+                    continue
+                target = unique_path(folder, member_name)
+                with archive.open(member) as src, open(target, 'wb') as dst:
+                    while True:
+                        block = src.read(1024 * 1024)
+                        if not block:
+                            break
+                        dst.write(block)
+                entries.append((target, member_name))
+        os.remove(path)
+    return entries
+
+
+def read_header(path, filename, columns=None):
+    """Colonnes normalisées du fichier (premier petit morceau seulement).
+    columns : colonnes connues, pour choisir la feuille d'un classeur."""
+    _, chunks = read_import_chunks(path, filename, chunksize=50, columns=columns)
+    first = next(iter(chunks), None)
+    if hasattr(chunks, "close"):
+        chunks.close()  # libère le fichier / classeur sans lire la suite
+    return [] if first is None else list(normalize_columns(first.columns))
+
+
+def match_table(filename, header, schemas):
+    """
+    Table cible d'un fichier : nom de table contenu dans le nom du fichier
+    (le plus long gagne), sinon meilleure correspondance des colonnes.
+    Retourne (table, "nom" | "en-tête") ou (None, None).
+    """
+    stem = os.path.splitext(filename)[0].lower()
+    by_name = [t for t in schemas if t.lower() in stem]
+    if by_name:
+        return max(by_name, key=len), "nom"
+
+    columns = set(header)
+    best, best_score = None, (0, 0)
+    for table, schema in schemas.items():
+        matched = len(columns & {f.name for f in schema})
+        score = (matched / len(columns) if columns else 0, matched)
+        if score > best_score:
+            best, best_score = table, score
+    if best and best_score[0] >= HEADER_MATCH_MIN:
+        return best, "en-tête"
+    return None, None
+
+
+def schema_fields(schema):
+    """Schéma BigQuery -> tuples sérialisables (payload du job, tâche de lecture)."""
+    return [(f.name, f.field_type, f.mode) for f in schema]
+
+
+def stage_file_worker(task):
+    """
+    Exécuté dans un thread du pool : lecture, nettoyage et mise en transit
+    Parquet d'un fichier. Ne lève pas : l'erreur est retournée à l'appelant.
+    """
+    try:
+        schema = [bigquery.SchemaField(name, ftype, mode=mode) for name, ftype, mode in task["schema"]]
+        with fetch_staged(task["path"]) as path:
+            dialect, raw_chunks = read_import_chunks(path, task["filename"],
+                                                     columns={f.name for f in schema})
+            plan = CleaningPlan(schema)
+            chunks = (plan.clean(c) for c in raw_chunks)
+            key_stats = {}
+            if task["key"]:
+                chunks = keyed_chunks(chunks, task["key"], stats=key_stats)
+                schema = schema + [bigquery.SchemaField(ROW_NUMBER_COL, "INTEGER")]
+            nb_lignes = stage_chunks(chunks, schema, task["staged_file"])
+        return {
+            "nb_lignes": nb_lignes,
+            "dialecte": describe_dialect(dialect),
+            "convertis": plan.nb_convertis,
+            "rejetes": plan.nb_rejetes,
+            "sans_cle": key_stats.get("sans_cle", 0),
+            "bilan": "; ".join(filter(None, [plan.summary(), describe_dropped(key_stats.get("sans_cle"), task["key"])]))
+                     or None,
+        }
+    except Exception as e:
+        return {"erreur": str(e)}
+
+
+def in_upload_order(results, tasks):
+    """
+    (tâche, résultat) au fil de la mise en transit -> (table, [(tâche, résultat)...])
+    dans l'ordre d'envoi des fichiers de chaque table : un fichier n'est rendu
+    qu'après ceux de sa table envoyés avant lui (une clé présente dans deux
+    fichiers garde la valeur du dernier envoyé, quel que soit l'ordre de lecture).
+    """
+    order = {}
+    for task in tasks:
+        order.setdefault(task["table"], []).append(task["id"])
+    position = dict.fromkeys(order, 0)
+    ready = {}
+    for task, parsed in results:
+        table = task["table"]
+        ready[task["id"]] = (task, parsed)
+        ids, batch = order[table], []
+        while position[table] < len(ids) and ids[position[table]] in ready:
+            batch.append(ready.pop(ids[position[table]]))
+            position[table] += 1
+        if batch:
+            yield table, batch
+
+
+def parse_files(tasks, workers=BATCH_PARSE_WORKERS):
+    """Met les fichiers en transit en parallèle ; produit (tâche, résultat) au fil de l'eau."""
+    # Threads, pas de processus : un fork du serveur copierait des verrous tenus par ses
+    # autres threads (jobs, tampon d'écriture, SSE...) et "spawn" / "forkserver"
+    # réexécuteraient app.py dans chaque enfant. La lecture (moteur C de pandas,
+    # pyarrow, zlib, réseau) relâche le GIL l'essentiel du temps.
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks))), thread_name_prefix="lot-lecture") as pool:
+        futures = {pool.submit(stage_file_worker, task): task for task in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
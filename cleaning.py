@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+
+
+# ============================================================
+# 🧹 NETTOYAGE COMPILÉ À PARTIR DU SCHÉMA BIGQUERY
+# ============================================================
+# Le plan de nettoyage est construit une fois par table (type de chaque colonne
+# -> fonction de conversion), puis appliqué colonne par colonne en passes
+# vectorisées sur chaque morceau lu. Les valeurs converties (virgule décimale,
+# date FR, espaces) et rejetées (non vides devenues NULL) sont comptées.
+
+NUMERIC_TYPES = ("INTEGER", "INT64", "FLOAT", "FLOAT64", "NUMERIC", "BIGNUMERIC")
+INTEGER_TYPES = ("INTEGER", "INT64")
+BOOL_TYPES = ("BOOLEAN", "BOOL")
+DATE_TYPES = ("DATE", "DATETIME", "TIMESTAMP")
+TRUE_VALUES = {"1", "true", "vrai", "oui", "yes", "on", "x"}
+FALSE_VALUES = {"0", "false", "faux", "non", "no", "off"}
+
+# Formats essayés dans l'ordre ; les deux premiers (ISO) ne comptent pas comme conversions
+DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%d-%m-%Y",
+    "%Y-%m-%dT%H:%M:%S",
+)
+ISO_FORMATS = 2
+
+# Espaces utilisées comme séparateurs de milliers, insécables comprises (explicites :
+# le \s des chaînes pyarrow, moteur RE2, ne couvre que l'ASCII)
+_SPACES = "[\\s\u00a0\u202f]"
+# '1,234' : milliers à l'anglaise ou décimale à la française, rejeté plutôt que deviné
+_AMBIGUOUS = r"[+-]?[1-9]\d{0,2},\d{3}"
+_INTEGER = r"[+-]?\d+"
+MAX_EXACT_FLOAT = 2 ** 53    # au-delà, un entier passé par float64 n'est plus exact
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def normalize_columns(columns):
+    """Nettoie les noms de colonnes ('Poids Limite (kg)' -> 'Poids_Limite_kg')."""
+    return (
+        pd.Index(columns)
+        .astype(str)
+        .str.strip()
+        .str.replace('[^0-9a-zA-Z_]', '_', regex=True)
+        .str.replace('_{2,}', '_', regex=True)
+        .str.strip('_')
+    )
+
+
+def _as_text(series):
+    return series.fillna("").astype(str).str.strip()
+
+
+def parse_numbers(series):
+    """
+    Texte -> float64 : '12,3' / '1 234,5' / '1.234,5' / '1,234.5' acceptés,
+    '1,234' rejeté (ambigu). Retourne (valeurs, nb convertis, nb rejetés).
+    """
+    s = _as_text(series)
+    empty = (s == "").to_numpy()
+    values = pd.to_numeric(s, errors="coerce").astype("float64")
+
+    # Passe rapide ci-dessus ; seules les valeurs non standard sont retravaillées
+    todo = values.isna().to_numpy() & ~empty
+    converted = 0
+    if todo.any():
+        t = s[todo].str.replace(_SPACES, "", regex=True)
+        t = t.mask(t.str.fullmatch(_AMBIGUOUS), "")
+        french = t.str.rfind(",") > t.str.rfind(".")
+        t = t.where(
+            ~french,
+            t.str.replace(".", "", regex=False).str.replace(",", ".", regex=False),
+        ).where(french, t.str.replace(",", "", regex=False))
+        fixed = pd.to_numeric(t, errors="coerce").astype("float64")
+        values[todo] = fixed.to_numpy()
+        converted = int(fixed.notna().sum())
+
+    rejected = int((values.isna().to_numpy() & ~empty).sum())
+    return values, converted, rejected
+
+
+def parse_integers(series):
+    """
+    Texte -> Int64 nullable. Les entiers ('1234', '1 234') sont lus directement,
+    sans passer par float64 (exacts jusqu'aux bornes de INT64) ; les autres
+    écritures ('12,0', '1e3') passent par parse_numbers et sont rejetées si
+    décimales ou au-delà de 2**53.
+    """
+    s = _as_text(series)
+    t = s.str.replace(_SPACES, "", regex=True)
+    digits = t.str.fullmatch(_INTEGER).to_numpy()
+    out = pd.Series(pd.NA, index=series.index, dtype="Int64")
+    converted = int((t != s)[digits].sum())
+    rejected = 0
+
+    if digits.any():
+        ints = pd.to_numeric(t[digits], errors="coerce")
+        if ints.dtype != np.int64:
+            # Valeurs hors de int64 dans le morceau : lecture exacte valeur par valeur
+            ints = [v if INT64_MIN <= v <= INT64_MAX else None for v in map(int, t[digits])]
+        ints = pd.array(list(ints), dtype="Int64")
+        out[digits] = ints
+        rejected += int(ints.isna().sum())
+
+    rest = ~digits & (s != "").to_numpy()
+    if rest.any():
+        values, n_converted, n_rejected = parse_numbers(s[rest])
+        exact = values.notna() & (values % 1 == 0) & (values.abs() <= MAX_EXACT_FLOAT)
+        out[rest] = values.where(exact).astype("Int64").to_numpy()
+        converted += n_converted
+        rejected += n_rejected + int((values.notna() & ~exact).sum())
+    return out, converted, rejected
+
+
+def parse_bools(series):
+    s = _as_text(series).str.lower()
+    out = pd.Series(pd.NA, index=series.index, dtype="boolean")
+    is_true, is_false = s.isin(TRUE_VALUES), s.isin(FALSE_VALUES)
+    out[is_true] = True
+    out[is_false] = False
+    rejected = int(((s != "") & ~is_true & ~is_false).sum())
+    return out, 0, rejected
+
+
+def parse_dates(series):
+    """Texte -> datetime64 (formats ISO puis français jour/mois/année)."""
+    s = _as_text(series)
+    out = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+    todo = (s != "").to_numpy().copy()
+    converted = 0
+    for i, fmt in enumerate(DATE_FORMATS):
+        if not todo.any():
+            break
+        parsed = pd.to_datetime(s[todo], format=fmt, errors="coerce")
+        ok = parsed.notna().to_numpy()
+        if ok.any():
+            idx = np.flatnonzero(todo)[ok]
+            out.iloc[idx] = parsed[ok].to_numpy()
+            todo[idx] = False
+            if i >= ISO_FORMATS:
+                converted += int(ok.sum())
+    return out, converted, int(todo.sum())
+
+
+def parse_strings(series):
+    raw = series.fillna("").astype(str)
+    s = raw.str.strip()
+    return s, int((s != raw).sum()), 0
+
+
+def parser_for(field_type):
+    """Fonction de conversion associée à un type BigQuery."""
+    if field_type in INTEGER_TYPES:
+        return parse_integers
+    if field_type in NUMERIC_TYPES:
+        return parse_numbers
+    if field_type in BOOL_TYPES:
+        return parse_bools
+    if field_type in DATE_TYPES:
+        return parse_dates
+    return parse_strings
+
+
+def parse_number(value):
+    """Version unitaire de parse_numbers (saisies du frontend) : float ou None."""
+    return parse_number_list([value])[0]
+
+
+def parse_number_list(values):
+    """Liste de saisies -> liste de float / None, en une seule passe vectorisée."""
+    parsed, _, _ = parse_numbers(pd.Series(list(values), dtype=object))
+    return [float(v) if np.isfinite(v) else None for v in parsed.to_numpy()]
+
+
+class CleaningPlan:
+    """
+    Plan de nettoyage d'une table : colonnes du schéma -> conversion typée.
+    clean() s'applique à chaque morceau lu ; les compteurs s'accumulent sur l'import.
+    """
+
+    def __init__(self, schema):
+        self.steps = {f.name: parser_for(f.field_type) for f in schema}
+        self.stats = {name: {"convertis": 0, "rejetes": 0} for name in self.steps}
+        self._mappings = {}
+
+    def _mapping(self, raw_columns):
+        """Colonne brute -> colonne du schéma (calculé une fois par en-tête de fichier)."""
+        key = tuple(raw_columns)
+        if key not in self._mappings:
+            mapping = {}
+            for raw, name in zip(raw_columns, normalize_columns(raw_columns)):
+                if name in self.steps and name not in mapping.values():
+                    mapping[raw] = name
+            self._mappings[key] = mapping
+        return self._mappings[key]
+
+    def clean(self, df):
+        """Morceau brut (texte) -> DataFrame typé limité aux colonnes du schéma."""
+        out = {}
+        for raw, name in self._mapping(df.columns).items():
+            values, converted, rejected = self.steps[name](df[raw])
+            out[name] = values
+            self.stats[name]["convertis"] += converted
+            self.stats[name]["rejetes"] += rejected
+        return pd.DataFrame(out, index=df.index)
+
+    @property
+    def nb_convertis(self):
+        return sum(s["convertis"] for s in self.stats.values())
+
+    @property
+    def nb_rejetes(self):
+        return sum(s["rejetes"] for s in self.stats.values())
+
+    def summary(self):
+        """Résumé lisible des colonnes touchées, ou None si rien à signaler."""
+        parts = [
+            f"{name} : {s['convertis']} convertie(s), {s['rejetes']} rejetée(s)"
+            for name, s in self.stats.items() if s["convertis"] or s["rejetes"]
+        ]
+        return " ; ".join(parts) or None
@@ -1,7 +1,6 @@
 import os
 import psycopg2
 from psycopg2 import pool
-from google.cloud import secretmanager
 from google.api_core.exceptions import NotFound, PermissionDenied
 
 PROJECT_ID = "slottix"
@@ -19,6 +18,8 @@ connection_pool = None  # initialisé dynamiquement
 
 def get_secret(secret_id):
     """Récupère un secret depuis Google Secret Manager"""
+    # Import à l'usage : les modules qui n'utilisent que le pool (jobs, tests) s'en passent
+    from google.cloud import secretmanager
     client = secretmanager.SecretManagerServiceClient()
     name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/latest"
     try:
@@ -1,12 +1,29 @@
 import os
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = r"C:\Users\cedri\Documents\Projet\Slotting Profiling\SlottixFlask\credentials_slottix.json"
 
+import base64
+import hashlib
+import json
 import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 from flask import Blueprint, render_template, request, jsonify
 from google.cloud import bigquery
 
+from cleaning import parse_number, parse_number_list
+from gcp_client import get_bq_client
+from http_cache import versioned_json, table_version
+from edit_buffer import EditBuffer
+from exports import EXPORT_FORMATS, query_batches, export_response
+from emplacement_snapshot import emplacement_snapshot, filter_frame, frame_records, key_label, LABEL_COL, ID_COL, KEY_COL
+from location_grid import AisleGrid, preview_coordinates
+from sync_engine import on_table_change, table_changed, temp_table_id, bulk_update_from_frame
+
 bp_detail_emplacement = Blueprint("detail_emplacement", __name__)
-client = bigquery.Client()
 TABLE_ID = "slottix.entrepot_optimisation.TblEmplacement"
 
 _num_regex = re.compile(r"^-?\d+(\.\d+)?$")
@@ -38,7 +55,6 @@ def _filters_from_args(args):
         "type1": args.get("type1", ""),
         "type2": args.get("type2", ""),
         "type3": args.get("type3", ""),
-        "pictogramme": args.get("pictogramme", ""),
         "search": args.get("search[value]", ""),  # recherche globale
     }
 
@@ -78,22 +94,345 @@ def _build_where_and_params(f):
     if f.get("type3"):
         conds.append("LOWER(e.Type3) = LOWER(@type3)")
         params.append(bigquery.ScalarQueryParameter("type3", "STRING", f["type3"]))
-    if f.get("pictogramme"):
-        conds.append("p.NomPicto = @pictogramme")
-        params.append(bigquery.ScalarQueryParameter("pictogramme", "STRING", f["pictogramme"]))
 
     if f["search"]:
-        search = f["search"].replace("'", "")
+        # Mêmes règles que l'index de recherche (libellé Z-AAA-DDDD-NN et types)
         conds.append(
-            f"(CAST(e.Zone AS STRING) LIKE '%{search}%' OR "
-            f"CAST(e.Allee AS STRING) LIKE '%{search}%' OR "
-            f"CAST(e.Deplacement AS STRING) LIKE '%{search}%' OR "
-            f"CAST(e.Niveau AS STRING) LIKE '%{search}%')"
+            "(LOWER(CONCAT(e.Zone, '-', LPAD(CAST(e.Allee AS STRING), 3, '0'), '-', "
+            "LPAD(CAST(e.Deplacement AS STRING), 4, '0'), '-', LPAD(CAST(e.Niveau AS STRING), 2, '0'))) "
+            "LIKE CONCAT('%', LOWER(@search), '%') OR "
+            "LOWER(e.Type1) LIKE CONCAT('%', LOWER(@search), '%') OR "
+            "LOWER(e.Type2) LIKE CONCAT('%', LOWER(@search), '%') OR "
+            "LOWER(e.Type3) LIKE CONCAT('%', LOWER(@search), '%'))"
         )
+        params.append(bigquery.ScalarQueryParameter("search", "STRING", f["search"].strip()))
 
     return conds, params
 
 
+# ============================================================
+# 🧭 PAGINATION PAR CLÉ (seek) + CURSEURS OPAQUES
+# ============================================================
+# Lecture BigQuery de la grille quand l'instantané en mémoire est indisponible.
+# Les pages se suivent par "clé > dernière clé de la page précédente" au lieu de
+# LIMIT/OFFSET : BigQuery ne trie plus tout ce qui précède la page demandée.
+# Les clés de début de page déjà vues sont gardées par signature de filtres ;
+# un saut direct (page 1 -> page 800) repart de la borne connue la plus proche.
+# Les comptages (total / filtré) sont gardés avec les bornes : parcourir une vue
+# filtrée coûte une requête par page.
+# Chaque entrée porte la version de TblEmplacement (date de modification BigQuery
+# + compteur local, cf. http_cache.table_version) : un import ou une édition faits
+# par une autre instance l'invalident au plus REF_CHECK_S secondes plus tard.
+# Version illisible : pas de cache, bornes et comptages recalculés.
+
+PAGE_KEY = ("Zone", "Allee", "Deplacement", "Niveau")
+PAGE_KEY_PARAMS = ("k_zone", "k_allee", "k_dep", "k_niv")
+PAGE_CACHE_TTL_S = 600        # bornes conservées 10 min au plus (vidées dès que la version change)
+PAGE_CACHE_MAX = 50           # nombre de signatures de filtres conservées
+PAGE_SCAN_MIN_GAP = 20        # saut de plus de 20 pages sans borne proche : calcul de toutes les bornes
+CASE_INSENSITIVE_FILTERS = ("zone", "type1", "type2", "type3")
+
+_page_lock = threading.Lock()
+_page_bounds = OrderedDict()  # signature -> {"maj": t, "version": v, "bornes": {start: clé de la ligne start - 1}, "comptes": (total, filtré)}
+
+
+def _filter_signature(f):
+    """Signature stable des filtres (casse ignorée là où le WHERE l'ignore)."""
+    norm = {
+        k: str(v or "").strip().lower() if k in CASE_INSENSITIVE_FILTERS else str(v or "").strip()
+        for k, v in f.items()
+    }
+    return hashlib.sha1(json.dumps(norm, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _row_key(row):
+    """Clé composite d'une ligne (None si incomplète : pas de seek possible)."""
+    key = [row.get(c) for c in PAGE_KEY]
+    return None if any(v is None for v in key) else key
+
+
+def _param_type(value):
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    return "STRING"
+
+
+def encode_cursor(signature, start, key):
+    """Curseur opaque renvoyé à DataTables : filtres, position et clé de reprise."""
+    raw = json.dumps([signature, start, key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token, signature, start):
+    """Clé de reprise du curseur, ou None s'il ne correspond pas (autres filtres / position)."""
+    if not token:
+        return None
+    try:
+        sig, pos, key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        return None
+    if sig != signature or pos != start or not isinstance(key, list) or len(key) != len(PAGE_KEY):
+        return None
+    if not all(isinstance(v, (str, int, float)) for v in key):
+        return None
+    return key
+
+
+def _seek_condition(key):
+    """(Zone, Allee, Deplacement, Niveau) > clé, développé (pas de comparaison de tuples en BigQuery)."""
+    cond = None
+    for col, name in reversed(list(zip(PAGE_KEY, PAGE_KEY_PARAMS))):
+        gt = f"e.{col} > @{name}"
+        cond = gt if cond is None else f"({gt} OR (e.{col} = @{name} AND {cond}))"
+    params = [bigquery.ScalarQueryParameter(n, _param_type(v), v) for n, v in zip(PAGE_KEY_PARAMS, key)]
+    return cond, params
+
+
+def _page_version():
+    """Version courante de TblEmplacement (None si illisible : cache ignoré)."""
+    try:
+        return table_version("TblEmplacement")
+    except Exception as e:
+        print(f"⚠️ Version de TblEmplacement indisponible, bornes de pages non gardées : {e}")
+        return None
+
+
+def _page_entry(signature, version, create=False):
+    """Entrée du cache pour une signature et une version de table (à appeler sous _page_lock)."""
+    if version is None:
+        return None
+    entry = _page_bounds.get(signature)
+    if entry is not None and (entry["version"] != version
+                              or time.monotonic() - entry["maj"] > PAGE_CACHE_TTL_S):
+        del _page_bounds[signature]
+        entry = None
+    if entry is None and create:
+        entry = _page_bounds[signature] = {"maj": time.monotonic(), "version": version,
+                                           "bornes": {}, "comptes": None}
+        while len(_page_bounds) > PAGE_CACHE_MAX:
+            _page_bounds.popitem(last=False)
+    if entry is not None:
+        _page_bounds.move_to_end(signature)
+    return entry
+
+
+def _cached_bounds(signature, version):
+    with _page_lock:
+        entry = _page_entry(signature, version)
+        return dict(entry["bornes"]) if entry else {}
+
+
+def _remember_bounds(signature, version, bounds):
+    with _page_lock:
+        entry = _page_entry(signature, version, create=True)
+        if entry is not None:
+            entry["bornes"].update(bounds)
+
+
+def invalidate_page_cache():
+    """TblEmplacement modifiée : bornes de pages et comptages ne sont plus valables."""
+    with _page_lock:
+        _page_bounds.clear()
+
+
+@on_table_change
+def _on_table_change(table_name, keys=None):
+    if table_name == "TblEmplacement":
+        invalidate_page_cache()
+
+
+def _page_counts(client, table, conds, params, signature, version):
+    """
+    (total, filtré) pour une signature de filtres : un seul job (COUNTIF) au
+    premier affichage, puis lu dans le cache tant que la version de la table ne change pas.
+    """
+    with _page_lock:
+        entry = _page_entry(signature, version)
+        if entry and entry["comptes"] is not None:
+            return entry["comptes"]
+
+    filter_sql = " AND ".join(conds) if conds else "TRUE"
+    query = f"""
+SELECT COUNT(*) AS total, COUNTIF({filter_sql}) AS filtered
+FROM `{table}` AS e
+"""
+    row = list(client.query(query, job_config=_page_job_config(list(params))).result())[0]
+    counts = (row.total, row.filtered)
+    with _page_lock:
+        entry = _page_entry(signature, version, create=True)
+        if entry is not None:
+            entry["comptes"] = counts
+    return counts
+
+
+def _page_job_config(params):
+    job_cfg = bigquery.QueryJobConfig(query_parameters=params)
+    job_cfg.use_query_cache = True
+    job_cfg.maximum_bytes_billed = 10**9
+    return job_cfg
+
+
+def _scan_page_bounds(client, table, conds, params, signature, version, length):
+    """
+    Un seul tri des clés filtrées (4 colonnes) -> clé de fin de chaque page ;
+    les sauts suivants sur ces filtres deviennent des seeks.
+    """
+    where_sql = " WHERE " + " AND ".join(conds) if conds else ""
+    key_cols = ", ".join(f"e.{c}" for c in PAGE_KEY)
+    out_cols = ", ".join(PAGE_KEY)
+    query = f"""
+SELECT {out_cols}, rn
+FROM (
+  SELECT {key_cols}, ROW_NUMBER() OVER (ORDER BY {key_cols}) AS rn
+  FROM `{table}` AS e
+  {where_sql}
+)
+WHERE MOD(rn, @page_length) = 0
+"""
+    job_cfg = _page_job_config(params + [bigquery.ScalarQueryParameter("page_length", "INT64", length)])
+    bounds = {}
+    for r in client.query(query, job_config=job_cfg).result():
+        row = dict(r)
+        key = _row_key(row)
+        if key is not None:
+            bounds[row["rn"]] = key
+    print(f"🧭 Bornes de pages calculées : {len(bounds)} (signature {signature})")
+    _remember_bounds(signature, version, bounds)
+    return {**_cached_bounds(signature, version), **bounds}
+
+
+def _resolve_page(client, table, conds, params, signature, version, start, length, cursor):
+    """
+    Point de départ d'une page : (clé de reprise ou None, lignes à sauter après cette clé).
+    Curseur valide ou borne connue -> seek direct ; sinon saut depuis la borne la plus proche.
+    """
+    key = decode_cursor(cursor, signature, start)
+    if key is not None or start == 0:
+        return key, 0
+
+    bounds = _cached_bounds(signature, version)
+    if start in bounds:
+        return bounds[start], 0
+    known = max((b for b in bounds if b <= start), default=0)
+    if start - known > PAGE_SCAN_MIN_GAP * length:
+        bounds = _scan_page_bounds(client, table, conds, params, signature, version, length)
+        known = max((b for b in bounds if b <= start), default=0)
+    return bounds.get(known), start - known
+
+
+# ============================================================
+# 🗂️ LECTURES SERVIES PAR L'INSTANTANÉ EN MÉMOIRE (cf. emplacement_snapshot.py)
+# ============================================================
+GRID_RENAMES = {"Profondeur": "longueur", "Largeur": "largeur", "Hauteur": "hauteur"}
+GRID_COLUMNS = [
+    "Zone", "Allee", "Deplacement", "Niveau", "longueur", "largeur", "hauteur",
+    "PoidsLimiteTotal", "PoidsLimiteUnitaire", "X", "Y", "Z", "Type1", "Type2", "Type3", "Palette",
+]
+
+
+def _snapshot_page(f, start, length):
+    """Page de la grille servie localement (None : instantané indisponible -> BigQuery)."""
+    try:
+        frame, version, index = emplacement_snapshot.get_indexed()
+    except Exception as e:
+        print(f"⚠️ Instantané indisponible, lecture BigQuery : {e}")
+        return None
+    filtered = filter_frame(_overlay_pending(frame), f, index)
+    page = filtered.iloc[start:start + length].rename(columns=GRID_RENAMES)[GRID_COLUMNS]
+    return {
+        "recordsTotal": len(frame),
+        "recordsFiltered": len(filtered),
+        "data": frame_records(page),
+        "version": version,
+    }
+
+
+def _bq_range_frame(zone, allee, dep_from, dep_to, niv_from, niv_to):
+    """Emplacements d'une plage lus dans BigQuery (repli sans instantané)."""
+    query = f"""
+        SELECT 
+          Zone,
+          CAST(Allee AS INT64) AS Allee,
+          CAST(Deplacement AS INT64) AS Deplacement,
+          CAST(Niveau AS INT64) AS Niveau,
+          SAFE_CAST(Profondeur AS FLOAT64) AS Profondeur,
+          SAFE_CAST(Largeur AS FLOAT64) AS Largeur,
+          SAFE_CAST(Hauteur AS FLOAT64) AS Hauteur
+        FROM `{TABLE_ID}`
+        WHERE UPPER(TRIM(Zone)) = @zone
+          AND CAST(Allee AS INT64) = @allee
+          AND CAST(Deplacement AS INT64) BETWEEN @dep_from AND @dep_to
+          AND CAST(Niveau AS INT64) BETWEEN @niv_from AND @niv_to
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("zone", "STRING", str(zone).strip().upper()),
+        bigquery.ScalarQueryParameter("allee", "INT64", int(allee)),
+        bigquery.ScalarQueryParameter("dep_from", "INT64", int(dep_from)),
+        bigquery.ScalarQueryParameter("dep_to", "INT64", int(dep_to)),
+        bigquery.ScalarQueryParameter("niv_from", "INT64", int(niv_from)),
+        bigquery.ScalarQueryParameter("niv_to", "INT64", int(niv_to)),
+    ])
+    return get_bq_client().query(query, job_config=job_config).to_arrow().to_pandas()
+
+
+def _range_window(zone, allee, dep_from, dep_to, niv_from, niv_to):
+    """
+    Plage Déplacement × Niveau d'une allée : tranche de la grille dense (cf. location_grid.py).
+    Allée hors grille : filtre de l'instantané ; instantané indisponible : BigQuery.
+    """
+    bounds = (int(dep_from), int(dep_to), int(niv_from), int(niv_to))
+    try:
+        grid, _ = emplacement_snapshot.get_grid()
+        window = grid.window(zone, allee, *bounds)
+        if window is not None:
+            return window
+        frame, _ = emplacement_snapshot.get()
+        rows = filter_frame(frame, {
+            "zone": zone, "allee": allee,
+            "deplacement_from": dep_from, "deplacement_to": dep_to,
+            "niveau_from": niv_from, "niveau_to": niv_to,
+        })
+    except Exception as e:
+        print(f"⚠️ Instantané indisponible, lecture BigQuery : {e}")
+        rows = _bq_range_frame(zone, allee, *bounds)
+    return AisleGrid(zone, allee, rows).window(*bounds)
+
+
+def _changed_keys(rows):
+    return [(r.get("Zone"), r.get("Allee"), r.get("Deplacement"), r.get("Niveau")) for r in rows]
+
+
+# ============================================================
+# 🔎 API : RECHERCHE D'EMPLACEMENTS (libellé / type, préfixe ou sous-chaîne)
+# ============================================================
+SEARCH_MAX_RESULTS = 50
+
+
+@bp_detail_emplacement.route("/api/detail_emplacement/search", methods=["GET"])
+def api_detail_emplacement_search():
+    """?q=A-012&prefix=1 -> libellés correspondants (au plus SEARCH_MAX_RESULTS) et nombre total."""
+    try:
+        term = request.args.get("q", "")
+        prefix = request.args.get("prefix") in ("1", "true")
+        frame, version, index = emplacement_snapshot.get_indexed()
+        t0 = time.perf_counter()
+        ids = index.lookup(term, prefix=prefix)
+        matches = frame[np.isin(frame[ID_COL].to_numpy(), ids)]
+        labels = matches[LABEL_COL].head(SEARCH_MAX_RESULTS).tolist()
+        return jsonify({
+            "total": len(matches),
+            "labels": labels,
+            "version": version,
+            "ms": round((time.perf_counter() - t0) * 1000, 1),
+        })
+    except Exception as e:
+        return jsonify({"error": f"Erreur lors de la recherche : {e}"}), 500
+
+
 # ============================================================
 # 🧭 PAGE PRINCIPALE
 # ============================================================
@@ -107,12 +446,11 @@ def page_detail_emplacement():
 # ============================================================
 @bp_detail_emplacement.route("/detail_emplacement/data", methods=["GET"])
 def data_detail_emplacement():
-    client = bigquery.Client()
+    client = get_bq_client()
 
     PROJECT_ID = "slottix"
     DATASET_ID = "entrepot_optimisation"
     TABLE_EMPLA = f"{PROJECT_ID}.{DATASET_ID}.TblEmplacement"
-    TABLE_PICTO = f"{PROJECT_ID}.{DATASET_ID}.TblPictogramme"
 
     try:
         f = _filters_from_args(request.args)
@@ -122,16 +460,32 @@ def data_detail_emplacement():
         length = int(request.args.get("length", 50))
         draw = int(request.args.get("draw", 1))
 
+        # --- Instantané en mémoire : filtres, tri et pagination locaux ---
+        # (BigQuery et pagination par clé ci-dessous : instantané indisponible)
+        page = _snapshot_page(f, start, length)
+        if page is not None:
+            return jsonify(dict(page, draw=draw))
+
         # --- Tri automatique hiérarchique ---
         # (Zone, Allée, Déplacement, Niveau) → ordre logique d’affichage
         order_col_idx = request.args.get("order[0][column]")
         order_dir = request.args.get("order[0][dir]", "asc")
 
-        # Toujours forcer l’ordre de tri global
+        # Toujours forcer l’ordre de tri global (c'est aussi la clé de pagination)
         order_clause = "ORDER BY e.Zone ASC, e.Allee ASC, e.Deplacement ASC, e.Niveau ASC"
 
+        # --- Point de départ : curseur, borne connue, ou saut depuis la borne la plus proche ---
+        signature = _filter_signature(f)
+        version = _page_version()
+        seek_key, skip = _resolve_page(client, TABLE_EMPLA, conds, params, signature, version,
+                                       start, length, request.args.get("cursor", ""))
+        page_conds, page_params = list(conds), list(params)
+        if seek_key is not None:
+            seek_sql, seek_params = _seek_condition(seek_key)
+            page_conds.append(seek_sql)
+            page_params += seek_params
 
-        where_sql = " WHERE " + " AND ".join(conds) if conds else ""
+        where_sql = " WHERE " + " AND ".join(page_conds) if page_conds else ""
 
         query = f"""
 SELECT 
@@ -144,33 +498,42 @@ SELECT
 FROM `{TABLE_EMPLA}` AS e
 {where_sql}
 {order_clause}
-LIMIT @length OFFSET @start
+LIMIT @length OFFSET @skip
 """
 
-        params += [
+        page_params += [
             bigquery.ScalarQueryParameter("length", "INT64", length),
-            bigquery.ScalarQueryParameter("start", "INT64", start)
+            bigquery.ScalarQueryParameter("skip", "INT64", skip)
         ]
 
-        job_cfg = bigquery.QueryJobConfig(query_parameters=params)
-        job_cfg.use_query_cache = True
-        job_cfg.maximum_bytes_billed = 10**9
+        job_cfg = _page_job_config(page_params)
 
         print("🔍 SQL exécuté:")
         print(query)
-        print("🔸 Params:", [(p.name, getattr(p, "_value", None)) for p in params])
+        print("🔸 Params:", [(p.name, getattr(p, "_value", None)) for p in page_params])
 
         rows_iter = client.query(query, job_config=job_cfg).result()
-        rows = [dict(r) for r in rows_iter]
+        rows = _overlay_rows([dict(r) for r in rows_iter])
+
+        # --- Bornes : début de cette page et de la suivante (curseur renvoyé à DataTables) ---
+        bounds = {start: seek_key} if seek_key is not None else {}
+        next_cursor = None
+        last_key = _row_key(rows[-1]) if len(rows) == length else None
+        if last_key is not None:
+            bounds[start + length] = last_key
+            next_cursor = encode_cursor(signature, start + length, last_key)
+        if bounds:
+            _remember_bounds(signature, version, bounds)
 
-        total_query = f"SELECT COUNT(*) AS total FROM `{TABLE_EMPLA}`"
-        total = list(client.query(total_query))[0].total
+        total, filtered = _page_counts(client, TABLE_EMPLA, conds, params, signature, version)
 
         return jsonify({
             "draw": draw,
             "recordsTotal": total,
-            "recordsFiltered": total,
-            "data": rows
+            "recordsFiltered": filtered,
+            "data": rows,
+            "next_start": start + length,
+            "next_cursor": next_cursor
         })
 
     except Exception as e:
@@ -180,14 +543,44 @@ LIMIT @length OFFSET @start
         return jsonify({"error": str(e)}), 500
 
 
+# ============================================================
+# 🧊 EXPORT FILTRÉ DE LA GRILLE (toutes les pages, cf. exports.py)
+# ============================================================
+@bp_detail_emplacement.route("/detail_emplacement/export/<format>", methods=["GET"])
+def export_detail_emplacement(format):
+    """Export des emplacements répondant aux filtres de la grille : csv, excel, parquet ou arrow."""
+    if format not in EXPORT_FORMATS:
+        return "Format non supporté", 400
+    try:
+        f = _filters_from_args(request.args)
+        f["search"] = request.args.get("search", f["search"])
+        conds, params = _build_where_and_params(f)
+        where_sql = " WHERE " + " AND ".join(conds) if conds else ""
+        # Saisies en attente écrites d'abord : l'export reflète la grille
+        edit_buffer.flush()
+        query = f"""
+SELECT e.*
+FROM `{TABLE_ID}` AS e
+{where_sql}
+ORDER BY e.Zone, e.Allee, e.Deplacement, e.Niveau
+"""
+        schema, batches = query_batches(query, bigquery.QueryJobConfig(query_parameters=params))
+        return export_response(schema, batches, format, "emplacements_filtres")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"Erreur export : {e}"}), 500
+
+
 # ============================================================
 # 🧩 API : LISTES (Type1 / Type2 / Type3 uniquement)
 # ============================================================
 @bp_detail_emplacement.route("/api/detail_emplacement/lists", methods=["GET"])
+@versioned_json("TblTypeEmpla123")
 def api_detail_emplacement_lists():
     """Renvoie les listes hiérarchiques Type1 / Type2 / Type3."""
     try:
-        client = bigquery.Client()
+        client = get_bq_client()
         PROJECT_ID = "slottix"
         DATASET_ID = "entrepot_optimisation"
 
@@ -226,13 +619,6 @@ def page_detail_emplacement_modif_masse():
 @bp_detail_emplacement.route("/api/detail_emplacement/dimensions", methods=["POST"])
 def api_detail_emplacement_dimensions():
     """Retourne les dimensions (profondeur, largeur, hauteur) des emplacements sélectionnés."""
-    from google.cloud import bigquery
-    client = bigquery.Client()
-
-    PROJECT_ID = "slottix"
-    DATASET_ID = "entrepot_optimisation"
-    TABLE = f"{PROJECT_ID}.{DATASET_ID}.TblEmplacement"
-
     data = request.get_json(force=True)
     zone = (data.get("zone") or "").strip().upper()
     allee = data.get("allee")
@@ -245,57 +631,217 @@ def api_detail_emplacement_dimensions():
     if any(v is None or v == "" for v in [zone, allee, dep_from, dep_to, niv_from, niv_to]):
         return jsonify({"error": "Paramètres manquants"}), 400
 
-    query = f"""
-        SELECT 
-          Zone,
-          CAST(Allee AS INT64) AS Allee,
-          CAST(Deplacement AS INT64) AS Deplacement,
-          CAST(Niveau AS INT64) AS Niveau,
-          SAFE_CAST(Profondeur AS FLOAT64) / 100.0 AS profondeur,
-          SAFE_CAST(Largeur AS FLOAT64) / 100.0 AS largeur,
-          SAFE_CAST(Hauteur AS FLOAT64) / 100.0 AS hauteur
-        FROM `{TABLE}`
-        WHERE UPPER(TRIM(Zone)) = @zone
-          AND CAST(Allee AS INT64) = @allee
-          AND CAST(Deplacement AS INT64) BETWEEN @dep_from AND @dep_to
-          AND CAST(Niveau AS INT64) BETWEEN @niv_from AND @niv_to
-        ORDER BY CAST(Deplacement AS INT64), CAST(Niveau AS INT64)
+    try:
+        dims = _range_window(zone, allee, dep_from, dep_to, niv_from, niv_to).dimensions()
+    except Exception as e:
+        return jsonify({"error": f"Erreur BigQuery : {e}"}), 500
+
+    if not dims:
+        return jsonify({"error": "Aucune donnée trouvée pour cette sélection."}), 400
+
+    return jsonify({"dimensions": dims})
+
+
+# ============================================================
+# 🧮 API : Aperçu des coordonnées calculées (modification en masse)
+# ============================================================
+@bp_detail_emplacement.route("/api/detail_emplacement/preview_coords", methods=["POST"])
+def api_detail_emplacement_preview_coords():
+    """
+    Aperçu X/Y/Z et dimensions d'une plage, calculé sur la tranche de la grille dense.
+    Mêmes paramètres que /dimensions + pair_impair, x_ref, y_ref, z_ref,
+    espacement, hauteur_lisse, orientation (coordonnées facultatives).
     """
+    data = request.get_json(force=True)
+    zone = (data.get("zone") or "").strip().upper()
+    bounds = [data.get(k) for k in ("dep_from", "dep_to", "niv_from", "niv_to")]
+    allee = data.get("allee")
+    if any(v is None or v == "" for v in [zone, allee] + bounds):
+        return jsonify({"error": "Paramètres manquants"}), 400
 
-    job_config = bigquery.QueryJobConfig(query_parameters=[
-        bigquery.ScalarQueryParameter("zone", "STRING", zone),
-        bigquery.ScalarQueryParameter("allee", "INT64", int(allee)),
-        bigquery.ScalarQueryParameter("dep_from", "INT64", int(dep_from)),
-        bigquery.ScalarQueryParameter("dep_to", "INT64", int(dep_to)),
-        bigquery.ScalarQueryParameter("niv_from", "INT64", int(niv_from)),
-        bigquery.ScalarQueryParameter("niv_to", "INT64", int(niv_to)),
-    ])
+    refs = [parse_number(data.get(k)) for k in ("x_ref", "y_ref", "z_ref")]
+    has_xyz = any(r is not None for r in refs)
+    espacement = parse_number(data.get("espacement"))
+    hauteur_lisse = parse_number(data.get("hauteur_lisse"))
+    orientation = data.get("orientation") or "X"
+    if has_xyz and (None in refs or espacement is None or hauteur_lisse is None):
+        return jsonify({"error": "X, Y, Z réf, espacement et hauteur des lisses sont obligatoires ensemble."}), 400
 
     try:
-        rows = list(client.query(query, job_config=job_config).result())
+        window = _range_window(zone, allee, *bounds)
     except Exception as e:
         return jsonify({"error": f"Erreur BigQuery : {e}"}), 500
 
+    rows = preview_coordinates(
+        window, parity=data.get("pair_impair"),
+        x_ref=refs[0], y_ref=refs[1], z_ref=refs[2],
+        espacement=espacement or 0.0, hauteur_lisse=hauteur_lisse or 0.0,
+        orientation=orientation, niv_from=int(bounds[2]),
+    )
     if not rows:
         return jsonify({"error": "Aucune donnée trouvée pour cette sélection."}), 400
+    return jsonify({"apercu": rows, "xyz": has_xyz})
 
-    dims = [
-        {
-            "Zone": r.Zone,
-            "Allee": r.Allee,
-            "Deplacement": r.Deplacement,
-            "Niveau": r.Niveau,
-            "profondeur": r.profondeur,
-            "largeur": r.largeur,
-            "hauteur": r.hauteur,
-        }
-        for r in rows
-    ]
 
-    return jsonify({"dimensions": dims})
+# ============================================================
+# 🧰 APPLICATION DES MODIFICATIONS (SQL en ligne ou table de transit)
+# ============================================================
+# Jusqu'à BULK_UPDATE_MIN_ROWS lignes : UPDATE ... FROM UNNEST([STRUCT(...), ...]).
+# Au-delà (zone entière...), le texte SQL dépasserait les limites de BigQuery :
+# les modifications sont chargées dans une table temporaire puis appliquées
+# par un seul MERGE (cf. sync_engine.bulk_update_from_frame).
+
+BULK_UPDATE_MIN_ROWS = 500
+CHANGE_FIELDS = [
+    ("Zone", "STRING"), ("Allee", "INT64"), ("Deplacement", "INT64"), ("Niveau", "INT64"),
+    ("X", "FLOAT64"), ("Y", "FLOAT64"), ("Z", "FLOAT64"), ("PoidsLimiteUnitaire", "FLOAT64"),
+    ("Type1", "STRING"), ("Type2", "STRING"), ("Type3", "STRING"), ("Palette", "BOOL"),
+]
+CHANGE_MATCH_SQL = (
+    "LOWER(TRIM(T.Zone)) = LOWER(TRIM(N.Zone)) AND T.Allee = N.Allee "
+    "AND T.Deplacement = N.Deplacement AND T.Niveau = N.Niveau"
+)
+# Champs vides -> on n'écrase pas : COALESCE(N.val, T.val)
+UPDATE_SET_ITEMS = [
+    (col, f"COALESCE(N.{col}, T.{col})")
+    for col in ("X", "Y", "Z", "PoidsLimiteUnitaire", "Type1", "Type2", "Type3", "Palette")
+]
+
+
+def _sql_literal(value, field_type):
+    """Littéral SQL typé (NULL casté) pour les STRUCT en ligne et les SET constants."""
+    if value is None:
+        return f"CAST(NULL AS {field_type})"
+    if field_type == "STRING":
+        return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+    if field_type == "BOOL":
+        return "TRUE" if value else "FALSE"
+    if field_type == "FLOAT64":
+        return repr(float(value))
+    return str(int(value))
+
+
+def _last_per_key(records):
+    """Une modification par emplacement (la dernière) : UPDATE / MERGE refusent les doublons."""
+    out = {}
+    for r in records:
+        out[(r["Zone"].lower(), r["Allee"], r["Deplacement"], r["Niveau"])] = r
+    return list(out.values())
+
+
+def _apply_changes(client, table, records, fields, set_items):
+    """
+    records : une modification (dict) par emplacement ; fields : [(colonne, type)] ;
+    set_items : [(colonne, expression)], alias T (table) et N (modification).
+    Retourne le nombre de lignes modifiées.
+    """
+    set_sql = ", ".join(f"{col} = {expr}" for col, expr in set_items)
+
+    if len(records) >= BULK_UPDATE_MIN_ROWS:
+        project, dataset, _ = table.split(".")
+        schema = [bigquery.SchemaField(name, ftype) for name, ftype in fields]
+        frame = pd.DataFrame(records, columns=[name for name, _ in fields])
+        print(f"🧰 Mise à jour en masse via table de transit : {len(records)} emplacements")
+        return bulk_update_from_frame(
+            client, frame, schema, table,
+            temp_table_id(project, dataset, "TblEmplacementModif", uuid.uuid4().hex),
+            CHANGE_MATCH_SQL, set_sql,
+        )
 
+    structs = ",\n          ".join(
+        "STRUCT(" + ", ".join(f"{_sql_literal(r.get(name), ftype)} AS {name}" for name, ftype in fields) + ")"
+        for r in records
+    )
+    target_set = ", ".join(f"T.{col} = {expr}" for col, expr in set_items)
+    q = f"""
+        UPDATE `{table}` AS T
+        SET {target_set}
+        FROM UNNEST([
+          {structs}
+        ]) AS N
+        WHERE {CHANGE_MATCH_SQL}
+        """
+    print("🧾 UPDATE envoyé à BigQuery:")
+    print(q)
+    job = client.query(q)
+    job.result()
+    return job.num_dml_affected_rows or 0
+
+
+# ============================================================
+# ✍️ ÉCRITURE DIFFÉRÉE DES SAISIES DE LA GRILLE (cf. edit_buffer.py)
+# ============================================================
+# Chaque worker a sa file : les autres workers voient les saisies une fois écrites
+# (au plus EDIT_FLUSH_INTERVAL_S secondes plus tard). Les écritures directes dans
+# TblEmplacement (mise à jour en masse, imports) appellent edit_buffer.settle()
+# avant d'écrire : une saisie plus ancienne ne peut plus les écraser ensuite.
+OVERLAY_COLUMNS = [name for name, _ in CHANGE_FIELDS if name not in ("Zone", "Allee", "Deplacement", "Niveau")]
 
 
+def _edit_key(rec):
+    return key_label(rec["Zone"], rec["Allee"], rec["Deplacement"], rec["Niveau"])
+
+
+def _edit_keys(records):
+    """Clés des modifications (clés incomplètes ignorées : aucune saisie en attente ne les porte)."""
+    keys = set()
+    for rec in records:
+        try:
+            keys.add(_edit_key(rec))
+        except (TypeError, ValueError):
+            continue
+    return keys
+
+
+def _flush_edits(records):
+    """Un lot de saisies -> un seul ordre DML, puis rafraîchissement des clés touchées."""
+    _apply_changes(get_bq_client(), TABLE_ID, records, CHANGE_FIELDS, UPDATE_SET_ITEMS)
+    table_changed("TblEmplacement", keys=_changed_keys(records))
+
+
+edit_buffer = EditBuffer(_flush_edits, _edit_key).flush_at_exit()
+
+
+def _overlay_pending(frame):
+    """Instantané + saisies pas encore écrites (copie seulement s'il y en a sur ces lignes)."""
+    pending = edit_buffer.pending()
+    if not pending:
+        return frame
+    rows = frame.index[frame[KEY_COL].isin(list(pending)).to_numpy()]
+    if not len(rows):
+        return frame
+    frame = frame.copy()
+    keys = frame.loc[rows, KEY_COL].tolist()
+    for col in OVERLAY_COLUMNS:
+        values = [pending[k].get(col) for k in keys]
+        hit = [i for i, v in enumerate(values) if v is not None]
+        if not hit:
+            continue
+        if isinstance(frame[col].dtype, pd.CategoricalDtype):
+            frame[col] = frame[col].astype(object)
+        frame.loc[rows[hit], col] = [values[i] for i in hit]
+    return frame
+
+
+def _overlay_rows(rows):
+    """Même superposition pour des lignes lues dans BigQuery (repli sans instantané)."""
+    pending = edit_buffer.pending()
+    if not pending:
+        return rows
+    for row in rows:
+        try:
+            rec = pending.get(_edit_key(row))
+        except (TypeError, ValueError):
+            continue
+        if rec:
+            row.update({col: rec[col] for col in OVERLAY_COLUMNS if rec.get(col) is not None})
+    return rows
+
+
+@bp_detail_emplacement.route("/api/detail_emplacement/flush_status", methods=["GET"])
+def api_detail_emplacement_flush_status():
+    """Saisies en attente d'écriture et retard de la plus ancienne (secondes)."""
+    return jsonify(edit_buffer.status())
 
 
 # ============================================================
@@ -312,24 +858,12 @@ def api_update_coords():
     ⚡ Seuls les champs saisis sont mis à jour.
     """
     from google.cloud import bigquery
-    client = bigquery.Client()
+    client = get_bq_client()
 
     PROJECT_ID = "slottix"
     DATASET_ID = "entrepot_optimisation"
     TABLE = f"{PROJECT_ID}.{DATASET_ID}.TblEmplacement"
 
-    def to_float_or_null(v):
-        """Convertit un nombre avec virgule éventuelle, sinon None"""
-        if v is None:
-            return None
-        s = str(v).strip().replace(",", ".")
-        if s == "":
-            return None
-        try:
-            return float(s)
-        except Exception:
-            return None
-
     def to_int(v):
         try:
             return int(v)
@@ -348,7 +882,7 @@ def api_update_coords():
         type1 = to_str_or_null(data.get("type1"))
         type2 = to_str_or_null(data.get("type2"))
         type3 = to_str_or_null(data.get("type3"))
-        poids_limite_unitaire = to_float_or_null(data.get("poids_limite_unitaire"))
+        poids_limite_unitaire = parse_number(data.get("poids_limite_unitaire"))
         palette_val = data.get("palette")
 
         if not coords:
@@ -360,72 +894,51 @@ def api_update_coords():
         else:
             palette_sql = "TRUE" if str(palette_val).lower() in ("1", "true", "yes", "on") else "FALSE"
 
-        struct_rows = []
-        for c in coords:
-            zone = str(c.get("Zone", "")).strip().replace("'", "''")
-            allee = to_int(c.get("Allee"))
-            dep = to_int(c.get("Deplacement"))
-            niv = to_int(c.get("Niveau"))
-
-            x = to_float_or_null(c.get("X"))
-            y = to_float_or_null(c.get("Y"))
-            z = to_float_or_null(c.get("Z"))
-
-            def num_sql(v):
-                return str(v) if v is not None else "CAST(NULL AS FLOAT64)"
-
-            struct_rows.append(
-                f"STRUCT('{zone}' AS Zone, {allee} AS Allee, {dep} AS Deplacement, {niv} AS Niveau, "
-                f"{num_sql(x)} AS X, {num_sql(y)} AS Y, {num_sql(z)} AS Z)"
-            )
-
-        structs_clause = ",\n          ".join(struct_rows)
+        # Nombres (virgules FR acceptées) convertis colonne par colonne, comme à l'import
+        xs = parse_number_list(c.get("X") for c in coords)
+        ys = parse_number_list(c.get("Y") for c in coords)
+        zs = parse_number_list(c.get("Z") for c in coords)
+
+        records = [
+            {
+                "Zone": str(c.get("Zone", "")).strip(),
+                "Allee": to_int(c.get("Allee")),
+                "Deplacement": to_int(c.get("Deplacement")),
+                "Niveau": to_int(c.get("Niveau")),
+                "X": x, "Y": y, "Z": z,
+            }
+            for c, x, y, z in zip(coords, xs, ys, zs)
+        ]
 
         # Construction dynamique du SET (on ne met à jour que ce qui est saisi)
-        set_parts = []
+        set_items = []
 
         has_xyz = any(c.get("X") not in (None, "") for c in coords)
         if has_xyz:
-            set_parts += ["T.X = COALESCE(N.X, T.X)",
-                          "T.Y = COALESCE(N.Y, T.Y)",
-                          "T.Z = COALESCE(N.Z, T.Z)"]
+            set_items += [("X", "COALESCE(N.X, T.X)"),
+                          ("Y", "COALESCE(N.Y, T.Y)"),
+                          ("Z", "COALESCE(N.Z, T.Z)")]
 
         if poids_limite_unitaire is not None:
-            set_parts.append(f"T.PoidsLimiteUnitaire = {poids_limite_unitaire}")
+            set_items.append(("PoidsLimiteUnitaire", _sql_literal(poids_limite_unitaire, "FLOAT64")))
 
         if type1:
-            set_parts.append(f"T.Type1 = '{type1.replace("'", "''")}'")
+            set_items.append(("Type1", _sql_literal(type1, "STRING")))
         if type2:
-            set_parts.append(f"T.Type2 = '{type2.replace("'", "''")}'")
+            set_items.append(("Type2", _sql_literal(type2, "STRING")))
         if type3:
-            set_parts.append(f"T.Type3 = '{type3.replace("'", "''")}'")
+            set_items.append(("Type3", _sql_literal(type3, "STRING")))
         if palette_val is not None:
-            set_parts.append(f"T.Palette = {palette_sql}")
+            set_items.append(("Palette", palette_sql))
 
-        if not set_parts:
+        if not set_items:
             return jsonify({"status": "error", "message": "Aucun champ à mettre à jour."}), 400
 
-        set_clause = ",\n          ".join(set_parts)
-
-        q = f"""
-        UPDATE `{TABLE}` AS T
-        SET 
-          {set_clause}
-        FROM UNNEST([
-          {structs_clause}
-        ]) AS N
-        WHERE 
-          LOWER(TRIM(T.Zone)) = LOWER(TRIM(N.Zone))
-          AND T.Allee = N.Allee
-          AND T.Deplacement = N.Deplacement
-          AND T.Niveau = N.Niveau
-        """
-
-        print("🧾 SQL UPDATE (modif masse):")
-        print(q)
-
-        job = client.query(q)
-        job.result()
+        fields = [f for f in CHANGE_FIELDS if f[0] in ("Zone", "Allee", "Deplacement", "Niveau", "X", "Y", "Z")]
+        # Saisies différées sur ces emplacements écrites d'abord : elles ne repasseront pas après cette mise à jour
+        edit_buffer.settle(_edit_keys(records))
+        _apply_changes(client, TABLE, _last_per_key(records), fields, set_items)
+        table_changed("TblEmplacement", keys=_changed_keys(coords))
 
         return jsonify({"status": "success", "message": f"✅ {len(coords)} emplacement(s) mis à jour avec succès."})
 
@@ -447,29 +960,10 @@ def api_update_detail_emplacement():
     - X, Y, Z, PoidsLimiteUnitaire (accepte virgules FR)
     - Type1 / Type2 / Type3
     - Palette (BOOL)
-    ⚡ Tout en une seule requête BigQuery.
+    ⚡ Écriture différée : acquitté tout de suite, fusionné par emplacement et
+       écrit par lots (cf. edit_buffer.py) ; la grille affiche déjà les valeurs saisies.
     🔒 Champs vides -> on n'écrase pas : COALESCE(N.val, T.val)
     """
-    from google.cloud import bigquery
-    client = bigquery.Client()
-
-    PROJECT_ID = "slottix"
-    DATASET_ID = "entrepot_optimisation"
-    TABLE = f"{PROJECT_ID}.{DATASET_ID}.TblEmplacement"
-
-    def to_float_or_null(v):
-        """'12,3' -> 12.3 ; ''/None/texte invalide -> None"""
-        if v is None:
-            return None
-        s = str(v).strip()
-        if s == "":
-            return None
-        s = s.replace(",", ".")
-        try:
-            return float(s)
-        except Exception:
-            return None
-
     def to_int(v, default=0):
         try:
             return int(v)
@@ -489,88 +983,37 @@ def api_update_detail_emplacement():
         if not changes:
             return jsonify({"status": "error", "message": "Aucune donnée reçue."}), 400
 
-        # Construire les STRUCT typés (avec NULL CASTés) pour UNNEST
-        struct_rows = []
-        for c in changes:
-            zone = str(c.get("Zone", "")).strip().replace("'", "''")
-            allee = to_int(c.get("Allee"))
-            dep   = to_int(c.get("Deplacement"))
-            niv   = to_int(c.get("Niveau"))
-
-            x  = to_float_or_null(c.get("X"))
-            y  = to_float_or_null(c.get("Y"))
-            z  = to_float_or_null(c.get("Z"))
-            pdu = to_float_or_null(c.get("PoidsLimiteUnitaire"))
+        # Modifications typées, une par emplacement
+        # Nombres ('12,3' -> 12.3 ; vide / invalide -> None) : même moteur que l'import
+        xs = parse_number_list(c.get("X") for c in changes)
+        ys = parse_number_list(c.get("Y") for c in changes)
+        zs = parse_number_list(c.get("Z") for c in changes)
+        pdus = parse_number_list(c.get("PoidsLimiteUnitaire") for c in changes)
 
-            t1 = to_str_or_null(c.get("Type1"))
-            t2 = to_str_or_null(c.get("Type2"))
-            t3 = to_str_or_null(c.get("Type3"))
-
-            # Palette : bool → TRUE/FALSE/NULL, typé explicitement en BOOL
+        records = []
+        for c, x, y, z, pdu in zip(changes, xs, ys, zs, pdus):
+            # Palette : bool -> TRUE/FALSE/NULL
             pal_val = c.get("Palette", None)
-            if pal_val is None:
-                pal_sql = "CAST(NULL AS BOOL)"
-            elif str(pal_val).lower() in ("1", "true", "yes", "on"):
-                pal_sql = "CAST(TRUE AS BOOL)"
-            else:
-                pal_sql = "CAST(FALSE AS BOOL)"
-
-
-            def num_sql(v):
-                return str(v) if v is not None else "CAST(NULL AS FLOAT64)"
-
-            def str_sql(v):
-                return "'" + v.replace("'", "''") + "'" if v is not None else "CAST(NULL AS STRING)"
-
-            struct_rows.append(
-                "STRUCT("
-                f"'{zone}' AS Zone, "
-                f"{allee} AS Allee, "
-                f"{dep} AS Deplacement, "
-                f"{niv} AS Niveau, "
-                f"{num_sql(x)} AS X, "
-                f"{num_sql(y)} AS Y, "
-                f"{num_sql(z)} AS Z, "
-                f"{num_sql(pdu)} AS PoidsLimiteUnitaire, "
-                f"{str_sql(t1)} AS Type1, "
-                f"{str_sql(t2)} AS Type2, "
-                f"{str_sql(t3)} AS Type3, "
-                f"{pal_sql} AS Palette)"
-            )
-
-        structs_clause = ",\n          ".join(struct_rows)
-
-        # Requête unique UPDATE ... FROM UNNEST([...]) avec COALESCE (ne pas écraser si NULL)
-        q = f"""
-        UPDATE `{TABLE}` AS T
-        SET 
-          T.X = COALESCE(N.X, T.X),
-          T.Y = COALESCE(N.Y, T.Y),
-          T.Z = COALESCE(N.Z, T.Z),
-          T.PoidsLimiteUnitaire = COALESCE(N.PoidsLimiteUnitaire, T.PoidsLimiteUnitaire),
-          T.Type1 = COALESCE(N.Type1, T.Type1),
-          T.Type2 = COALESCE(N.Type2, T.Type2),
-          T.Type3 = COALESCE(N.Type3, T.Type3),
-          T.Palette = COALESCE(CAST(N.Palette AS BOOL), T.Palette)
+            records.append({
+                "Zone": str(c.get("Zone", "")).strip(),
+                "Allee": to_int(c.get("Allee")),
+                "Deplacement": to_int(c.get("Deplacement")),
+                "Niveau": to_int(c.get("Niveau")),
+                "X": x, "Y": y, "Z": z, "PoidsLimiteUnitaire": pdu,
+                "Type1": to_str_or_null(c.get("Type1")),
+                "Type2": to_str_or_null(c.get("Type2")),
+                "Type3": to_str_or_null(c.get("Type3")),
+                "Palette": None if pal_val is None else str(pal_val).lower() in ("1", "true", "yes", "on"),
+            })
+
+        # File d'écriture : un seul UPDATE / MERGE pour toutes les saisies du cycle
+        en_attente = edit_buffer.add(records)
 
-        FROM UNNEST([
-          {structs_clause}
-        ]) AS N
-        WHERE 
-          LOWER(TRIM(T.Zone)) = LOWER(TRIM(N.Zone))
-          AND T.Allee = N.Allee
-          AND T.Deplacement = N.Deplacement
-          AND T.Niveau = N.Niveau
-        """
-
-        # Debug utile (visible dans ta console Flask)
-        print("🧾 UPDATE envoyé à BigQuery:")
-        print(q)
-
-        job = client.query(q)
-        job.result()  # on attend la fin
-
-        return jsonify({"status": "success", "message": f"✅ {len(changes)} emplacements mis à jour avec succès."})
+        return jsonify({
+            "status": "success",
+            "message": f"✅ {len(changes)} emplacements enregistrés (écriture BigQuery sous quelques secondes).",
+            "en_attente": en_attente,
+        })
 
     except Exception as e:
         import traceback
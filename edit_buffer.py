@@ -0,0 +1,531 @@
+import atexit
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+from db import get_pg_connection, release_pg_connection
+
+
+# ============================================================
+# ✍️ ÉCRITURE DIFFÉRÉE DES MODIFICATIONS (write-behind)
+# ============================================================
+# Les enregistrements de la grille sont acquittés tout de suite : les
+# modifications sont fusionnées par emplacement dans une file en mémoire,
+# puis envoyées en un seul ordre DML toutes les EDIT_FLUSH_INTERVAL_S secondes
+# (ou dès EDIT_FLUSH_MAX_ROWS emplacements). Plusieurs planificateurs ne
+# déclenchent plus chacun leur job BigQuery. Les lectures de la grille
+# superposent les modifications en attente (cf. pending()).
+# Durabilité (une fois start(journal) appelé) : une saisie n'est acquittée
+# qu'une fois journalisée (TblSaisieEnAttente, une ligne par emplacement et par
+# instance), et n'en sort qu'une fois écrite dans BigQuery. L'instance entretient
+# le battement de cœur de ses lignes ; celles d'une instance arrêtée sans avoir
+# vidé sa file (arrêt brutal, SIGTERM manqué) sont reprises par le balayage
+# d'une autre instance après EDIT_ORPHAN_S secondes.
+# Cloud Run : CPU toujours allouée (--no-cpu-throttling, cf. .github/workflows/deploy.yml),
+# sans quoi le thread d'envoi est gelé entre deux requêtes.
+
+EDIT_FLUSH_INTERVAL_S = float(os.environ.get("EDIT_FLUSH_INTERVAL_S", 5))
+EDIT_FLUSH_MAX_ROWS = int(os.environ.get("EDIT_FLUSH_MAX_ROWS", 500))
+EDIT_ORPHAN_S = 60           # lignes du journal sans battement depuis 60 s : instance arrêtée
+EDIT_SWEEP_S = 30            # recherche des saisies orphelines toutes les 30 s
+EDIT_SETTLE_WAIT_S = 30      # attente maximale des lots d'autres instances avant une écriture directe
+
+# Unique par processus (le PID est le même d'un conteneur à l'autre)
+INSTANCE_ID = f"{os.environ.get('K_REVISION', socket.gethostname())}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _journal_value(rec):
+    """Saisie telle que journalisée : champs renseignés seulement (None = inchangé)."""
+    return json.dumps({k: v for k, v in rec.items() if v is not None}, sort_keys=True)
+
+
+# ============================================================
+# 💾 JOURNAL DES SAISIES EN ATTENTE
+# ============================================================
+# Le journal fait foi : un lot écrit le contenu des lignes journalisées de ses
+# clés. Aucune transaction ne reste ouverte pendant l'écriture BigQuery :
+#  1. mark()    : transaction courte, les lignes sont marquées « en écriture »
+#                 (Ecriture) et leur contenu lu avec leur Version ;
+#  2. écriture BigQuery, hors transaction ;
+#  3. release() : transaction courte, retire les lignes écrites dont la Version
+#                 n'a pas bougé (une saisie arrivée pendant l'écriture incrémente
+#                 la Version : la ligne reste journalisée) et démarque les autres.
+# Avant une écriture directe dans la table, claim_keys() reprend les saisies des
+# autres instances sur les mêmes clés, sauf celles en cours d'écriture, qui sont
+# attendues (cf. EditBuffer.settle).
+
+def _fold(rows):
+    """(clé, saisie) -> {clé: saisie fusionnée}, dans l'ordre des lignes."""
+    merged = {}
+    for key, saisie in rows:
+        saisie = json.loads(saisie) if isinstance(saisie, str) else saisie
+        merged[key] = dict(merged.get(key, {}), **saisie)
+    return merged
+
+
+class MemoryEditJournal:
+    """Journal en mémoire : tests et développement local sans PostgreSQL."""
+
+    def __init__(self):
+        self._rows = {}      # (clé, instance) -> {"saisie", "version", "ecriture", "heartbeat"}
+        self._lock = threading.Lock()
+
+    def init(self):
+        pass
+
+    def add(self, instance, records, under=False):
+        now = time.monotonic()
+        with self._lock:
+            self._add(instance, records, under, now)
+
+    def _add(self, instance, records, under, now):
+        for key, rec in records.items():
+            row = self._rows.setdefault((key, instance), {"saisie": {}, "version": 0, "ecriture": False})
+            value = json.loads(_journal_value(rec))
+            row["saisie"] = dict(value, **row["saisie"]) if under else dict(row["saisie"], **value)
+            row["version"] += 1
+            row["heartbeat"] = now
+
+    def mark(self, instance, keys):
+        with self._lock:
+            marked = {}
+            for key in keys:
+                row = self._rows.get((key, instance))
+                if row:
+                    row["ecriture"] = True
+                    marked[key] = (dict(row["saisie"]), row["version"])
+            return marked
+
+    def release(self, instance, marked, written):
+        with self._lock:
+            for key, (_, version) in marked.items():
+                row = self._rows.get((key, instance))
+                if row is None:
+                    continue
+                if written and row["version"] == version:
+                    del self._rows[(key, instance)]
+                else:
+                    row["ecriture"] = False
+
+    def heartbeat(self, instance):
+        now = time.monotonic()
+        with self._lock:
+            for (_, owner), row in self._rows.items():
+                if owner == instance:
+                    row["heartbeat"] = now
+
+    def claim_orphans(self, instance, orphan_s):
+        """Saisies des instances silencieuses, retirées de leur journal et passées sous celles d'instance."""
+        limit = time.monotonic() - orphan_s
+        return self._claim(instance, lambda key, row: row["heartbeat"] < limit)
+
+    def claim_keys(self, instance, keys):
+        """Saisies des autres instances sur ces clés (None : toutes), passées sous celles d'instance,
+        sauf celles en cours d'écriture. Retourne (saisies reprises, nombre de lignes en écriture)."""
+        busy = []
+
+        def claimable(key, row):
+            if keys is not None and key not in keys:
+                return False
+            if row["ecriture"]:
+                busy.append(key)
+                return False
+            return True
+
+        return self._claim(instance, claimable), len(busy)
+
+    def _claim(self, instance, claimable):
+        now = time.monotonic()
+        with self._lock:
+            taken = [(k, row) for k, row in self._rows.items() if k[1] != instance and claimable(k[0], row)]
+            for k, _ in taken:
+                del self._rows[k]
+            claimed = _fold((k[0], row["saisie"]) for k, row in taken)
+            self._add(instance, claimed, True, now)
+        return claimed
+
+    def rows(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._rows.items()}
+
+
+class PgEditJournal:
+    """Journal PostgreSQL (table TblSaisieEnAttente, créée si absente)."""
+
+    # Fusion JSONB (||) : mêmes règles que EditBuffer._merge (champ absent = inchangé)
+    UPSERT = """
+        INSERT INTO TblSaisieEnAttente (Cle, Instance, Saisie) VALUES (%s, %s, %s)
+        ON CONFLICT (Cle, Instance) DO UPDATE
+        SET Saisie = {merge}, Version = TblSaisieEnAttente.Version + 1, Heartbeat = now()
+    """
+    OVER = UPSERT.format(merge="TblSaisieEnAttente.Saisie || EXCLUDED.Saisie")
+    UNDER = UPSERT.format(merge="EXCLUDED.Saisie || TblSaisieEnAttente.Saisie")
+
+    def _transaction(self, work):
+        """Exécute work(cur) dans une transaction courte ; retourne son résultat."""
+        conn = None
+        try:
+            conn = get_pg_connection()
+            cur = conn.cursor()
+            result = work(cur)
+            conn.commit()
+            cur.close()
+            return result
+        except Exception:
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                release_pg_connection(conn)
+
+    def init(self):
+        self._transaction(lambda cur: cur.execute("""
+            CREATE TABLE IF NOT EXISTS TblSaisieEnAttente (
+                Cle VARCHAR(128) NOT NULL,
+                Instance VARCHAR(160) NOT NULL,
+                Saisie JSONB NOT NULL,
+                Version BIGINT NOT NULL DEFAULT 1,
+                Ecriture TIMESTAMPTZ,
+                DateSaisie TIMESTAMPTZ NOT NULL DEFAULT now(),
+                Heartbeat TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (Cle, Instance)
+            )
+        """))
+
+    def add(self, instance, records, under=False):
+        if records:
+            rows = [(key, instance, _journal_value(rec)) for key, rec in records.items()]
+            self._transaction(lambda cur: cur.executemany(self.UNDER if under else self.OVER, rows))
+
+    def mark(self, instance, keys):
+        def work(cur):
+            cur.execute("""
+                UPDATE TblSaisieEnAttente SET Ecriture = now()
+                WHERE Instance = %s AND Cle = ANY(%s)
+                RETURNING Cle, Saisie, Version
+            """, (instance, list(keys)))
+            return {key: (_fold([(key, saisie)])[key], version) for key, saisie, version in cur.fetchall()}
+        return self._transaction(work)
+
+    def release(self, instance, marked, written):
+        if not marked:
+            return
+
+        def work(cur):
+            keys = list(marked)
+            if written:
+                cur.execute("""
+                    DELETE FROM TblSaisieEnAttente T
+                    USING unnest(%s::varchar[], %s::bigint[]) AS E(Cle, Version)
+                    WHERE T.Instance = %s AND T.Cle = E.Cle AND T.Version = E.Version
+                """, (keys, [marked[k][1] for k in keys], instance))
+            cur.execute(
+                "UPDATE TblSaisieEnAttente SET Ecriture = NULL WHERE Instance = %s AND Cle = ANY(%s)",
+                (instance, keys),
+            )
+        self._transaction(work)
+
+    def heartbeat(self, instance):
+        self._transaction(lambda cur: cur.execute(
+            "UPDATE TblSaisieEnAttente SET Heartbeat = now() WHERE Instance = %s", (instance,)))
+
+    def claim_orphans(self, instance, orphan_s):
+        return self._claim(instance, "Heartbeat < now() - make_interval(secs => %s)", (orphan_s,))
+
+    def claim_keys(self, instance, keys):
+        """Cf. MemoryEditJournal.claim_keys."""
+        where_keys = "TRUE" if keys is None else "Cle = ANY(%s)"
+        params = () if keys is None else (list(keys),)
+        claimed = self._claim(instance, f"{where_keys} AND Ecriture IS NULL", params)
+
+        def work(cur):
+            cur.execute(f"""
+                SELECT count(*) FROM TblSaisieEnAttente
+                WHERE Instance <> %s AND {where_keys} AND Ecriture IS NOT NULL
+            """, (instance,) + params)
+            return cur.fetchone()[0]
+        return claimed, self._transaction(work)
+
+    def _claim(self, instance, where, params):
+        # DELETE ... RETURNING puis réinsertion dans la même transaction : une seule instance les reprend.
+        # Saisies de l'instance (plus récentes) prioritaires sur celles reprises.
+        def work(cur):
+            cur.execute(f"""
+                DELETE FROM TblSaisieEnAttente
+                WHERE Instance <> %s AND {where}
+                RETURNING Cle, Saisie
+            """, (instance,) + tuple(params))
+            claimed = _fold(cur.fetchall())
+            if claimed:
+                cur.executemany(self.UNDER, [(key, instance, _journal_value(rec)) for key, rec in claimed.items()])
+            return claimed
+        return self._transaction(work)
+
+
+# ============================================================
+# ✍️ FILE D'ÉCRITURE
+# ============================================================
+
+
+class EditBuffer:
+    """
+    File de modifications fusionnées par clé. flush_fn(records) écrit un lot
+    (exception : le lot est remis en file et retenté au cycle suivant).
+    Un champ à None signifie « inchangé » (même règle que COALESCE(N.val, T.val)).
+    """
+
+    def __init__(self, flush_fn, key_fn, interval=EDIT_FLUSH_INTERVAL_S, max_rows=EDIT_FLUSH_MAX_ROWS):
+        self.flush_fn = flush_fn
+        self.key_fn = key_fn
+        self.interval = interval
+        self.max_rows = max_rows
+        self._cond = threading.Condition()
+        self._pending = {}      # clé -> modification fusionnée
+        self._since = {}        # clé -> date (monotonic) de la plus ancienne modification non écrite
+        self._inflight = {}     # lot en cours d'écriture (encore visible en lecture)
+        self._thread = None
+        self.last_flush = None  # {"date", "lignes", "duree_s", "erreur"}
+        self.journal = None     # MemoryEditJournal / PgEditJournal (cf. start)
+        self.instance = INSTANCE_ID
+        self._swept = 0.0
+
+    def start(self, journal):
+        """Active le journal durable et reprend les saisies laissées par une instance arrêtée
+        (à appeler une fois par processus serveur, cf. app.start_background_services)."""
+        journal.init()
+        with self._cond:
+            self.journal = journal
+        self._sweep()
+        with self._cond:
+            self._ensure_worker()
+        return self
+
+    # ------------------------------------------------------------
+    # Écriture
+    # ------------------------------------------------------------
+    def add(self, records):
+        """
+        Met les modifications en file ; retourne le nombre d'emplacements en attente.
+        Journal actif : journalisées d'abord (exception si le journal est injoignable,
+        la saisie n'est alors pas acquittée).
+        """
+        now = time.monotonic()
+        merged = {}
+        for rec in records:
+            self._merge(merged, {}, self.key_fn(rec), rec, now)
+        journal = self.journal
+        if journal is not None:
+            journal.add(self.instance, merged)
+        with self._cond:
+            for key, rec in merged.items():
+                self._merge(self._pending, self._since, key, rec, now)
+            self._ensure_worker()
+            if len(self._pending) >= self.max_rows:
+                self._cond.notify_all()
+            return len(self._pending)
+
+    @staticmethod
+    def _merge(pending, since, key, rec, now):
+        merged = dict(pending.get(key, {}))
+        for field, value in rec.items():
+            if value is not None or field not in merged:
+                merged[field] = value
+        pending[key] = merged
+        since.setdefault(key, now)
+
+    def flush(self):
+        """Écrit tout de suite les modifications en attente, après le lot en cours d'écriture (arrêt, tests)."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._inflight)
+            batch, since = self._take()
+        if batch:
+            self._write(batch, since)
+
+    def settle(self, keys=None):
+        """
+        À appeler avant une écriture directe dans la table (mise à jour en masse,
+        import) : les saisies en attente sur ces clés (None : toutes) sont écrites
+        d'abord, celles de l'instance comme celles des autres instances (journal),
+        et ne repasseront pas après l'écriture directe.
+        """
+        self.flush()
+        journal = self.journal
+        if journal is None:
+            return
+        keys = None if keys is None else set(keys)
+        deadline = time.monotonic() + EDIT_SETTLE_WAIT_S
+        n = 0
+        while True:
+            # Reprises puis écrites par cette instance ; celles en cours d'écriture sont attendues
+            claimed, busy = journal.claim_keys(self.instance, keys)
+            if claimed:
+                n += len(claimed)
+                self._merge_under(claimed)
+                self.flush()
+            if not busy:
+                break
+            if time.monotonic() > deadline:
+                print(f"⚠️ Écriture différée : {busy} saisie(s) d'autres instances toujours en cours d'écriture "
+                      f"après {EDIT_SETTLE_WAIT_S} s, écriture directe sans les attendre")
+                break
+            time.sleep(0.2)
+        if n:
+            print(f"✍️ Écriture différée : {n} saisie(s) d'autres instances écrite(s) avant une écriture directe")
+
+    # ------------------------------------------------------------
+    # Lecture
+    # ------------------------------------------------------------
+    def pending(self):
+        """Modifications pas encore visibles dans la table : lot en cours + file (la file gagne)."""
+        with self._cond:
+            out = {k: dict(v) for k, v in self._inflight.items()}
+            for key, rec in self._pending.items():
+                self._merge(out, {}, key, rec, 0)
+            return out
+
+    def status(self):
+        now = time.monotonic()
+        with self._cond:
+            oldest = min(list(self._since.values()), default=None)
+            return {
+                "en_attente": len(self._pending),
+                "en_cours": len(self._inflight),
+                "retard_s": round(now - oldest, 2) if oldest is not None else 0.0,
+                "intervalle_s": self.interval,
+                "lot_max": self.max_rows,
+                "dernier_envoi": self.last_flush,
+            }
+
+    # ------------------------------------------------------------
+    # Envoi en arrière-plan
+    # ------------------------------------------------------------
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="edit-buffer", daemon=True)
+            self._thread.start()
+
+    def _take(self):
+        """Retire la file pour l'envoyer (à appeler sous self._cond)."""
+        batch, since = self._pending, self._since
+        self._pending, self._since = {}, {}
+        self._inflight = dict(batch)
+        return batch, since
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= self.max_rows, timeout=self.interval)
+                journal = self.journal
+            if journal is not None:
+                try:
+                    journal.heartbeat(self.instance)
+                    if time.monotonic() - self._swept > EDIT_SWEEP_S:
+                        self._sweep()
+                except Exception as e:
+                    print(f"⚠️ Journal des saisies injoignable (battement / reprise) : {e}")
+            with self._cond:
+                if not self._pending:
+                    continue
+                batch, since = self._take()
+            self._write(batch, since)
+
+    def _sweep(self):
+        """Reprend les saisies journalisées par une instance arrêtée ; elles passent sous les saisies locales."""
+        self._swept = time.monotonic()
+        journal = self.journal
+        if journal is None:
+            return
+        # Requête hors du verrou : add() et pending() ne l'attendent pas
+        claimed = journal.claim_orphans(self.instance, EDIT_ORPHAN_S)
+        if claimed:
+            self._merge_under(claimed)
+            print(f"♻️ Écriture différée : {len(claimed)} saisie(s) d'une instance arrêtée reprise(s)")
+
+    def _merge_under(self, claimed):
+        """Met en file des saisies reprises d'autres instances, sous les saisies locales (plus récentes)."""
+        now = time.monotonic()
+        with self._cond:
+            for key, rec in claimed.items():
+                merged = {key: rec}
+                self._merge(merged, {}, key, self._pending.get(key, {}), now)
+                self._pending[key] = merged[key]
+                self._since.setdefault(key, now)
+            self._ensure_worker()
+            self._cond.notify_all()
+
+    def _write(self, batch, since):
+        t0 = time.perf_counter()
+        error = None
+        try:
+            journal = self.journal
+            if journal is not None:
+                self._write_journaled(journal, list(batch))
+            else:
+                self.flush_fn(list(batch.values()))
+        except Exception as e:
+            error = str(e)
+            print(f"❌ Écriture différée : échec sur {len(batch)} emplacement(s), nouvel essai au prochain cycle : {e}")
+        with self._cond:
+            if error:
+                # Remise en file sous les modifications arrivées entre-temps (plus récentes)
+                newer, newer_since = self._pending, self._since
+                self._pending, self._since = dict(batch), dict(since)
+                for key, rec in newer.items():
+                    self._merge(self._pending, self._since, key, rec, newer_since[key])
+            self._inflight = {}
+            self._cond.notify_all()
+            self.last_flush = {
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "lignes": len(batch),
+                "duree_s": round(time.perf_counter() - t0, 2),
+                "erreur": error,
+            }
+        if not error:
+            print(f"✍️ Écriture différée : {len(batch)} emplacement(s) en {self.last_flush['duree_s']} s")
+
+    def _write_journaled(self, journal, keys):
+        """Écrit le contenu journalisé de ces clés (cf. JOURNAL DES SAISIES EN ATTENTE)."""
+        marked = journal.mark(self.instance, keys)
+        if not marked:
+            return
+        try:
+            self.flush_fn([saisie for saisie, _ in marked.values()])
+        except Exception:
+            try:
+                journal.release(self.instance, marked, written=False)
+            except Exception as e:
+                print(f"⚠️ Journal des saisies : démarquage impossible après échec d'écriture : {e}")
+            raise
+        journal.release(self.instance, marked, written=True)
+
+    def flush_at_exit(self):
+        """Vide la file à l'arrêt normal de l'interpréteur (SIGTERM : cf. flush_on_sigterm)."""
+        atexit.register(self.flush)
+        return self
+
+    def flush_on_sigterm(self):
+        """Cloud Run arrête une instance par SIGTERM (10 s avant SIGKILL) : atexit n'est pas
+        exécuté, la file est donc vidée ici avant de rendre la main au gestionnaire
+        précédent. Le journal couvre les arrêts brutaux. Sans effet hors du thread principal."""
+        if threading.current_thread() is not threading.main_thread():
+            return self
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            print("🛑 SIGTERM : écriture des saisies en attente...")
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Saisies non écrites à l'arrêt (gardées au journal) : {e}")
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        return self
@@ -0,0 +1,341 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from gcp_client import get_bq_client
+from location_grid import LocationGrid
+from location_search import DELTA_MAX, LocationSearchIndex
+from sync_engine import UPSERT_KEYS, on_table_change
+
+
+# ============================================================
+# 🗂️ INSTANTANÉ EN MÉMOIRE DE TblEmplacement
+# ============================================================
+# La table ne fait que quelques dizaines de milliers de lignes : chaque worker
+# en garde une copie colonnaire (Arrow -> pandas / NumPy, Zone et Types en
+# catégories), triée sur la clé. Filtres, tri, pagination et recherches par
+# plage se font localement en quelques millisecondes.
+# Versionnée : chaque rafraîchissement incrémente la version. Après une écriture
+# de l'application, seules les clés modifiées sont relues (cf. sync_engine.table_changed) ;
+# une modification faite hors de l'application est vue via la date de modification BigQuery.
+# Un index de recherche (cf. location_search.py) suit l'instantané ; la grille
+# dense par allée (cf. location_grid.py) est construite à la demande.
+
+TABLE_EMPLACEMENT = "slottix.entrepot_optimisation.TblEmplacement"
+SNAPSHOT_KEY = UPSERT_KEYS["TblEmplacement"]
+SNAPSHOT_COLUMNS = SNAPSHOT_KEY + [
+    "Profondeur", "Largeur", "Hauteur", "PoidsLimiteTotal", "PoidsLimiteUnitaire",
+    "X", "Y", "Z", "Type1", "Type2", "Type3", "Palette",
+]
+CATEGORY_COLUMNS = ("Zone", "Type1", "Type2", "Type3")
+TYPE_COLUMNS = ("Type1", "Type2", "Type3")
+KEY_COL = "_Cle"             # clé normalisée (key_label), calculée au chargement
+ID_COL = "_Id"               # identifiant de ligne stable (index de recherche)
+LABEL_COL = "_Libelle"       # libellé Z-AAA-DDDD-NN
+SNAPSHOT_CHECK_S = 60        # contrôle de la date de modification BigQuery au plus toutes les 60 s
+INCREMENTAL_MAX = 5000       # au-delà de 5 000 clés modifiées : rechargement complet
+
+
+def key_label(zone, allee, deplacement, niveau):
+    """Clé normalisée d'un emplacement (zone sans casse ni espaces, comme les UPDATE)."""
+    return f"{str(zone).strip().lower()}|{int(allee)}|{int(deplacement)}|{int(niveau)}"
+
+
+def _key_labels(frame):
+    parts = [frame["Zone"].astype(str).str.strip().str.lower()]
+    parts += [frame[c].astype("Int64").astype(str) for c in SNAPSHOT_KEY[1:]]
+    labels = parts[0]
+    for p in parts[1:]:
+        labels = labels + "|" + p
+    return labels
+
+
+def _prepare(frame):
+    """Types compacts (catégories) et tri sur la clé : l'ordre d'affichage de la grille."""
+    frame = frame.copy()
+    for col in CATEGORY_COLUMNS:
+        frame[col] = frame[col].astype("category")
+    return frame.sort_values(SNAPSHOT_KEY, kind="stable", na_position="first").reset_index(drop=True)
+
+
+def _int_or_none(v):
+    try:
+        return int(v) if v not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def filter_frame(frame, f, index=None):
+    """
+    Lignes de l'instantané répondant aux filtres de la grille (mêmes règles que
+    _build_where_and_params : égalités sans casse, plages, recherche globale).
+    index : LocationSearchIndex de l'instantané pour la recherche globale
+    (sinon parcours des libellés et des types).
+    """
+    mask = np.ones(len(frame), dtype=bool)
+
+    def same_text(col, value):
+        return (frame[col].astype(str).str.strip().str.lower() == str(value).strip().lower()).to_numpy()
+
+    if f.get("zone"):
+        mask &= same_text("Zone", f["zone"])
+    allee = _int_or_none(f.get("allee"))
+    if allee is not None:
+        mask &= (frame["Allee"] == allee).to_numpy()
+
+    for col, lo, hi in (("Deplacement", "deplacement_from", "deplacement_to"),
+                        ("Niveau", "niveau_from", "niveau_to")):
+        lo, hi = _int_or_none(f.get(lo)), _int_or_none(f.get(hi))
+        if lo is not None and hi is not None:
+            mask &= frame[col].between(lo, hi).to_numpy()
+        elif lo is not None and col == "Deplacement":
+            mask &= (frame[col] == lo).to_numpy()
+
+    for col in ("Type1", "Type2", "Type3"):
+        if f.get(col.lower()):
+            mask &= same_text(col, f[col.lower()])
+
+    term = str(f.get("search") or "").strip().lower()
+    if term and index is not None:
+        mask &= np.isin(frame[ID_COL].to_numpy(), index.lookup(term))
+    elif term:
+        found = np.zeros(len(frame), dtype=bool)
+        for col in (LABEL_COL,) + TYPE_COLUMNS:
+            text = frame[col].astype(str).str.lower()
+            found |= text.str.contains(term, regex=False).fillna(False).to_numpy(dtype=bool)
+        mask &= found
+
+    return frame[mask]
+
+
+def location_labels(frame):
+    """Libellés Z-AAA-DDDD-NN des emplacements (format des routes)."""
+    return (frame["Zone"].astype(str)
+            + "-" + frame["Allee"].astype("Int64").astype(str).str.zfill(3)
+            + "-" + frame["Deplacement"].astype("Int64").astype(str).str.zfill(4)
+            + "-" + frame["Niveau"].astype("Int64").astype(str).str.zfill(2))
+
+
+def _with_keys(frame, first_id=0):
+    """Ajoute identifiant, clé normalisée et libellé (calculés une fois par ligne chargée)."""
+    frame = frame.copy()
+    frame[ID_COL] = np.arange(first_id, first_id + len(frame), dtype=np.int64)
+    frame[KEY_COL] = _key_labels(frame)
+    frame[LABEL_COL] = location_labels(frame)
+    return frame
+
+
+def _index_columns(frame):
+    return frame[ID_COL].to_numpy(), frame[LABEL_COL].tolist(), \
+        [frame[c].astype(object).where(frame[c].notna(), None).tolist() for c in TYPE_COLUMNS]
+
+
+def frame_records(frame):
+    """DataFrame -> liste de dict JSON (types Python natifs, NaN -> None)."""
+    out = frame.astype(object)
+    return out.where(out.notna(), None).to_dict("records")
+
+
+class EmplacementSnapshot:
+    """Copie colonnaire versionnée de TblEmplacement, propre au worker."""
+
+    def __init__(self, table_id=TABLE_EMPLACEMENT, client=None):
+        self.table_id = table_id
+        self._client = client
+        self._lock = threading.Lock()        # état publié (frame, version, index, invalidations)
+        self._load_lock = threading.Lock()   # un seul chargement BigQuery à la fois
+        self._grid_lock = threading.Lock()
+        self.frame = None
+        self.index = None
+        self.grid = None
+        self._grid_version = 0
+        self._grid_aisles = None   # allées à reconstruire (None : grille entière)
+        self._next_id = 0
+        self.version = 0
+        self.modified = None
+        self._checked = 0.0
+        self._stale = False
+        self._pending = set()
+
+    @property
+    def client(self):
+        """Client passé au constructeur, sinon le client partagé résolu à chaque appel (cf. set_bq_client)."""
+        return self._client if self._client is not None else get_bq_client()
+
+    # ------------------------------------------------------------
+    # Lecture
+    # ------------------------------------------------------------
+    def get(self):
+        """(DataFrame, version) à jour. Le DataFrame n'est jamais modifié sur place :
+        un rafraîchissement en produit un nouveau, les lecteurs en cours gardent l'ancien."""
+        frame, version, _ = self.get_indexed()
+        return frame, version
+
+    def get_indexed(self):
+        """(DataFrame, version, index de recherche) cohérents entre eux.
+        Les lectures BigQuery se font hors du verrou : invalidate() et les
+        lecteurs d'un instantané à jour n'attendent jamais un rechargement."""
+        with self._lock:
+            if not self._refresh_due():
+                return self.frame, self.version, self.index
+        with self._load_lock:
+            self._refresh()
+        with self._lock:
+            return self.frame, self.version, self.index
+
+    def get_grid(self):
+        """(LocationGrid, version) : grille dense par allée, reconstruite seulement
+        pour les allées touchées depuis la version précédente."""
+        self.get_indexed()
+        with self._grid_lock:
+            with self._lock:
+                frame, version = self.frame, self.version
+                if self._grid_version == version:
+                    return self.grid, version
+                aisles, self._grid_aisles = self._grid_aisles, set()
+            t0 = time.perf_counter()
+            try:
+                if self.grid is None or aisles is None:
+                    grid = LocationGrid.build(frame)
+                    what = f"{len(grid)} allées"
+                else:
+                    grid = self.grid.updated(frame, aisles)
+                    what = f"{len(aisles)} allée(s) reconstruite(s)"
+            except Exception:
+                with self._lock:
+                    self._grid_aisles = None   # échec : grille entière à la prochaine demande
+                raise
+            self.grid, self._grid_version = grid, version
+            print(f"🧱 Grille des allées v{version} : {what} en {time.perf_counter() - t0:.2f} s")
+            return grid, version
+
+    def warm_up(self):
+        """Chargement initial en arrière-plan (première page servie sans attendre BigQuery)."""
+        def load():
+            try:
+                self.get_grid()
+            except Exception as e:
+                print(f"⚠️ Instantané TblEmplacement non chargé : {e}")
+        threading.Thread(target=load, name="snapshot-emplacement", daemon=True).start()
+
+    # ------------------------------------------------------------
+    # Invalidation (écritures de l'application)
+    # ------------------------------------------------------------
+    def invalidate(self, keys=None):
+        """keys : [(Zone, Allee, Deplacement, Niveau)] modifiées, ou None (table entière)."""
+        with self._lock:
+            if keys is None:
+                self._stale = True
+                return
+            for k in keys:
+                try:
+                    self._pending.add(key_label(*k))
+                except (TypeError, ValueError):
+                    self._stale = True  # clé illisible : on relira tout
+            if len(self._pending) > INCREMENTAL_MAX:
+                self._stale = True
+
+    # ------------------------------------------------------------
+    # Chargement / rafraîchissement
+    # ------------------------------------------------------------
+    # Un seul chargement à la fois (_load_lock). Le travail à faire est relevé
+    # sous _lock, le nouvel instantané construit hors du verrou (BigQuery, tri,
+    # index), puis substitué à l'ancien sous _lock. Une invalidation arrivée
+    # pendant le chargement reste en attente pour le suivant.
+    def _refresh_due(self):
+        return (self.frame is None or self._stale or bool(self._pending)
+                or time.monotonic() - self._checked > SNAPSHOT_CHECK_S)
+
+    def _refresh(self):
+        with self._lock:
+            if not self._refresh_due():
+                return
+            if self.frame is None or self._stale:
+                keys = None
+            elif self._pending:
+                keys = sorted(self._pending)
+            else:
+                keys = ()
+                self._checked = time.monotonic()
+            self._stale = False
+            self._pending.clear()
+            frame, index, next_id = self.frame, self.index, self._next_id
+
+        try:
+            t0 = time.perf_counter()
+            modified = self.client.get_table(self.table_id).modified
+            if keys == ():
+                if modified == self.modified:
+                    return
+                print("🗂️ TblEmplacement modifiée hors de l'application : rechargement de l'instantané.")
+                keys = None
+            if keys is None:
+                frame, index, next_id = self._load()
+                what = f"chargé ({len(frame)} lignes)"
+            else:
+                frame, index, next_id = self._load_keys(keys, frame, index, next_id)
+                what = f"{len(keys)} clé(s) relue(s)"
+        except Exception:
+            with self._lock:
+                if keys is None or self.frame is None:
+                    self._stale = True
+                else:
+                    self._pending.update(keys or ())
+            raise
+
+        with self._lock:
+            self.frame, self.index, self._next_id = frame, index, next_id
+            self.modified = modified
+            if keys is None:
+                self._grid_aisles = None
+            elif self._grid_aisles is not None:
+                self._grid_aisles.update(tuple(k.split("|")[:2]) for k in keys)
+            self.version += 1
+            self._checked = time.monotonic()
+            print(f"🗂️ Instantané TblEmplacement v{self.version} : {what} en {time.perf_counter() - t0:.2f} s")
+
+    def _query(self, where_sql="", params=()):
+        query = f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM `{self.table_id}` AS e {where_sql}"
+        job_cfg = bigquery.QueryJobConfig(query_parameters=list(params))
+        return self.client.query(query, job_config=job_cfg).to_arrow().to_pandas()
+
+    def _load(self):
+        """Table entière -> (DataFrame, index, prochain identifiant)."""
+        frame = _prepare(_with_keys(self._query()))
+        return frame, LocationSearchIndex.build(*_index_columns(frame)), len(frame)
+
+    def _load_keys(self, keys, frame, index, next_id):
+        """Relit les seules clés modifiées et les remplace (ou les retire) dans une copie de l'instantané."""
+        fresh = self._query(
+            "WHERE CONCAT(LOWER(TRIM(e.Zone)), '|', "
+            + ", '|', ".join(f"CAST(SAFE_CAST(e.{c} AS INT64) AS STRING)" for c in SNAPSHOT_KEY[1:])
+            + ") IN UNNEST(@keys)",
+            [bigquery.ArrayQueryParameter("keys", "STRING", keys)],
+        )
+        fresh = _with_keys(fresh, next_id)
+        replaced = frame[KEY_COL].isin(keys).to_numpy()
+        replaced_ids = frame.loc[replaced, ID_COL].to_numpy()
+        kept = frame[~replaced]
+        frames = [kept.astype({c: object for c in CATEGORY_COLUMNS})]
+        if len(fresh):
+            frames.append(fresh)
+        new_frame = _prepare(pd.concat(frames, ignore_index=True))
+
+        # Index : anciennes lignes retirées, lignes relues ajoutées au delta ; reconstruit s'il grossit trop
+        if index.delta_size + len(replaced_ids) + len(fresh) > DELTA_MAX:
+            index = LocationSearchIndex.build(*_index_columns(new_frame))
+        else:
+            index = index.updated(replaced_ids, *_index_columns(fresh))
+        return new_frame, index, next_id + len(fresh)
+
+
+emplacement_snapshot = EmplacementSnapshot()
+
+
+@on_table_change
+def _on_table_change(table_name, keys=None):
+    if table_name == "TblEmplacement":
+        emplacement_snapshot.invalidate(keys)
@@ -0,0 +1,287 @@
+import atexit
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, Response, jsonify, request, send_file, stream_with_context
+
+from exports import EXPORT_FORMATS, STREAM_WRITERS, xlsx_file, export_response as plain_export_response
+from sync_engine import on_table_change
+
+
+# ============================================================
+# 🗃️ CACHE DES EXPORTS (fichiers compressés, clé = version de la table)
+# ============================================================
+# Les mêmes exports (TblEmplacement, TblProduit...) sont téléchargés des
+# dizaines de fois entre deux imports. Le fichier produit au premier
+# téléchargement est gardé sur disque, sous la clé (table, format, version) —
+# version : date de modification BigQuery + compteur de l'application
+# (cf. http_cache.table_version). Les téléchargements suivants sont servis par
+# send_file (reprise / Range, ETag) sans requête ni sérialisation.
+#  - CSV stocké compressé en gzip, envoyé tel quel (Content-Encoding: gzip) ;
+#    Parquet / Arrow (zstd) et XLSX (zip) sont déjà compressés
+#  - premier téléchargement toujours en flux : le fichier est écrit en même temps
+#  - taille totale bornée (EXPORT_CACHE_MAX_MB) : les moins récemment servis partent
+#  - une écriture de l'application sur la table (table_changed) supprime ses exports
+# Un dossier par processus : chaque worker gère ses fichiers (effacés à l'arrêt).
+# Cloud Run : le disque de l'instance est en mémoire, un fichier en cache compte
+# dans sa limite de mémoire. Le cache n'y est actif que si EXPORT_CACHE_DIR pointe
+# vers un volume monté ; un dossier en mémoire (tmpfs) est de plus limité à
+# EXPORT_CACHE_MEMORY_SHARE de la mémoire de l'instance.
+
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR")
+EXPORT_CACHE_MAX_MB = float(os.environ.get("EXPORT_CACHE_MAX_MB", 256))
+EXPORT_CACHE_MEMORY_SHARE = 0.25
+EXPORT_CACHE_GZIP_LEVEL = 6
+GZIP_FORMATS = ("csv",)
+_CHUNK = 1024 * 1024
+
+bp_export_cache = Blueprint("export_cache", __name__)
+
+
+def _memory_limit():
+    """Limite de mémoire du conteneur (cgroup v2 puis v1), None si non bornée."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as fh:
+                value = fh.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+        return None
+    return None
+
+
+def _in_memory(directory):
+    """Dossier sur un système de fichiers en mémoire (tmpfs / ramfs) ?"""
+    path = os.path.realpath(directory)
+    fstype, best = None, ""
+    try:
+        with open("/proc/mounts") as fh:
+            for line in fh:
+                parts = line.split()
+                mount = parts[1]
+                if len(parts) > 2 and (path == mount or path.startswith(mount.rstrip("/") + "/")) \
+                        and len(mount) >= len(best):
+                    fstype, best = parts[2], mount
+    except OSError:
+        return False
+    return fstype in ("tmpfs", "ramfs")
+
+
+def _cache_settings():
+    """(dossier, taille max en octets) ; dossier None : cache désactivé."""
+    if not EXPORT_CACHE_DIR and os.environ.get("K_SERVICE"):
+        print("⚠️ EXPORT_CACHE_DIR non défini : cache des exports désactivé (disque Cloud Run en mémoire)")
+        return None, 0
+    directory = EXPORT_CACHE_DIR or os.path.join(tempfile.gettempdir(), "slottix_exports")
+    max_bytes = EXPORT_CACHE_MAX_MB * 1024 * 1024
+    limit = _memory_limit()
+    if limit and _in_memory(directory) and max_bytes > limit * EXPORT_CACHE_MEMORY_SHARE:
+        max_bytes = limit * EXPORT_CACHE_MEMORY_SHARE
+        print(f"🗃️ Cache des exports en mémoire : limité à {max_bytes / 1e6:.0f} Mo "
+              f"({EXPORT_CACHE_MEMORY_SHARE:.0%} de la mémoire de l'instance)")
+    return directory, max_bytes
+
+
+class ExportEntry:
+    def __init__(self, key, path, size, encoding):
+        self.key = key            # (table, format, version)
+        self.path = path
+        self.size = size
+        self.encoding = encoding  # "gzip" ou None
+        self.created = time.time()
+        self.hits = 0
+
+    @property
+    def etag(self):
+        return f"{os.path.basename(self.path)}-{self.encoding or 'identity'}"
+
+
+class ExportCache:
+    """Fichiers d'export sur disque, index LRU en mémoire (par processus).
+    directory None : cache désactivé, les exports sont produits à chaque fois."""
+
+    def __init__(self, directory, max_bytes):
+        self.base_directory = directory
+        self.enabled = directory is not None
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def directory(self):
+        # Calculé à l'usage : les workers créés par fork ont chacun leur dossier
+        return os.path.join(self.base_directory, str(os.getpid()))
+
+    # ------------------------------------------------------------
+    # Index
+    # ------------------------------------------------------------
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(entry.path):
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            self._hits += 1
+            return entry
+
+    def _store(self, key, tmp_path, encoding):
+        """Range le fichier terminé sous sa clé puis évince les plus anciens au-delà de la taille max."""
+        path = os.path.join(self.directory, "_".join(str(k) for k in key[:2]) + f"_{int(time.time() * 1000)}")
+        os.replace(tmp_path, path)
+        entry = ExportEntry(key, path, os.path.getsize(path), encoding)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+                self._remove(old)
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self._remove(evicted)
+                print(f"🗃️ Export évincé du cache : {evicted.key[0]} ({evicted.key[1]}, {evicted.size / 1e6:.1f} Mo)")
+        return entry
+
+    @staticmethod
+    def _remove(entry):
+        # Un envoi en cours garde son fichier ouvert (suppression effective à la fermeture)
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def invalidate(self, table_name):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == table_name]:
+                entry = self._entries.pop(key)
+                self._size -= entry.size
+                self._remove(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "actif": self.enabled,
+                "fichiers": len(self._entries),
+                "taille_mo": round(self._size / 1e6, 1),
+                "max_mo": round(self.max_bytes / 1e6, 1),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.enabled:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    # ------------------------------------------------------------
+    # Production (premier téléchargement)
+    # ------------------------------------------------------------
+    def _temp_path(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".part", dir=self.directory)
+        os.close(fd)
+        return path
+
+    def tee(self, key, chunks, encoding=None):
+        """Renvoie les morceaux au client en les écrivant dans le cache ; le fichier
+        n'est gardé que si l'export est allé jusqu'au bout (sinon : déconnexion, erreur)."""
+        tmp = self._temp_path()
+        complete = False
+        try:
+            with open(tmp, "wb") as raw:
+                out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=EXPORT_CACHE_GZIP_LEVEL, mtime=0) \
+                    if encoding == "gzip" else raw
+                for chunk in chunks:
+                    out.write(chunk)
+                    yield chunk
+                if out is not raw:
+                    out.close()
+            complete = True
+        finally:
+            if complete:
+                self._store(key, tmp, encoding)
+            else:
+                os.remove(tmp)
+
+    def put_file(self, key, path):
+        """Range un fichier déjà produit (XLSX) : il appartient désormais au cache."""
+        tmp = self._temp_path()
+        shutil.move(path, tmp)
+        return self._store(key, tmp, None)
+
+    # ------------------------------------------------------------
+    # Envoi
+    # ------------------------------------------------------------
+    def send(self, entry, download_name, mimetype):
+        """send_file du fichier en cache (Range / If-None-Match gérés par Werkzeug)."""
+        if entry.encoding and not request.accept_encodings.quality(entry.encoding):
+            # Client sans gzip (rare) : décompression à la volée, sans reprise
+            def inflate():
+                with gzip.open(entry.path, "rb") as src:
+                    while chunk := src.read(_CHUNK):
+                        yield chunk
+            response = Response(stream_with_context(inflate()), mimetype=mimetype,
+                                headers={"Content-Disposition": f"attachment;filename={download_name}"})
+        else:
+            response = send_file(entry.path, mimetype=mimetype, as_attachment=True,
+                                 download_name=download_name, conditional=True, etag=entry.etag)
+            if entry.encoding:
+                response.headers["Content-Encoding"] = entry.encoding
+        response.vary.add("Accept-Encoding")
+        response.headers["X-Export-Cache"] = "hit"
+        return response
+
+    def export_response(self, key, schema, batches, format, basename):
+        """Premier téléchargement : export habituel (cf. exports.export_response), gardé en cache."""
+        if not self.enabled:
+            return plain_export_response(schema, batches, format, basename)
+        ext, mimetype = EXPORT_FORMATS[format]
+        download_name = f"{basename}.{ext}"
+        if format == "excel":
+            path, nb_lignes = xlsx_file(schema, batches)
+            print(f"📗 Export Excel {basename} : {nb_lignes} lignes (mis en cache)")
+            response = self.send(self.put_file(key, path), download_name, mimetype)
+            response.headers["X-Export-Cache"] = "miss"
+            return response
+
+        encoding = "gzip" if format in GZIP_FORMATS else None
+        chunks = self.tee(key, STREAM_WRITERS[format](schema, batches), encoding)
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment;filename={download_name}", "X-Export-Cache": "miss"},
+        )
+
+
+export_cache = ExportCache(*_cache_settings())
+atexit.register(export_cache.clear)
+
+
+@on_table_change
+def _on_table_change(table_name, keys=None):
+    export_cache.invalidate(table_name)
+
+
+# ============================================================
+# 🔎 API : état du cache des exports
+# ============================================================
+@bp_export_cache.route("/api/exports/cache", methods=["GET"])
+def api_export_cache_stats():
+    return jsonify(export_cache.stats())
@@ -0,0 +1,234 @@
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response, send_file, stream_with_context
+from openpyxl import Workbook
+
+from gcp_client import get_bq_client
+
+
+# ============================================================
+# 📤 EXPORTS EN FLUX (sans limite de lignes, mémoire constante)
+# ============================================================
+# Le résultat de la requête est lu page par page (lots Arrow de
+# EXPORT_PAGE_ROWS lignes) et chaque lot est encodé puis envoyé aussitôt dans
+# une réponse HTTP « chunked » : ni DataFrame complet, ni fichier en mémoire.
+# L'en-tête part dès que le schéma est connu (premier octet en moins d'une seconde).
+
+EXPORT_DATASET = "slottix.entrepot_optimisation"
+EXPORT_PAGE_ROWS = 20000
+CSV_SEP = ";"
+EXCEL_MAX_ROWS = 1_048_576 - 1      # lignes de données par feuille (limite Excel, en-tête compris)
+EXPORT_TMP_DIR = os.environ.get("EXPORT_TMP_DIR") or None   # None : dossier temporaire du système
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+COLUMNAR_COMPRESSION = "zstd"
+# format d'URL -> (extension, type MIME)
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv"),
+    "excel": ("xlsx", XLSX_MIMETYPE),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrows", "application/vnd.apache.arrow.stream"),
+}
+_TABLE_NAME = re.compile(r"^\w+$")
+# Entiers / booléens nullables (comme RowIterator.to_dataframe) : même rendu dans tous les lots
+_PANDAS_TYPES = {pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}.get
+
+
+def export_query(table_name):
+    """SELECT * de la table (nom vérifié : il est inséré dans le SQL)."""
+    if not _TABLE_NAME.match(table_name or ""):
+        raise ValueError(f"Nom de table invalide : {table_name}")
+    return f"SELECT * FROM `{EXPORT_DATASET}.{table_name}`"
+
+
+def query_batches(query, job_config=None, client=None):
+    """(schéma BigQuery, itérateur de lots pyarrow.RecordBatch) du résultat de query."""
+    client = client or get_bq_client()
+    rows = client.query(query, job_config=job_config).result(page_size=EXPORT_PAGE_ROWS)
+    return rows.schema, rows.to_arrow_iterable()
+
+
+def csv_stream(schema, batches, sep=CSV_SEP):
+    """Morceaux CSV encodés en UTF-8 : en-tête, puis un morceau par lot (même format que DataFrame.to_csv)."""
+    yield (sep.join(field.name for field in schema) + "\n").encode("utf-8")
+    for batch in batches:
+        if batch.num_rows:
+            yield batch.to_pandas(types_mapper=_PANDAS_TYPES).to_csv(index=False, header=False, sep=sep).encode("utf-8")
+
+
+# ============================================================
+# 📗 EXCEL EN ÉCRITURE SEULE (mémoire bornée)
+# ============================================================
+# Un classeur XLSX n'est lisible qu'une fois complet : il est écrit dans un
+# fichier temporaire par openpyxl en mode write_only (les lignes partent sur
+# disque au fil de l'eau, rien n'est gardé en mémoire), puis envoyé par
+# send_file. Au-delà de EXCEL_MAX_ROWS lignes, la suite va dans une nouvelle
+# feuille (« Données 2 », « Données 3 »...), chacune avec l'en-tête.
+
+def _excel_value(value):
+    # Excel ne connaît pas les fuseaux horaires : TIMESTAMP BigQuery -> heure UTC sans fuseau
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def xlsx_file(schema, batches, sheet_name="Données"):
+    """Écrit les lots dans un classeur XLSX temporaire ; retourne (chemin, nombre de lignes).
+    Le fichier est à supprimer par l'appelant (cf. send_temp_file)."""
+    header = [field.name for field in schema]
+    wb = Workbook(write_only=True)
+    ws, in_sheet, sheets, total = None, EXCEL_MAX_ROWS, 0, 0
+
+    def new_sheet():
+        nonlocal ws, in_sheet, sheets
+        sheets += 1
+        ws = wb.create_sheet(sheet_name if sheets == 1 else f"{sheet_name} {sheets}")
+        ws.append(header)
+        in_sheet = 0
+
+    for batch in batches:
+        columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+        for row in zip(*columns):
+            if in_sheet >= EXCEL_MAX_ROWS:
+                new_sheet()
+            ws.append([_excel_value(v) for v in row])
+            in_sheet += 1
+        total += batch.num_rows
+    if ws is None:
+        new_sheet()
+
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".xlsx", dir=EXPORT_TMP_DIR)
+    os.close(fd)
+    try:
+        wb.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, total
+
+
+def frame_batches(frame):
+    """(schéma, lots) d'un petit DataFrame, pour les mêmes écrivains que les requêtes."""
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    return table.schema, table.to_batches()
+
+
+def send_temp_file(path, download_name, mimetype):
+    """send_file d'un fichier temporaire, supprimé une fois la réponse envoyée."""
+    response = send_file(path, as_attachment=True, download_name=download_name, mimetype=mimetype)
+
+    def cleanup():
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"⚠️ Fichier d'export temporaire non supprimé ({path}) : {e}")
+    response.call_on_close(cleanup)
+    return response
+
+
+# ============================================================
+# 🧊 PARQUET / ARROW IPC EN FLUX (types conservés)
+# ============================================================
+# Les lots Arrow de BigQuery sont réécrits tels quels : Parquet (un groupe de
+# lignes par lot) ou flux Arrow IPC, compressés en zstd. Les deux formats
+# s'écrivent séquentiellement : chaque lot encodé part aussitôt au client.
+# Le schéma BigQuery (types, modes, descriptions) est joint aux métadonnées
+# (clé « bigquery_schema »).
+
+class _ChunkSink:
+    """Fichier en écriture seule dont on récupère le contenu au fil de l'eau (take)."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        out = b"".join(self._chunks)
+        self._chunks = []
+        return out
+
+
+def _columnar_schema(schema, batches):
+    """(schéma Arrow avec métadonnées, lots) ; résultat vide : colonnes texte."""
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is not None:
+        arrow_schema = first.schema
+    elif isinstance(schema, pa.Schema):
+        arrow_schema = schema
+    else:
+        arrow_schema = pa.schema([pa.field(field.name, pa.string()) for field in schema])
+    if not isinstance(schema, pa.Schema):
+        bq_schema = [field.to_api_repr() for field in schema]
+        arrow_schema = arrow_schema.with_metadata(
+            dict(arrow_schema.metadata or {}, bigquery_schema=json.dumps(bq_schema)))
+
+    def all_batches():
+        if first is not None:
+            yield first
+        yield from batches
+    return arrow_schema, all_batches()
+
+
+def parquet_stream(schema, batches):
+    arrow_schema, batches = _columnar_schema(schema, batches)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, arrow_schema, compression=COLUMNAR_COMPRESSION) as writer:
+        for batch in batches:
+            writer.write_batch(batch.replace_schema_metadata(arrow_schema.metadata))
+            yield sink.take()
+    yield sink.take()
+
+
+def arrow_stream(schema, batches):
+    arrow_schema, batches = _columnar_schema(schema, batches)
+    sink = _ChunkSink()
+    options = pa.ipc.IpcWriteOptions(compression=COLUMNAR_COMPRESSION)
+    with pa.ipc.new_stream(sink, arrow_schema, options=options) as writer:
+        for batch in batches:
+            writer.write_batch(batch.replace_schema_metadata(arrow_schema.metadata))
+            yield sink.take()
+    yield sink.take()
+
+
+# formats envoyés au fil de l'eau (excel : fichier temporaire, cf. xlsx_file)
+STREAM_WRITERS = {"csv": csv_stream, "parquet": parquet_stream, "arrow": arrow_stream}
+
+
+def export_response(schema, batches, format, basename):
+    """Réponse de téléchargement au format demandé (cf. EXPORT_FORMATS)."""
+    ext, mimetype = EXPORT_FORMATS[format]
+    filename = f"{basename}.{ext}"
+    if format == "excel":
+        path, nb_lignes = xlsx_file(schema, batches)
+        print(f"📗 Export Excel {basename} : {nb_lignes} lignes")
+        return send_temp_file(path, filename, mimetype)
+
+    return Response(
+        stream_with_context(STREAM_WRITERS[format](schema, batches)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename={filename}"},
+    )
@@ -1,8 +1,238 @@
 import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import google.auth
+from flask import Blueprint, jsonify
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+from google.resumable_media.requests import Download, ResumableUpload
+from requests.adapters import HTTPAdapter
+
+
+# ============================================================
+# 📊 CLIENT BIGQUERY PARTAGÉ
+# ============================================================
+# Un seul client par processus, partagé entre les threads : les identifiants
+# sont résolus une fois et la session HTTP garde ses connexions ouvertes
+# (keep-alive). Chaque appel est chronométré (cf. /api/bigquery/stats).
+# Remplaçable par un faux client en test : set_bq_client(fake).
+
+BQ_PROJECT_ID = os.environ.get("BQ_PROJECT_ID", "slottix")
+BQ_HTTP_POOL_SIZE = int(os.environ.get("BQ_HTTP_POOL_SIZE", 32))   # connexions gardées ouvertes
+BQ_SLOW_CALL_S = float(os.environ.get("BQ_SLOW_CALL_S", 2.0))       # appels signalés dans les logs
+BQ_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Méthodes chronométrées ; pour les jobs (requête, chargement), la durée court jusqu'à leur fin
+JOB_METHODS = ("query", "load_table_from_file", "load_table_from_uri", "load_table_from_dataframe")
+TIMED_METHODS = (
+    "query", "get_table", "update_table", "delete_table", "create_table",
+    "load_table_from_file", "load_table_from_uri", "load_table_from_dataframe",
+    "insert_rows_json", "list_rows",
+)
+
+bp_gcp = Blueprint("gcp", __name__)
+
+_client = None
+_client_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(method, elapsed):
+    with _stats_lock:
+        s = _stats.setdefault(method, {"appels": 0, "total_s": 0.0, "max_s": 0.0})
+        s["appels"] += 1
+        s["total_s"] += elapsed
+        s["max_s"] = max(s["max_s"], elapsed)
+    if elapsed >= BQ_SLOW_CALL_S:
+        print(f"🐢 BigQuery {method} : {elapsed:.2f} s")
+
+
+class TimedJob:
+    """Job (requête, chargement) dont la durée soumission -> fin est mesurée à la première attente."""
+
+    WAIT_METHODS = ("result", "to_dataframe", "to_arrow")
+
+    def __init__(self, job, method, t0):
+        self._job = job
+        self._method = method
+        self._t0 = t0
+        self._recorded = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._job, name)
+        if name not in self.WAIT_METHODS:
+            return attr
+
+        def waited(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if not self._recorded:
+                self._recorded = True
+                _record(self._method, time.perf_counter() - self._t0)
+            return result
+        return waited
+
+    def __iter__(self):
+        return iter(self.result())
+
+
+class TimedClient:
+    """Enveloppe d'un client BigQuery (réel ou faux) qui chronomètre les appels."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in TIMED_METHODS or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            result = attr(*args, **kwargs)
+            if name in JOB_METHODS:
+                # Le job s'exécute après le retour de l'appel : mesuré quand on attend sa fin
+                return TimedJob(result, name, t0)
+            _record(name, time.perf_counter() - t0)
+            return result
+        return timed
+
+
+def _build_client():
+    """Client réel : identifiants par défaut et session HTTP à connexions persistantes."""
+    credentials, _ = google.auth.default(scopes=BQ_SCOPES)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=BQ_HTTP_POOL_SIZE, pool_maxsize=BQ_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return bigquery.Client(project=BQ_PROJECT_ID, credentials=credentials, _http=session)
+
 
 def get_bq_client():
-    """Retourne un client BigQuery prêt, local ou cloud."""
-    if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-        return bigquery.Client()
-    return bigquery.Client()  # Cloud Run utilisera l'identité IAM
+    """Retourne le client BigQuery partagé (créé au premier appel), local ou cloud."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                t0 = time.perf_counter()
+                _client = TimedClient(_build_client())
+                print(f"📊 Client BigQuery prêt en {time.perf_counter() - t0:.2f} s")
+    return _client
+
+
+def set_bq_client(client):
+    """Remplace le client partagé (faux client en test) ; None : client réel au prochain appel."""
+    global _client
+    with _client_lock:
+        _client = TimedClient(client) if client is not None else None
+
+
+def warm_up_bq_client():
+    """Au démarrage : identifiants, jeton et connexion HTTPS établis en arrière-plan
+    (requête à blanc, non facturée) pour que la première requête utilisateur n'attende pas."""
+    def warm():
+        try:
+            job_cfg = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+            get_bq_client().query("SELECT 1", job_config=job_cfg)
+        except Exception as e:
+            print(f"⚠️ Préchauffage BigQuery impossible : {e}")
+    threading.Thread(target=warm, name="bq-warmup", daemon=True).start()
+
+
+# ============================================================
+# 🪣 CLOUD STORAGE (fichiers de transit durables)
+# ============================================================
+# API JSON de Cloud Storage par la session autorisée : envoi en reprise
+# par blocs et lecture en flux avec contrôle MD5 (google-resumable-media,
+# installé avec google-cloud-bigquery). Appels chronométrés comme BigQuery.
+
+GCS_API = "https://storage.googleapis.com"
+GCS_CHUNK = 8 * 1024 * 1024        # multiple de 256 Kio (envoi en reprise)
+
+_gcs_session = None
+
+
+def _gcs():
+    global _gcs_session
+    if _gcs_session is None:
+        with _client_lock:
+            if _gcs_session is None:
+                credentials, _ = google.auth.default(scopes=BQ_SCOPES)
+                _gcs_session = AuthorizedSession(credentials)
+    return _gcs_session
+
+
+def split_gcs_uri(uri):
+    """gs://bucket/objet -> (bucket, objet)."""
+    if not uri.startswith("gs://") or "/" not in uri[5:]:
+        raise ValueError(f"URI Cloud Storage invalide : {uri}")
+    bucket, name = uri[5:].split("/", 1)
+    return bucket, name
+
+
+def _object_url(bucket, name):
+    return f"{GCS_API}/storage/v1/b/{bucket}/o/{quote(name, safe='')}"
+
+
+def gcs_upload(path, uri, content_type="application/octet-stream"):
+    """Envoie un fichier local vers gs://bucket/objet (par blocs de GCS_CHUNK)."""
+    bucket, name = split_gcs_uri(uri)
+    t0 = time.perf_counter()
+    upload = ResumableUpload(f"{GCS_API}/upload/storage/v1/b/{bucket}/o?uploadType=resumable", GCS_CHUNK)
+    with open(path, "rb") as fh:
+        upload.initiate(_gcs(), fh, {"name": name}, content_type)
+        while not upload.finished:
+            upload.transmit_next_chunk(_gcs())
+    _record("gcs_upload", time.perf_counter() - t0)
+
+
+def gcs_download(uri, path):
+    """Copie gs://bucket/objet dans un fichier local."""
+    bucket, name = split_gcs_uri(uri)
+    t0 = time.perf_counter()
+    with open(path, "wb") as fh:
+        Download(_object_url(bucket, name) + "?alt=media", stream=fh).consume(_gcs())
+    _record("gcs_download", time.perf_counter() - t0)
+
+
+def gcs_delete(uri):
+    """Supprime un objet (absent : rien à faire)."""
+    bucket, name = split_gcs_uri(uri)
+    response = _gcs().delete(_object_url(bucket, name))
+    if response.status_code not in (200, 204, 404):
+        response.raise_for_status()
+
+
+def gcs_list(prefix_uri):
+    """(uri, date de création) des objets sous gs://bucket/préfixe."""
+    bucket, prefix = split_gcs_uri(prefix_uri)
+    params = {"prefix": prefix, "fields": "items(name,timeCreated),nextPageToken"}
+    while True:
+        response = _gcs().get(f"{GCS_API}/storage/v1/b/{bucket}/o", params=params)
+        response.raise_for_status()
+        data = response.json()
+        for item in data.get("items", []):
+            created = datetime.fromisoformat(item["timeCreated"].replace("Z", "+00:00"))
+            yield f"gs://{bucket}/{item['name']}", created
+        if not data.get("nextPageToken"):
+            return
+        params["pageToken"] = data["nextPageToken"]
+
+
+def bq_stats():
+    with _stats_lock:
+        return {
+            method: dict(s, total_s=round(s["total_s"], 3), max_s=round(s["max_s"], 3),
+                         moyenne_s=round(s["total_s"] / s["appels"], 3))
+            for method, s in _stats.items()
+        }
+
+
+# ============================================================
+# 🔎 API : durées des appels BigQuery
+# ============================================================
+@bp_gcp.route("/api/bigquery/stats", methods=["GET"])
+def api_bigquery_stats():
+    return jsonify(bq_stats())
@@ -0,0 +1,15 @@
+import os
+
+# ============================================================
+# 🦄 GUNICORN (production) : gunicorn -c gunicorn.conf.py app:app
+# ============================================================
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 0   # Cloud Run borne déjà la durée des requêtes (flux SSE, exports)
+
+
+def post_worker_init(worker):
+    # File de jobs + journal des saisies : une fois par worker, dans son thread principal (SIGTERM)
+    from app import start_background_services
+    start_background_services()
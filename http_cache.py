@@ -0,0 +1,82 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+
+from flask import make_response, request
+
+from gcp_client import BQ_PROJECT_ID, get_bq_client
+from sync_engine import on_table_change
+
+
+# ============================================================
+# 🏷️ GET CONDITIONNELS (ETag / 304) SUR LES DONNÉES DE RÉFÉRENCE
+# ============================================================
+# Listes de types, familles, groupes de circuits, TypeFlux... : rechargées à
+# chaque ouverture de page alors qu'elles changent rarement. Chaque réponse
+# porte un ETag calculé à partir de la version des tables lues :
+#  - date de modification BigQuery, relue au plus toutes les REF_CHECK_S secondes
+#  - compteur de modifications de l'application (cf. sync_engine.table_changed)
+# Le navigateur renvoie If-None-Match : si la version n'a pas bougé, 304 sans
+# requête BigQuery. Cache-Control « no-cache » : le navigateur garde la réponse
+# mais la revalide à chaque fois (une écriture faite par une autre instance est
+# vue au plus REF_CHECK_S secondes plus tard).
+
+REF_DATASET = "entrepot_optimisation"
+REF_CHECK_S = float(os.environ.get("REF_CHECK_S", 30))
+REF_CACHE_CONTROL = "private, no-cache"
+
+_lock = threading.Lock()
+_modified = {}   # table -> (date du contrôle (monotonic), date de modification BigQuery)
+_counters = {}   # table -> nombre de modifications signalées par l'application
+
+
+def table_version(table_name):
+    """Version d'une table : date de modification BigQuery + compteur local."""
+    now = time.monotonic()
+    with _lock:
+        entry = _modified.get(table_name)
+    if entry is None or now - entry[0] > REF_CHECK_S:
+        table = get_bq_client().get_table(f"{BQ_PROJECT_ID}.{REF_DATASET}.{table_name}")
+        entry = (now, table.modified.isoformat() if table.modified else "")
+        with _lock:
+            _modified[table_name] = entry
+    with _lock:
+        return f"{entry[1]}#{_counters.get(table_name, 0)}"
+
+
+def versioned_json(*tables):
+    """
+    Décorateur d'une vue GET en lecture seule : ETag = empreinte (URL, versions
+    des tables) ; If-None-Match identique -> 304 sans exécuter la vue.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                versions = [table_version(t) for t in tables]
+            except Exception as e:
+                print(f"⚠️ Version de {', '.join(tables)} indisponible, réponse sans ETag : {e}")
+                return view(*args, **kwargs)
+
+            etag = hashlib.sha1("|".join([request.full_path] + versions).encode()).hexdigest()[:20]
+            if etag in request.if_none_match:
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = REF_CACHE_CONTROL
+            return response
+        return wrapper
+    return decorator
+
+
+@on_table_change
+def _on_table_change(table_name, keys=None):
+    # Nouvel ETag tout de suite ; la date BigQuery sera relue à la prochaine requête
+    with _lock:
+        _counters[table_name] = _counters.get(table_name, 0) + 1
+        _modified.pop(table_name, None)
@@ -0,0 +1,420 @@
+import codecs
+import csv
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from openpyxl import load_workbook
+
+from cleaning import normalize_columns
+from gcp_client import gcs_delete, gcs_download, gcs_list, gcs_upload
+
+try:
+    # Lecteur Excel natif (Rust), plus rapide qu'openpyxl : utilisé s'il est installé
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+
+# ============================================================
+# 📥 PIPELINE D'IMPORT PAR MORCEAUX (lecture → nettoyage → chargement)
+# ============================================================
+# Les fichiers TblEmplacement / TblPicking peuvent dépasser plusieurs centaines
+# de milliers de lignes : on ne les charge jamais entièrement en mémoire.
+
+CHUNK_SIZE = 50_000
+SNIFF_BYTES = 64 * 1024
+UPLOAD_BLOCK = 1024 * 1024
+CSV_SEPARATORS = (';', ',', '\t', '|')
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# Fichiers Parquet de transit conservés pour relance / audit
+STAGING_FOLDER = os.path.join('uploads', 'staging')
+STAGING_RETENTION_DAYS = 7
+# Fichiers relus par un job : rangés dans gs://STAGING_BUCKET/ (le disque d'une instance
+# Cloud Run est en mémoire et lui est propre : un job repris après un redémarrage, ou
+# par une autre instance, ne le retrouverait pas). Sans bucket : disque local (développement).
+STAGING_BUCKET = os.environ.get("STAGING_BUCKET")
+STAGING_PREFIXES = ("staging", "lots")
+if not STAGING_BUCKET and os.environ.get("K_SERVICE"):
+    print("⚠️ STAGING_BUCKET non défini : fichiers de transit sur le disque de l'instance (jobs non reprenables)")
+
+# Type BigQuery -> type Arrow (le fichier Parquet porte exactement le schéma de la table)
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BIGNUMERIC": pa.decimal256(76, 38),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp('us'),
+    "TIMESTAMP": pa.timestamp('us', tz='UTC'),
+    "TIME": pa.time64('us'),
+    "BYTES": pa.binary(),
+}
+
+
+def save_upload_hashed(upload, path):
+    """
+    Écrit le fichier envoyé (FileStorage) sur disque par blocs en calculant son
+    SHA-256 au passage : une seule lecture, pas de copie complète en mémoire.
+    """
+    digest = hashlib.sha256()
+    tmp_path = path + ".part"
+    with open(tmp_path, 'wb') as out:
+        while True:
+            block = upload.stream.read(UPLOAD_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    os.replace(tmp_path, path)
+    return digest.hexdigest()
+
+
+def _detect_encoding(sample):
+    """Retourne (encodage, bom) à partir des premiers octets du fichier."""
+    for bom, enc in BOMS:
+        if sample.startswith(bom):
+            return enc, True
+
+    # UTF-16 sans BOM (export Excel "Texte Unicode") : un octet nul sur deux
+    if sample.count(b'\x00') > len(sample) // 4:
+        odd_nulls = sample[1::2].count(b'\x00')
+        return ('utf-16-le' if odd_nulls > len(sample) // 4 else 'utf-16-be'), False
+
+    try:
+        sample.decode('utf-8')
+        return 'utf-8', False
+    except UnicodeDecodeError as e:
+        # Caractère multi-octets coupé par la fin de l'échantillon : c'est bien de l'UTF-8
+        if e.start >= len(sample) - 3 and e.reason == 'unexpected end of data':
+            return 'utf-8', False
+
+    try:
+        sample.decode('cp1252')
+        return 'cp1252', False
+    except UnicodeDecodeError:
+        return 'latin1', False
+
+
+def _detect_separator(lines):
+    """Séparateur qui donne le plus de lignes avec le même nombre de champs que l'en-tête."""
+    best, best_score = None, (0, 0)
+    for sep in CSV_SEPARATORS:
+        counts = [len(row) for row in csv.reader(lines, delimiter=sep) if row]
+        if not counts or counts[0] < 2:
+            continue
+        score = (sum(1 for c in counts if c == counts[0]), counts[0])
+        if score > best_score:
+            best, best_score = sep, score
+    return best
+
+
+def sniff_csv_dialect(path, sample_size=SNIFF_BYTES):
+    """
+    Détecte BOM, encodage et séparateur sur un échantillon d'octets,
+    pour ne parser le fichier qu'une seule fois ensuite.
+    """
+    with open(path, 'rb') as fh:
+        sample = fh.read(sample_size)
+    if not sample:
+        raise ValueError("Impossible de lire le CSV : fichier vide")
+
+    encoding, bom = _detect_encoding(sample)
+    if encoding.startswith('utf-16') and len(sample) % 2:
+        sample = sample[:-1]
+    text = sample.decode(encoding, errors='ignore')
+
+    lines = text.splitlines()
+    if len(sample) == sample_size and len(lines) > 1:
+        lines = lines[:-1]  # dernière ligne probablement tronquée
+
+    sep = _detect_separator(lines[:50])
+    if sep is None:
+        raise ValueError(f"Impossible de lire le CSV : séparateur introuvable (encodage {encoding})")
+    return {"encoding": encoding, "sep": sep, "bom": bom}
+
+
+def describe_dialect(dialect):
+    """Libellé court enregistré dans TblHistoriqueImport.Dialecte."""
+    if not dialect:
+        return None
+    if dialect.get("sheet"):
+        return f"{dialect['reader']} | feuille '{dialect['sheet']}'"
+    if not dialect.get("encoding"):
+        return None
+    sep = {'\t': 'TAB'}.get(dialect["sep"], dialect["sep"])
+    return f"{dialect['encoding']} | sep '{sep}'" + (" | BOM" if dialect.get("bom") else "")
+
+
+def iter_csv_chunks(path, sep, encoding, chunksize=CHUNK_SIZE):
+    """Lit un CSV par blocs avec le moteur C (tout en texte, typage fait au nettoyage)."""
+    return pd.read_csv(
+        path,
+        sep=sep,
+        encoding=encoding,
+        engine='c',
+        dtype=str,
+        keep_default_na=False,
+        on_bad_lines='skip',
+        chunksize=chunksize,
+    )
+
+
+def _iter_frame_chunks(df, chunksize=CHUNK_SIZE):
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+# ============================================================
+# 📗 EXCEL EN FLUX (calamine si installé, sinon openpyxl en lecture seule)
+# ============================================================
+def _cell_text(value):
+    """Cellule Excel -> texte, comme une cellule CSV (12.0 -> '12', vide -> '')."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _open_excel_sheets(path):
+    """Retourne (moteur, {feuille: fabrique d'itérateur de lignes}, fermeture)."""
+    if CalamineWorkbook is not None:
+        workbook = CalamineWorkbook.from_path(path)
+        sheets = {
+            name: (lambda name=name: workbook.get_sheet_by_name(name).iter_rows())
+            for name in workbook.sheet_names
+        }
+        return "calamine", sheets, lambda: None
+    if path.lower().endswith('.xls'):
+        return None, {}, lambda: None
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    sheets = {ws.title: (lambda ws=ws: ws.iter_rows(values_only=True)) for ws in workbook.worksheets}
+    return "openpyxl", sheets, workbook.close
+
+
+def _excel_header(rows):
+    """Première ligne non vide d'une feuille (en-tête), ou None."""
+    for row in rows:
+        if any(v not in (None, "") for v in row):
+            return [_cell_text(v) or f"Unnamed_{i}" for i, v in enumerate(row)]
+    return None
+
+
+def _pick_sheet(sheets, columns=None):
+    """
+    Feuille à importer : celle dont l'en-tête partage le plus de colonnes avec
+    la table cible (columns), à défaut la première feuille non vide.
+    """
+    best, best_score = None, -1
+    for name, open_rows in sheets.items():
+        header = _excel_header(open_rows())
+        if header is None:
+            continue
+        score = len(set(normalize_columns(header)) & set(columns)) if columns else 0
+        if score > best_score:
+            best, best_score = name, score
+    return best
+
+
+def iter_excel_chunks(path, chunksize=CHUNK_SIZE, columns=None):
+    """
+    Lit un classeur ligne à ligne (mémoire bornée à un morceau) ; tout en texte,
+    comme iter_csv_chunks. Retourne (description du format, itérateur).
+    """
+    reader, sheets, close = _open_excel_sheets(path)
+    if reader is None:
+        # .xls sans calamine : ancien chemin pandas (classeur entier en mémoire)
+        df = pd.read_excel(path, dtype=str, keep_default_na=False)
+        return {"encoding": None, "sep": None, "bom": False}, _iter_frame_chunks(df, chunksize)
+
+    sheet = _pick_sheet(sheets, columns)
+    if sheet is None:
+        close()
+        raise ValueError("Impossible de lire le classeur : aucune feuille non vide")
+
+    def chunks():
+        try:
+            rows = iter(sheets[sheet]())
+            header = _excel_header(rows)
+            width = len(header)
+            buffer = []
+            for row in rows:
+                if all(v in (None, "") for v in row):
+                    continue
+                values = [_cell_text(v) for v in row[:width]]
+                buffer.append(values + [""] * (width - len(values)))
+                if len(buffer) >= chunksize:
+                    yield pd.DataFrame(buffer, columns=header, dtype=object)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=header, dtype=object)
+        finally:
+            close()
+
+    return {"encoding": None, "sep": None, "bom": False, "sheet": sheet, "reader": reader}, chunks()
+
+
+def read_import_chunks(path, filename, chunksize=CHUNK_SIZE, columns=None):
+    """
+    Retourne (description du format, itérateur de DataFrames bruts).
+    columns : colonnes de la table cible, pour choisir la feuille d'un classeur.
+    Lève ValueError si le format n'est pas supporté ou illisible.
+    """
+    name = filename.lower()
+    if name.endswith('.csv'):
+        dialect = sniff_csv_dialect(path)
+        return dialect, iter_csv_chunks(path, dialect["sep"], dialect["encoding"], chunksize)
+    if name.endswith(('.xls', '.xlsx')):
+        return iter_excel_chunks(path, chunksize, columns)
+    if name.endswith('.txt'):
+        dialect = {"encoding": 'utf-8-sig', "sep": '\t', "bom": False}
+        return dialect, iter_csv_chunks(path, '\t', 'utf-8-sig', chunksize)
+    raise ValueError("Format non supporté")
+
+
+def arrow_schema(schema):
+    """Schéma Arrow équivalent au schéma BigQuery (client.get_table(...).schema)."""
+    return pa.schema([
+        pa.field(f.name, ARROW_TYPES.get(f.field_type, pa.string()), nullable=f.mode != "REQUIRED")
+        for f in schema
+    ])
+
+
+def _to_arrow_array(series, arrow_type):
+    try:
+        return pa.array(series, type=arrow_type, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # ex. float -> NUMERIC, texte ISO -> DATE : conversion via cast Arrow
+        return pa.array(series, from_pandas=True).cast(arrow_type)
+
+
+def chunk_to_arrow(chunk, target_schema):
+    """DataFrame nettoyé -> RecordBatch typé ; colonnes absentes du fichier à NULL."""
+    arrays = []
+    for field in target_schema:
+        if field.name in chunk.columns:
+            arrays.append(_to_arrow_array(chunk[field.name], field.type))
+        else:
+            arrays.append(pa.nulls(len(chunk), type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=target_schema)
+
+
+def staging_path(table_name, folder=STAGING_FOLDER):
+    """Chemin unique du fichier Parquet de transit d'un import."""
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{table_name}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.parquet")
+
+
+def purge_staging(folder=STAGING_FOLDER, retention_days=STAGING_RETENTION_DAYS):
+    """Supprime les fichiers de transit (locaux et dans le bucket) plus anciens que la rétention."""
+    if os.path.isdir(folder):
+        limit = time.time() - retention_days * 86400
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.endswith('.parquet') and os.path.getmtime(path) < limit:
+                os.remove(path)
+    if STAGING_BUCKET:
+        limit = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        try:
+            for prefix in STAGING_PREFIXES:
+                for uri, created in gcs_list(f"gs://{STAGING_BUCKET}/{prefix}/"):
+                    if created < limit:
+                        gcs_delete(uri)
+        except Exception as e:
+            print(f"⚠️ Purge des fichiers de transit du bucket impossible : {e}")
+
+
+def publish_staged(path, prefix="staging"):
+    """
+    Range un fichier qu'un job relira là où toute instance le retrouve :
+    gs://STAGING_BUCKET/prefix/nom (copie locale supprimée), sinon le chemin local.
+    Retourne la référence à mettre dans le payload du job (cf. fetch_staged).
+    """
+    if not STAGING_BUCKET:
+        return path
+    uri = f"gs://{STAGING_BUCKET}/{prefix}/{os.path.basename(path)}"
+    gcs_upload(path, uri)
+    os.remove(path)
+    return uri
+
+
+@contextmanager
+def fetch_staged(ref):
+    """Chemin local d'un fichier publié par publish_staged (objet gs:// : copie
+    temporaire, supprimée à la sortie du bloc)."""
+    if not ref.startswith("gs://"):
+        if not os.path.exists(ref):
+            raise FileNotFoundError(f"Fichier de transit introuvable sur cette instance : {ref}")
+        yield ref
+        return
+    fd, path = tempfile.mkstemp(prefix="transit_", suffix=os.path.splitext(ref)[1])
+    os.close(fd)
+    try:
+        gcs_download(ref, path)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def discard_staged(ref):
+    """Supprime un fichier publié (objet gs:// ou fichier local)."""
+    if ref.startswith("gs://"):
+        gcs_delete(ref)
+    elif os.path.exists(ref):
+        os.remove(ref)
+
+
+def stage_chunks(chunks, schema, path, report=None):
+    """
+    Écrit les morceaux nettoyés dans un fichier Parquet typé selon le schéma BigQuery.
+    Un seul morceau en mémoire à la fois. Retourne le nombre de lignes écrites.
+    report : fonction de progression (cf. progress.py), appelée à chaque morceau ;
+    le journal du serveur n'a qu'une ligne par fichier.
+    """
+    target_schema = arrow_schema(schema)
+    total = n_chunks = 0
+    t0 = time.perf_counter()
+    with pq.ParquetWriter(path, target_schema, compression='snappy') as writer:
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            writer.write_batch(chunk_to_arrow(chunk, target_schema))
+            total += len(chunk)
+            n_chunks += 1
+            if report:
+                report("transit", f"{total} lignes lues, nettoyées et mises en transit", lignes=total)
+    print(f"📦 {total} lignes écrites dans {os.path.basename(path)} "
+          f"({n_chunks} morceau(x), {time.perf_counter() - t0:.1f} s)")
+    return total
+
+
+def load_staged_file(client, path, table_id, schema, write_disposition="WRITE_TRUNCATE"):
+    """Charge un fichier Parquet de transit dans BigQuery (un seul job de chargement)."""
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=write_disposition,
+        schema=schema,
+    )
+    with open(path, 'rb') as fh:
+        job = client.load_table_from_file(fh, table_id, job_config=job_config)
+    job.result()
+    print(f"✅ {job.output_rows} lignes chargées dans {table_id} depuis {os.path.basename(path)}")
+    return job.output_rows
@@ -0,0 +1,347 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, jsonify
+
+from db import get_pg_connection, release_pg_connection
+
+
+# ============================================================
+# ⏱️ FILE DE JOBS DURABLE (imports, synchronisations, générations)
+# ============================================================
+# Chaque traitement lourd est un job persisté (TblJob) exécuté par un pool
+# borné de workers. Chaque instance entretient le battement de cœur de tous
+# les jobs qu'elle détient (en attente comme en cours) ; un job sans battement
+# depuis STALE_AFTER_S (instance Cloud Run arrêtée, redéploiement) est repris
+# par le balayage périodique de n'importe quelle instance (toutes les SWEEP_S).
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+MAX_TENTATIVES = 3
+HEARTBEAT_S = 30
+STALE_AFTER_S = 120
+SWEEP_S = 60
+
+EN_ATTENTE = "en_attente"
+EN_COURS = "en_cours"
+SUCCES = "succes"
+ERREUR = "erreur"
+INTERROMPU = "interrompu"
+
+JOB_FIELDS = [
+    "IdJob", "TypeJob", "Statut", "Payload", "Resultat", "Erreur", "Tentatives",
+    "DateCreation", "DateDebut", "DateFin", "Heartbeat", "Instance",
+]
+
+INSTANCE_ID = f"{os.environ.get('K_REVISION', socket.gethostname())}:{os.getpid()}"
+
+bp_jobs = Blueprint("jobs", __name__)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def job_to_json(job):
+    """Vue JSON d'un job (dates ISO + durée en secondes)."""
+    out = {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in job.items()}
+    debut, fin = job.get("DateDebut"), job.get("DateFin")
+    if debut:
+        out["DureeSecondes"] = round(((fin or _now()) - debut).total_seconds(), 3)
+    return out
+
+
+# ============================================================
+# 💾 STOCKAGES
+# ============================================================
+class MemoryJobStore:
+    """Stockage en mémoire : tests et développement local sans PostgreSQL."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def init(self):
+        pass
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job["IdJob"]] = dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def heartbeat(self, job_ids):
+        now = _now()
+        with self._lock:
+            for job_id in job_ids:
+                if job_id in self._jobs:
+                    self._jobs[job_id]["Heartbeat"] = now
+
+    def claim_stale(self, instance, stale_before):
+        claimed = []
+        with self._lock:
+            for job in self._jobs.values():
+                last_seen = job.get("Heartbeat") or job["DateCreation"]
+                if job["Statut"] in (EN_ATTENTE, EN_COURS) and last_seen < stale_before:
+                    job.update(Instance=instance, Heartbeat=_now())
+                    claimed.append(dict(job))
+        return claimed
+
+
+class PgJobStore:
+    """Stockage PostgreSQL (table TblJob, créée si absente)."""
+
+    def _execute(self, sql, params=(), fetch=False):
+        conn = None
+        try:
+            conn = get_pg_connection()
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall() if fetch else None
+            conn.commit()
+            cur.close()
+            return rows
+        finally:
+            if conn:
+                release_pg_connection(conn)
+
+    def _row_to_job(self, row):
+        job = dict(zip(JOB_FIELDS, row))
+        for key in ("Payload", "Resultat"):
+            if isinstance(job[key], str):
+                job[key] = json.loads(job[key])
+        return job
+
+    def init(self):
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS TblJob (
+                IdJob VARCHAR(36) PRIMARY KEY,
+                TypeJob VARCHAR(64) NOT NULL,
+                Statut VARCHAR(20) NOT NULL,
+                Payload JSONB,
+                Resultat JSONB,
+                Erreur TEXT,
+                Tentatives INTEGER NOT NULL DEFAULT 0,
+                DateCreation TIMESTAMPTZ NOT NULL DEFAULT now(),
+                DateDebut TIMESTAMPTZ,
+                DateFin TIMESTAMPTZ,
+                Heartbeat TIMESTAMPTZ,
+                Instance VARCHAR(128)
+            )
+        """)
+        self._execute("CREATE INDEX IF NOT EXISTS IdxTblJobStatut ON TblJob (Statut)")
+
+    def create(self, job):
+        self._execute(
+            f"INSERT INTO TblJob ({', '.join(JOB_FIELDS)}) VALUES ({', '.join(['%s'] * len(JOB_FIELDS))})",
+            [json.dumps(job[k]) if k in ("Payload", "Resultat") and job[k] is not None else job[k]
+             for k in JOB_FIELDS],
+        )
+
+    def update(self, job_id, **fields):
+        sets = ", ".join(f"{k}=%s" for k in fields)
+        values = [json.dumps(v) if k in ("Payload", "Resultat") and v is not None else v
+                  for k, v in fields.items()]
+        self._execute(f"UPDATE TblJob SET {sets} WHERE IdJob=%s", values + [job_id])
+
+    def get(self, job_id):
+        rows = self._execute(f"SELECT {', '.join(JOB_FIELDS)} FROM TblJob WHERE IdJob=%s", (job_id,), fetch=True)
+        return self._row_to_job(rows[0]) if rows else None
+
+    def heartbeat(self, job_ids):
+        if job_ids:
+            self._execute("UPDATE TblJob SET Heartbeat=now() WHERE IdJob = ANY(%s)", (list(job_ids),))
+
+    def claim_stale(self, instance, stale_before):
+        # UPDATE ... RETURNING : une seule instance récupère un job donné
+        rows = self._execute(f"""
+            UPDATE TblJob SET Instance=%s, Heartbeat=now()
+            WHERE Statut IN (%s, %s) AND COALESCE(Heartbeat, DateCreation) < %s
+            RETURNING {', '.join(JOB_FIELDS)}
+        """, (instance, EN_ATTENTE, EN_COURS, stale_before), fetch=True)
+        return [self._row_to_job(r) for r in rows]
+
+
+# ============================================================
+# ⚙️ FILE D'EXÉCUTION
+# ============================================================
+class JobQueue:
+    """
+    Pool borné de workers + registre des types de jobs.
+    Les handlers reçoivent (payload, job_id) et doivent être rejouables :
+    un job interrompu est relancé tel quel par une autre instance.
+    """
+
+    def __init__(self, store=None, workers=JOB_WORKERS, heartbeat_s=HEARTBEAT_S,
+                 stale_after_s=STALE_AFTER_S, sweep_s=SWEEP_S):
+        self.store = store
+        self.workers = workers
+        self.heartbeat_s = heartbeat_s
+        self.stale_after_s = stale_after_s
+        self.sweep_s = sweep_s
+        self._handlers = {}
+        self._limits = {}
+        self._on_abandon = {}
+        self._owned = set()     # jobs de cette instance, en attente ou en cours (battement de cœur)
+        self._active = {}       # type -> jobs en cours (limite max_concurrent)
+        self._waiting = {}      # type -> deque de jobs en attente d'une place (sans thread du pool)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stop = threading.Event()
+
+    def task(self, kind, max_concurrent=None, on_abandon=None):
+        """Décorateur : enregistre un handler pour un type de job."""
+        def decorator(fn):
+            self._handlers[kind] = fn
+            if max_concurrent:
+                self._limits[kind] = max_concurrent
+            if on_abandon:
+                self._on_abandon[kind] = on_abandon
+            return fn
+        return decorator
+
+    def start(self, store=None):
+        """Démarre le pool, le battement de cœur et le balayage des jobs orphelins
+        (à appeler une fois par processus serveur, pas à l'import)."""
+        if store is not None:
+            self.store = store
+        self.store.init()
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+        print(f"✅ File de jobs démarrée ({self.workers} workers, instance {INSTANCE_ID})")
+        self.recover()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    @property
+    def started(self):
+        return self._executor is not None and not self._stop.is_set()
+
+    def submit(self, kind, payload=None, job_id=None):
+        """Persiste puis planifie un job ; retourne son identifiant."""
+        if kind not in self._handlers:
+            raise ValueError(f"Type de job inconnu : {kind}")
+        if not self.started:
+            raise RuntimeError("File de jobs non démarrée (cf. app.start_background_services)")
+        job_id = job_id or str(uuid.uuid4())
+        job = dict.fromkeys(JOB_FIELDS)
+        job.update(IdJob=job_id, TypeJob=kind, Statut=EN_ATTENTE, Payload=payload or {},
+                   Tentatives=0, DateCreation=_now(), Heartbeat=_now(), Instance=INSTANCE_ID)
+        self.store.create(job)
+        self._dispatch(job_id, kind, payload or {}, 0)
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _dispatch(self, job_id, kind, payload, tentatives):
+        """Confie le job au pool, ou le met de côté si son type a atteint max_concurrent :
+        il est relancé à la fin d'un job du même type, sans occuper de thread en attendant."""
+        with self._lock:
+            self._owned.add(job_id)
+            limit = self._limits.get(kind)
+            if limit and self._active.get(kind, 0) >= limit:
+                self._waiting.setdefault(kind, deque()).append((job_id, payload, tentatives))
+                return
+            self._active[kind] = self._active.get(kind, 0) + 1
+        self._executor.submit(self._run, job_id, kind, payload, tentatives)
+
+    def _run(self, job_id, kind, payload, tentatives):
+        try:
+            self.store.update(job_id, Statut=EN_COURS, DateDebut=_now(), DateFin=None,
+                              Heartbeat=_now(), Instance=INSTANCE_ID, Tentatives=tentatives + 1)
+            print(f"▶️ Job {kind} {job_id} démarré (tentative {tentatives + 1})")
+            try:
+                result = self._handlers[kind](payload, job_id)
+            except Exception as e:
+                traceback.print_exc()
+                self.store.update(job_id, Statut=ERREUR, Erreur=str(e), DateFin=_now())
+                print(f"❌ Job {kind} {job_id} en erreur : {e}")
+            else:
+                self.store.update(job_id, Statut=SUCCES, Resultat=result, Erreur=None, DateFin=_now())
+                print(f"✅ Job {kind} {job_id} terminé")
+        finally:
+            with self._lock:
+                self._owned.discard(job_id)
+                self._active[kind] -= 1
+                waiting = self._waiting.get(kind)
+                following = waiting.popleft() if waiting else None
+            if following:
+                self._dispatch(following[0], kind, *following[1:])
+
+    def owned(self):
+        with self._lock:
+            return set(self._owned)
+
+    def heartbeat(self):
+        """Un battement de cœur pour tous les jobs détenus (en attente compris)."""
+        try:
+            self.store.heartbeat(self.owned())
+        except Exception as e:
+            print(f"⚠️ Heartbeat jobs impossible : {e}")
+
+    def _heartbeat_loop(self):
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.heartbeat_s):
+            self.heartbeat()
+            if time.monotonic() - last_sweep >= self.sweep_s:
+                last_sweep = time.monotonic()
+                try:
+                    self.recover()
+                except Exception as e:
+                    print(f"⚠️ Reprise des jobs orphelins impossible : {e}")
+
+    def recover(self):
+        """Relance (ou abandonne après MAX_TENTATIVES) les jobs orphelins d'une instance arrêtée."""
+        stale_before = _now() - timedelta(seconds=self.stale_after_s)
+        mine = self.owned()
+        for job in self.store.claim_stale(INSTANCE_ID, stale_before):
+            kind, job_id = job["TypeJob"], job["IdJob"]
+            if job_id in mine:
+                continue   # battement en retard d'un job de cette instance : il tourne ou attend déjà ici
+            if kind not in self._handlers or job["Tentatives"] >= MAX_TENTATIVES:
+                self.store.update(job_id, Statut=INTERROMPU, DateFin=_now(),
+                                  Erreur="Job interrompu (arrêt de l'instance), abandonné.")
+                print(f"🛑 Job {kind} {job_id} abandonné après {job['Tentatives']} tentative(s)")
+                if kind in self._on_abandon:
+                    try:
+                        self._on_abandon[kind](job["Payload"] or {}, job_id)
+                    except Exception as e:
+                        print(f"⚠️ Nettoyage du job {job_id} impossible : {e}")
+                continue
+            self.store.update(job_id, Statut=EN_ATTENTE)
+            self._dispatch(job_id, kind, job["Payload"] or {}, job["Tentatives"])
+            print(f"🔁 Job {kind} {job_id} repris")
+
+
+job_queue = JobQueue()
+
+
+# ============================================================
+# 🔎 API : état d'un job
+# ============================================================
+@bp_jobs.route("/api/jobs/<job_id>", methods=["GET"])
+def api_job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job introuvable."}), 404
+    return jsonify(job_to_json(job))
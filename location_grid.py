@@ -0,0 +1,231 @@
+import numpy as np
+import pandas as pd
+
+
+# ============================================================
+# 🧱 GRILLE DENSE PAR ALLÉE (Zone, Allée) : Déplacement × Niveau
+# ============================================================
+# Une allée est un rectangle presque plein : chaque (Zone, Allée) est rangée
+# dans des matrices NumPy indexées par (Déplacement - dep0, Niveau - niv0)
+# (dimensions, coordonnées, types ; NaN / None pour une case vide).
+# Une plage « du déplacement .. au déplacement, du niveau .. au niveau » est
+# alors une tranche de matrices (vue, sans copie) au lieu d'un filtre ou d'une
+# requête ; l'aperçu des coordonnées de la modification en masse se calcule
+# par sommes cumulées sur cette tranche.
+# Construite à partir de l'instantané (cf. emplacement_snapshot.get_grid) ;
+# après une écriture, seules les allées touchées sont reconstruites.
+
+GRID_VALUE_COLUMNS = ("Profondeur", "Largeur", "Hauteur", "PoidsLimiteUnitaire", "X", "Y", "Z")
+GRID_TYPE_COLUMNS = ("Type1", "Type2", "Type3")
+GRID_MAX_CELLS = 200_000     # allée trop creuse (numérotation éclatée) : laissée au filtre de l'instantané
+DEFAULT_SIZE_M = 0.8         # dimension absente ou nulle dans l'aperçu (même règle que la page)
+
+
+def aisle_key(zone, allee):
+    return str(zone).strip().lower(), int(allee)
+
+
+def _numeric(series):
+    return pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
+
+
+class GridWindow:
+    """Tranche d'une allée : deps / nivs (axes), present (bool), values / types (matrices alignées)."""
+
+    def __init__(self, zone, allee, deps, nivs, present, values, types):
+        self.zone = zone
+        self.allee = allee
+        self.deps = deps
+        self.nivs = nivs
+        self.present = present
+        self.values = values
+        self.types = types
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def cells(self):
+        """(déplacements, niveaux, positions) des cases occupées, triées par déplacement puis niveau."""
+        di, ni = np.nonzero(self.present)
+        return self.deps[di], self.nivs[ni], (di, ni)
+
+    def dimensions(self):
+        """Dimensions en mètres (stockées en cm), format de /api/detail_emplacement/dimensions."""
+        deps, nivs, pos = self.cells()
+        sizes = {name: self.values[col][pos] / 100.0
+                 for name, col in (("profondeur", "Profondeur"), ("largeur", "Largeur"), ("hauteur", "Hauteur"))}
+        return [
+            {
+                "Zone": self.zone, "Allee": self.allee,
+                "Deplacement": int(d), "Niveau": int(n),
+                **{name: (None if np.isnan(v[i]) else float(v[i])) for name, v in sizes.items()},
+            }
+            for i, (d, n) in enumerate(zip(deps, nivs))
+        ]
+
+
+class AisleGrid:
+    """Matrices denses d'une allée."""
+
+    def __init__(self, zone, allee, frame):
+        self.zone = zone
+        self.allee = int(allee)
+        deps = _numeric(frame["Deplacement"])
+        nivs = _numeric(frame["Niveau"])
+        ok = ~(np.isnan(deps) | np.isnan(nivs))
+        deps, nivs = deps[ok].astype(np.int64), nivs[ok].astype(np.int64)
+        frame = frame[ok]
+
+        if len(deps):
+            self.dep0, self.niv0 = int(deps.min()), int(nivs.min())
+            shape = (int(deps.max()) - self.dep0 + 1, int(nivs.max()) - self.niv0 + 1)
+        else:
+            self.dep0, self.niv0, shape = 0, 0, (0, 0)
+        self.shape = shape
+        di, ni = deps - self.dep0, nivs - self.niv0
+
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[di, ni] = True
+        self.values = {}
+        for col in GRID_VALUE_COLUMNS:
+            m = np.full(shape, np.nan)
+            if col in frame:
+                m[di, ni] = _numeric(frame[col])
+            self.values[col] = m
+        self.types = {}
+        for col in GRID_TYPE_COLUMNS:
+            m = np.full(shape, None, dtype=object)
+            if col in frame:
+                s = frame[col].astype(object)
+                m[di, ni] = s.where(s.notna(), None).to_numpy()
+            self.types[col] = m
+
+    @staticmethod
+    def cells_needed(frame):
+        deps, nivs = _numeric(frame["Deplacement"]), _numeric(frame["Niveau"])
+        if np.isnan(deps).all() or np.isnan(nivs).all():
+            return 0
+        return int((np.nanmax(deps) - np.nanmin(deps) + 1) * (np.nanmax(nivs) - np.nanmin(nivs) + 1))
+
+    def window(self, dep_from, dep_to, niv_from, niv_to):
+        """Tranche [dep_from..dep_to] × [niv_from..niv_to] (bornes incluses, vues sur les matrices)."""
+        d0 = min(max(int(dep_from) - self.dep0, 0), self.shape[0])
+        d1 = min(max(int(dep_to) - self.dep0 + 1, d0), self.shape[0])
+        n0 = min(max(int(niv_from) - self.niv0, 0), self.shape[1])
+        n1 = min(max(int(niv_to) - self.niv0 + 1, n0), self.shape[1])
+        sl = (slice(d0, d1), slice(n0, n1))
+        return GridWindow(
+            self.zone, self.allee,
+            np.arange(self.dep0 + d0, self.dep0 + d1), np.arange(self.niv0 + n0, self.niv0 + n1),
+            self.present[sl],
+            {col: m[sl] for col, m in self.values.items()},
+            {col: m[sl] for col, m in self.types.items()},
+        )
+
+
+class LocationGrid:
+    """Allées de l'instantané ; en lecture seule, updated() retourne une nouvelle grille."""
+
+    def __init__(self, aisles=None, skipped=None):
+        self._aisles = aisles or {}
+        self._skipped = skipped or set()
+
+    @classmethod
+    def build(cls, frame):
+        grid = cls()
+        grid._add(frame)
+        return grid
+
+    def updated(self, frame, aisles):
+        """Nouvelle grille où les allées [(zone, allée)] sont reconstruites depuis frame."""
+        aisles = {aisle_key(*a) for a in aisles}
+        new = LocationGrid({k: v for k, v in self._aisles.items() if k not in aisles},
+                           self._skipped - aisles)
+        zones = frame["Zone"].astype(str).str.strip().str.lower()
+        allees = pd.to_numeric(frame["Allee"], errors="coerce")
+        mask = np.zeros(len(frame), dtype=bool)
+        for zone, allee in aisles:
+            mask |= ((zones == zone) & (allees == allee)).to_numpy()
+        new._add(frame[mask])
+        return new
+
+    def _add(self, frame):
+        if not len(frame):
+            return
+        frame = frame.assign(_zone=frame["Zone"].astype(str).str.strip().str.lower(),
+                             _allee=pd.to_numeric(frame["Allee"], errors="coerce"))
+        frame = frame[frame["_allee"].notna()]
+        for (zone, allee), rows in frame.groupby(["_zone", "_allee"], sort=False, observed=True):
+            key = aisle_key(zone, allee)
+            if AisleGrid.cells_needed(rows) > GRID_MAX_CELLS:
+                self._skipped.add(key)
+                continue
+            self._aisles[key] = AisleGrid(str(rows["Zone"].iloc[0]).strip(), allee, rows)
+
+    def __len__(self):
+        return len(self._aisles)
+
+    def window(self, zone, allee, dep_from, dep_to, niv_from, niv_to):
+        """Tranche d'une allée ; None si l'allée n'est pas dans la grille (trop creuse)."""
+        key = aisle_key(zone, allee)
+        if key in self._skipped:
+            return None
+        aisle = self._aisles.get(key)
+        if aisle is None:
+            return AisleGrid(zone, allee, pd.DataFrame({"Deplacement": [], "Niveau": []})).window(0, -1, 0, -1)
+        return aisle.window(dep_from, dep_to, niv_from, niv_to)
+
+
+def preview_coordinates(window, parity=None, x_ref=None, y_ref=None, z_ref=None,
+                        espacement=0.0, hauteur_lisse=0.0, orientation="X", niv_from=None):
+    """
+    Aperçu de la modification en masse des coordonnées sur une tranche :
+     - parity : "pair" / "impair" (déplacements gardés) ou None
+     - X ou Y (selon orientation) avance de espacement + largeur de la 1re case
+       de chaque nouveau déplacement ; Z repart de z_ref à chaque déplacement et
+       monte de hauteur + hauteur_lisse à chaque niveau au-dessus de niv_from.
+    Sans x_ref/y_ref/z_ref : dimensions seules (X, Y, Z à None).
+    """
+    present = window.present.copy()
+    if parity == "pair":
+        present &= (window.deps % 2 == 0)[:, None]
+    elif parity == "impair":
+        present &= (window.deps % 2 != 0)[:, None]
+
+    def size_m(col):
+        v = window.values[col] / 100.0
+        return np.where(np.isnan(v) | (v == 0), DEFAULT_SIZE_M, v)
+
+    profondeur, largeur, hauteur = size_m("Profondeur"), size_m("Largeur"), size_m("Hauteur")
+    has_xyz = x_ref is not None and y_ref is not None and z_ref is not None
+    if has_xyz:
+        # Pas horizontal : à chaque déplacement occupé (sauf le premier), espacement + largeur de sa 1re case
+        columns = np.flatnonzero(present.any(axis=1))
+        first_row = present.argmax(axis=1)
+        step = np.zeros(len(window.deps))
+        step[columns] = espacement + largeur[columns, first_row[columns]]
+        if len(columns):
+            step[columns[0]] = 0.0
+        offset = np.cumsum(step)
+        flat = np.zeros_like(offset)
+        xs = x_ref + (offset if orientation == "X" else flat)
+        ys = y_ref + (flat if orientation == "X" else offset)
+        # Pas vertical : hauteur + lisse à chaque case occupée au-dessus du niveau de départ
+        rise = np.where(present & (window.nivs != niv_from)[None, :], hauteur + hauteur_lisse, 0.0)
+        zs = z_ref + np.cumsum(rise, axis=1)
+
+    di, ni = np.nonzero(present)
+    rows = []
+    for d, n in zip(di, ni):
+        row = {
+            "Zone": window.zone, "Allee": window.allee,
+            "Deplacement": int(window.deps[d]), "Niveau": int(window.nivs[n]),
+            "X": None, "Y": None, "Z": None,
+            "profondeur": round(float(profondeur[d, n]), 3),
+            "largeur": round(float(largeur[d, n]), 3),
+            "hauteur": round(float(hauteur[d, n]), 3),
+        }
+        if has_xyz:
+            row.update(X=round(float(xs[d]), 3), Y=round(float(ys[d]), 3), Z=round(float(zs[d, n]), 3))
+        rows.append(row)
+    return rows
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+# ============================================================
+# 🔎 INDEX DE RECHERCHE DES EMPLACEMENTS
+# ============================================================
+# Recherche globale de la grille sur les libellés Z-AAA-DDDD-NN et les types :
+#  - libellés : tableau trié de tous les suffixes (suffix array). Une sous-chaîne
+#    est le préfixe d'un suffixe : deux recherches dichotomiques suffisent ;
+#    un préfixe de libellé est un suffixe commençant en position 0
+#  - types : peu de valeurs distinctes, chacune associée à ses lignes
+# Les lignes sont désignées par un identifiant entier stable (colonne _Id de
+# l'instantané) : le résultat est un tableau d'identifiants, pas un ensemble Python.
+# Mises à jour incrémentales : identifiants retirés (pierres tombales) + petit
+# delta parcouru linéairement ; au-delà de DELTA_MAX, l'index est reconstruit.
+
+DELTA_MAX = 2000
+_HIGH = "\U0010ffff"  # borne haute : tout suffixe commençant par le terme est < terme + _HIGH
+
+
+class LocationSearchIndex:
+    """Index en lecture seule ; updated() retourne un nouvel index (lecteurs en cours intacts)."""
+
+    def __init__(self, ids, labels, types):
+        """ids, labels : séquences alignées (identifiant de ligne, libellé) ; types : [séquence alignée] par colonne."""
+        self._ids = np.asarray(ids, dtype=np.int64)
+        labels = [str(label).lower() for label in labels]
+
+        lengths = np.fromiter((len(label) for label in labels), dtype=np.int64, count=len(labels))
+        suffixes = np.array([label[i:] for label in labels for i in range(len(label))], dtype=str)
+        owners = np.repeat(np.arange(len(labels)), lengths)
+        offsets = np.arange(len(suffixes)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        order = np.argsort(suffixes, kind="stable")
+        self._suffixes = suffixes[order]
+        self._owners = owners[order]
+        self._at_start = offsets[order] == 0
+
+        self._types = {}
+        for column in types:
+            values = np.array([str(v).lower() if v is not None else "" for v in column], dtype=object)
+            for value in set(values) - {""}:
+                rows = np.flatnonzero(values == value)
+                self._types[value] = np.concatenate([self._types[value], rows]) if value in self._types else rows
+
+        self._removed = np.empty(0, dtype=np.int64)
+        self._delta = {}  # identifiant -> [libellé, types...] en minuscules (lignes ajoutées depuis la construction)
+
+    @classmethod
+    def build(cls, ids, labels, types):
+        return cls(ids, labels, types)
+
+    @property
+    def delta_size(self):
+        return len(self._removed) + len(self._delta)
+
+    def updated(self, removed_ids, ids, labels, types):
+        """
+        Nouvel index où removed_ids sont retirés et (ids, labels, types) ajoutés.
+        Les structures triées sont partagées avec l'index d'origine.
+        """
+        removed_ids = np.asarray(removed_ids, dtype=np.int64)
+        new = object.__new__(LocationSearchIndex)
+        new.__dict__.update(self.__dict__)
+        new._removed = np.union1d(self._removed, removed_ids)
+        gone = set(removed_ids.tolist())
+        new._delta = {i: v for i, v in self._delta.items() if i not in gone}
+        for i, row_id in enumerate(ids):
+            texts = [str(labels[i]).lower()] + [str(col[i]).lower() for col in types if col[i] is not None]
+            new._delta[int(row_id)] = texts
+        return new
+
+    def lookup(self, term, prefix=False):
+        """
+        Identifiants des lignes dont le libellé contient term (ou commence par
+        term si prefix), ou dont un type contient term. Casse ignorée.
+        """
+        term = str(term or "").strip().lower()
+        if not term:
+            return np.empty(0, dtype=np.int64)
+
+        lo = np.searchsorted(self._suffixes, term, side="left")
+        hi = np.searchsorted(self._suffixes, term + _HIGH, side="left")
+        rows = self._owners[lo:hi]
+        if prefix:
+            rows = rows[self._at_start[lo:hi]]
+
+        hit = np.zeros(len(self._ids), dtype=bool)
+        hit[rows] = True
+        if not prefix:
+            for value, rows_of in self._types.items():
+                if term in value:
+                    hit[rows_of] = True
+
+        found = self._ids[hit]
+        if len(self._removed):
+            found = found[~np.isin(found, self._removed)]
+        extra = [i for i, texts in self._delta.items()
+                 if (texts[0].startswith(term) if prefix else any(term in t for t in texts))]
+        if extra:
+            found = np.concatenate([found, np.asarray(extra, dtype=np.int64)])
+        return found
@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+from flask import Blueprint, Response, request, stream_with_context
+
+from jobs import job_queue, job_to_json, SUCCES, ERREUR, INTERROMPU
+
+
+# ============================================================
+# 📡 PROGRESSION DES IMPORTS (Server-Sent Events)
+# ============================================================
+# Les étapes d'un import (lecture, nettoyage, transit, chargement, MERGE) sont
+# publiées sur un canal (identifiant de l'import = identifiant du job) et
+# diffusées en SSE à la page d'import : plus besoin de recharger l'historique.
+
+PROGRESS_TTL_S = 3600        # canaux terminés conservés 1 h (reconnexion / rechargement)
+KEEPALIVE_S = 15             # commentaire SSE pour garder la connexion ouverte
+RETRY_MS = 3000              # délai de reconnexion du navigateur
+FINAL_STAGES = ("termine", "erreur", "ignore")
+
+bp_progress = Blueprint("progress", __name__)
+
+
+class ProgressHub:
+    """Canaux d'événements en mémoire ; chaque abonné relit depuis son dernier id."""
+
+    def __init__(self):
+        self._channels = {}
+        self._cond = threading.Condition()
+
+    def publish(self, channel, stage, message, **data):
+        if not channel:
+            return
+        now = time.monotonic()
+        with self._cond:
+            ch = self._channels.setdefault(channel, {"debut": now, "events": [], "maj": now})
+            event = dict(data, id=len(ch["events"]), etape=stage, message=message,
+                         ecoule=round(now - ch["debut"], 2))
+            ch["events"].append(event)
+            ch["maj"] = now
+            self._purge(now)
+            self._cond.notify_all()
+        print(f"📡 [{channel[:8]}] {stage} : {message} ({event['ecoule']} s)")
+
+    def reporter(self, channel):
+        """Fonction report(etape, message, **data) liée à un canal (None : ne publie rien)."""
+        return lambda stage, message, **data: self.publish(channel, stage, message, **data)
+
+    def known(self, channel):
+        with self._cond:
+            return channel in self._channels
+
+    def wait_events(self, channel, last_id, timeout=KEEPALIVE_S):
+        """Événements postérieurs à last_id (attend jusqu'à timeout s'il n'y en a pas)."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self._channels.get(channel, {"events": []})["events"]) > last_id + 1,
+                timeout=timeout,
+            )
+            return list(self._channels.get(channel, {"events": []})["events"][last_id + 1:])
+
+    def _purge(self, now):
+        for name in [n for n, ch in self._channels.items() if now - ch["maj"] > PROGRESS_TTL_S]:
+            del self._channels[name]
+
+
+progress_hub = ProgressHub()
+
+
+def _sse(event, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}data: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+
+
+def _job_event(job):
+    """Canal inconnu de cette instance : état du job lu dans le stockage des jobs."""
+    statut = job["Statut"]
+    stage = {SUCCES: "termine", ERREUR: "erreur", INTERROMPU: "erreur"}.get(statut, "job")
+    return {"etape": stage, "message": f"Job {statut}", "job": job_to_json(job)}
+
+
+# ============================================================
+# 🔎 API : flux SSE d'un import
+# ============================================================
+@bp_progress.route("/api/progress/<channel>", methods=["GET"])
+def api_progress_stream(channel):
+    try:
+        last_id = int(request.headers.get("Last-Event-ID", -1))
+    except ValueError:
+        last_id = -1
+
+    @stream_with_context
+    def generate():
+        yield f"retry: {RETRY_MS}\n\n"
+
+        if not progress_hub.known(channel):
+            # Import pas encore commencé, ou lancé par une autre instance (ou avant un
+            # redémarrage) : on renvoie l'état du job puis on ferme ; le navigateur se
+            # reconnecte après RETRY_MS
+            job = job_queue.get(channel)
+            event = _job_event(job) if job else {"etape": "attente", "message": "En attente du démarrage de l'import..."}
+            yield _sse(event)
+            return
+
+        current = last_id
+        while True:
+            events = progress_hub.wait_events(channel, current)
+            if not events:
+                if not progress_hub.known(channel):
+                    return  # canal purgé
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                current = event["id"]
+                yield _sse(event, current)
+                if event["etape"] in FINAL_STAGES:
+                    return
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -8,6 +8,9 @@ from psycopg2.extras import RealDictCursor
 
 # 🔐 Import de la gestion du pool PostgreSQL
 from db import get_pg_connection, release_pg_connection
+from emplacement_snapshot import emplacement_snapshot, frame_records, location_labels
+from jobs import job_queue
+from sync_engine import table_changed
 
 
 bp_routes = Blueprint("routes", __name__)
@@ -22,6 +25,27 @@ def page_localisation_routes():
 # =============================================================
 # 📋 Liste des zones, allées, emplacements, et types d'engins
 # =============================================================
+# Source unique des coordonnées : l'instantané de TblEmplacement (BigQuery, où
+# écrivent imports et éditions). L'éditeur affiche et la génération des routes
+# secondaires utilise les mêmes X / Y / Z.
+def _emplacements_frame(zones=None):
+    """Emplacements complets (clé renseignée) lus dans l'instantané en mémoire (cf. emplacement_snapshot.py)."""
+    frame, _ = emplacement_snapshot.get()
+    frame = frame.dropna(subset=["Zone", "Allee", "Deplacement", "Niveau"])
+    if zones is not None:
+        frame = frame[frame["Zone"].astype(str).isin(zones)]
+    return pd.DataFrame({
+        "Zone": frame["Zone"].astype(str),
+        "Allee": frame["Allee"].astype("int64"),
+        "Deplacement": frame["Deplacement"].astype("int64"),
+        "Niveau": frame["Niveau"].astype("int64"),
+        "X": pd.to_numeric(frame["X"], errors="coerce").fillna(0).astype(float),
+        "Y": pd.to_numeric(frame["Y"], errors="coerce").fillna(0).astype(float),
+        "Z": pd.to_numeric(frame["Z"], errors="coerce").fillna(0).astype(float),
+        "label": location_labels(frame),
+    })
+
+
 @bp_routes.route("/api/routes/lists")
 def api_lists():
     conn = None
@@ -29,26 +53,8 @@ def api_lists():
         conn = get_pg_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        # Emplacements
-        cur.execute("""
-            SELECT Zone, Allee, Deplacement, Niveau, X, Y, Z
-            FROM TblEmplacement
-            WHERE Zone IS NOT NULL AND Allee IS NOT NULL
-        """)
-        emps = cur.fetchall()
-
-        emplacements = []
-        for r in emps:
-            emplacements.append({
-                "Zone": r["zone"],
-                "Allee": int(r["allee"]),
-                "Deplacement": int(r["deplacement"]),
-                "Niveau": int(r["niveau"]),
-                "X": float(r["x"] or 0),
-                "Y": float(r["y"] or 0),
-                "Z": float(r["z"] or 0),
-                "label": f"{r['zone']}-{str(r['allee']).zfill(3)}-{str(r['deplacement']).zfill(4)}-{str(r['niveau']).zfill(2)}"
-            })
+        # Emplacements : instantané en mémoire (même source que la génération des routes)
+        emplacements = frame_records(_emplacements_frame())
 
         zones = sorted(list({r["Zone"] for r in emplacements}))
         allees = sorted(list({r["Allee"] for r in emplacements}))
@@ -169,11 +175,15 @@ def add_route_simple():
         ))
 
         conn.commit()
+        table_changed("TblRouteSimple", [IdRoute])
 
-        # Appel création routes secondaires
-        _create_routes_secondaires(IdRoute, emp1, emp2, largeur_allee, type_engin, sens_unique, sens_direction)
+        # Création des routes secondaires en job (cf. /api/jobs/<id>)
+        job_id = job_queue.submit("routes_secondaires", {
+            "id_principale": IdRoute, "emp1": emp1, "emp2": emp2, "largeur": largeur_allee,
+            "type_engin": type_engin, "sens_unique": sens_unique, "sens_direction": sens_direction,
+        })
 
-        return jsonify({"status": "success", "message": "Route ajoutée"})
+        return jsonify({"status": "success", "message": "Route ajoutée", "job": job_id})
 
     except Exception as e:
         import traceback
@@ -209,6 +219,7 @@ def update_route_simple(id_route):
         values.append(id_route)
         cur.execute(f"UPDATE TblRouteSimple SET {', '.join(updates)} WHERE IdRoute=%s", values)
         conn.commit()
+        table_changed("TblRouteSimple", [id_route])
 
         return jsonify({"status": "success", "message": "Route mise à jour"})
 
@@ -229,6 +240,7 @@ def delete_route_simple(id):
         cur = conn.cursor()
         cur.execute("DELETE FROM TblRouteSimple WHERE IdRoute=%s", (id,))
         conn.commit()
+        table_changed("TblRouteSimple", [id])
         return jsonify({"message": "✅ Route supprimée"}), 200
 
     except Exception as e:
@@ -249,18 +261,13 @@ def _create_routes_secondaires(id_principale, emp1, emp2, largeur, type_engin, s
         conn = get_pg_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        cur.execute("""
-            SELECT Zone, Allee, Deplacement, Niveau, X, Y, Z
-            FROM TblEmplacement
-            WHERE Zone IN (%s, %s)
-        """, (emp1["Zone"], emp2["Zone"]))
-        emps = cur.fetchall()
-
-        if not emps:
+        # Coordonnées lues dans l'instantané, comme celles affichées par l'éditeur (api_lists)
+        df = _emplacements_frame({str(emp1["Zone"]), str(emp2["Zone"])})
+        if df.empty:
             print("⚠️ Aucun emplacement trouvé pour les zones concernées.")
             return
 
-        df = pd.DataFrame(emps).sort_values(["zone", "allee", "deplacement"])
+        df = df.drop(columns="label").rename(columns=str.lower).sort_values(["zone", "allee", "deplacement"])
 
         routes = []
         for (zone, allee, niveau), grp in df.groupby(["zone", "allee", "niveau"]):
@@ -288,6 +295,8 @@ def _create_routes_secondaires(id_principale, emp1, emp2, largeur, type_engin, s
                     largeur, type_engin, sens_unique, sens_direction
                 ))
 
+        # Même transaction : un job rejoué (reprise, double réclamation) remplace ses routes au lieu de les dupliquer
+        cur.execute("DELETE FROM TblRouteSecondaire WHERE IdRoutePrincipale=%s", (id_principale,))
         cur.executemany("""
             INSERT INTO TblRouteSecondaire (
                 IdRouteSecondaire, IdRoutePrincipale, TypeRoute, Zone, Allee, Cote,
@@ -297,14 +306,26 @@ def _create_routes_secondaires(id_principale, emp1, emp2, largeur, type_engin, s
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
         """, routes)
         conn.commit()
+        table_changed("TblRouteSecondaire", [id_principale])
         print(f"✅ {len(routes)} routes secondaires créées.")
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("Erreur génération routes secondaires :", e)
+        raise
 
     finally:
         if conn:
             cur.close()
             release_pg_connection(conn)
+
+
+@job_queue.task("routes_secondaires")
+def job_routes_secondaires(payload, job_id):
+    # Suppression + insertion en une seule transaction : un job interrompu peut être rejoué sans doublon
+    _create_routes_secondaires(
+        payload["id_principale"], payload["emp1"], payload["emp2"], payload["largeur"],
+        payload["type_engin"], payload["sens_unique"], payload["sens_direction"],
+    )
+    return {"IdRoute": payload["id_principale"]}
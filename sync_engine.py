@@ -0,0 +1,368 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+from import_pipeline import load_staged_file, stage_chunks, staging_path
+
+
+# ============================================================
+# 🔁 IMPORTS DIFFÉRENTIELS (manifeste d'empreintes par clé)
+# ============================================================
+# Après chaque synchronisation réussie, on conserve localement l'empreinte de
+# chaque ligne envoyée, par clé métier. À l'import suivant, seules les lignes
+# nouvelles ou modifiées partent vers BigQuery. Le manifeste n'est valable que
+# si la table n'a pas été modifiée entre-temps (date de modification BigQuery).
+
+MANIFEST_FOLDER = os.path.join('uploads', 'manifests')
+ROW_NUMBER_COL = "_Ligne"
+FINGERPRINT_COL = "_Empreinte"
+
+
+def _manifest_path(table_name, folder=MANIFEST_FOLDER):
+    return os.path.join(folder, f"{table_name}.parquet")
+
+
+def fingerprint_staged(path, key_cols):
+    """
+    Empreinte (uint64) de chaque ligne du fichier de transit, dédoublonné par clé
+    (dernière ligne du fichier gagnante, comme le MERGE).
+    Retourne un DataFrame [clés..., _Ligne, _Empreinte].
+    """
+    parts = []
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=100_000):
+        df = batch.to_pandas()
+        value_cols = [c for c in df.columns if c != ROW_NUMBER_COL]
+        fp = pd.util.hash_pandas_object(df[value_cols], index=False).to_numpy()
+        part = df[key_cols + [ROW_NUMBER_COL]].copy()
+        part[FINGERPRINT_COL] = fp
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns=key_cols + [ROW_NUMBER_COL, FINGERPRINT_COL])
+    fps = pd.concat(parts, ignore_index=True)
+    return fps.sort_values(ROW_NUMBER_COL).drop_duplicates(subset=key_cols, keep="last")
+
+
+def load_manifest(table_name, table_modified, folder=MANIFEST_FOLDER):
+    """Manifeste de la dernière synchronisation, ou None s'il est absent ou périmé."""
+    path = _manifest_path(table_name, folder)
+    if not os.path.exists(path):
+        return None
+    table = pq.read_table(path)
+    version = (table.schema.metadata or {}).get(b"table_modified", b"").decode()
+    if version != str(table_modified):
+        print(f"ℹ️ Manifeste {table_name} périmé (table modifiée depuis), import complet.")
+        return None
+    return table.to_pandas()
+
+
+def diff_against_manifest(fingerprints, manifest, key_cols):
+    """
+    Compare les empreintes du fichier au manifeste.
+    Retourne (numéros _Ligne à envoyer, {"inseres", "modifies", "inchanges"}) ;
+    sans manifeste, toutes les lignes sont envoyées et les compteurs valent None.
+    """
+    if manifest is None:
+        return fingerprints[ROW_NUMBER_COL].to_numpy(), None
+
+    previous = manifest[key_cols + [FINGERPRINT_COL]].astype({FINGERPRINT_COL: "UInt64"})
+    merged = fingerprints.merge(previous, on=key_cols, how="left", suffixes=("", "_prec"), indicator=True)
+    nouveaux = (merged["_merge"] == "left_only").to_numpy()
+    prev = merged[FINGERPRINT_COL + "_prec"].fillna(0).astype("uint64").to_numpy()
+    modifies = (~nouveaux) & (merged[FINGERPRINT_COL].astype("uint64").to_numpy() != prev)
+    lignes = merged.loc[nouveaux | modifies, ROW_NUMBER_COL].to_numpy()
+    counts = {
+        "inseres": int(nouveaux.sum()),
+        "modifies": int(modifies.sum()),
+        "inchanges": int(len(merged) - nouveaux.sum() - modifies.sum()),
+    }
+    return lignes, counts
+
+
+def write_delta_file(staged_path, lignes, delta_path):
+    """Recopie dans delta_path les seules lignes du fichier de transit à envoyer."""
+    source = pq.ParquetFile(staged_path)
+    keep = pa.array(np.sort(lignes))
+    total = 0
+    with pq.ParquetWriter(delta_path, source.schema_arrow, compression='snappy') as writer:
+        for batch in source.iter_batches(batch_size=100_000):
+            mask = pc.is_in(batch.column(ROW_NUMBER_COL), value_set=keep)
+            filtered = batch.filter(mask)
+            if filtered.num_rows:
+                writer.write_batch(filtered)
+                total += filtered.num_rows
+    return total
+
+
+def save_manifest(table_name, fingerprints, previous, key_cols, table_modified, folder=MANIFEST_FOLDER):
+    """
+    Enregistre le manifeste après une synchronisation réussie : empreintes du
+    fichier, complétées par les clés absentes du fichier (toujours en table).
+    """
+    os.makedirs(folder, exist_ok=True)
+    current = fingerprints[key_cols + [FINGERPRINT_COL]]
+    if previous is not None:
+        current = pd.concat([previous[key_cols + [FINGERPRINT_COL]], current], ignore_index=True)
+        current = current.drop_duplicates(subset=key_cols, keep="last")
+    table = pa.Table.from_pandas(current, preserve_index=False)
+    table = table.replace_schema_metadata({"table_modified": str(table_modified)})
+    tmp_path = _manifest_path(table_name, folder) + ".tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, _manifest_path(table_name, folder))
+
+
+def discard_manifest(table_name, folder=MANIFEST_FOLDER):
+    path = _manifest_path(table_name, folder)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# ============================================================
+# 🔑 UPSERT PAR CLÉ (MERGE généré pour chaque table)
+# ============================================================
+# Chaque table importable déclare sa clé métier : l'import met à jour / insère
+# les lignes du fichier sans toucher aux autres (extraction partielle sans risque).
+# Les tables absentes de cette configuration restent en remplacement complet.
+
+UPSERT_KEYS = {
+    "TblEmplacement": ["Zone", "Allee", "Deplacement", "Niveau"],
+    "TblPicking": ["Zone", "Allee", "Deplacement", "Niveau"],
+    "TblProduit": ["Reference"],
+    "TblPrevision": ["Reference"],
+    "TblReception": ["Reference"],
+}
+
+# Filet de sécurité : une table temporaire orpheline (job interrompu) expire seule
+TEMP_TABLE_TTL_HOURS = 24
+
+_table_locks = {}
+_table_locks_guard = threading.Lock()
+
+
+def upsert_key(table_name):
+    """Clé métier de la table, ou None si la table est importée en remplacement complet."""
+    return UPSERT_KEYS.get(table_name)
+
+
+def _table_lock(table_name):
+    # Deux MERGE simultanés sur la même table se gênent (conflits DML, manifeste) :
+    # on les sérialise par table, les autres tables restent en parallèle
+    with _table_locks_guard:
+        return _table_locks.setdefault(table_name, threading.Lock())
+
+
+def describe_dropped(nb_sans_cle, key_cols):
+    """Message du bilan pour les lignes écartées par keyed_chunks (None s'il n'y en a pas)."""
+    if not nb_sans_cle:
+        return None
+    return f"{nb_sans_cle} ligne(s) écartée(s) : clé {', '.join(key_cols)} vide ou incomplète"
+
+
+def temp_table_id(project, dataset, table_name, job_id):
+    """Table temporaire propre à un job : deux imports simultanés ne se marchent pas dessus."""
+    return f"{project}.{dataset}._Temp_{table_name}_{job_id.replace('-', '')[:12]}"
+
+
+def keyed_chunks(chunks, key_cols, stats=None):
+    """
+    Écarte les lignes dont une colonne clé est vide (elles ne pourraient jamais
+    être rapprochées) et numérote les lignes (_Ligne) pour dédoublonner dans le MERGE.
+    stats : dict complété au fil de l'eau — "sans_cle" : lignes écartées, à signaler
+    dans le bilan de l'import (TblHistoriqueImport.NbSansCle).
+    """
+    if stats is not None:
+        stats.setdefault("sans_cle", 0)
+    offset = 0
+    for chunk in chunks:
+        missing = [k for k in key_cols if k not in chunk.columns]
+        if missing:
+            raise ValueError(f"Colonne(s) clé absente(s) du fichier : {', '.join(missing)}")
+        mask = np.ones(len(chunk), dtype=bool)
+        for k in key_cols:
+            col = chunk[k]
+            if pd.api.types.is_string_dtype(col):
+                mask &= (col.fillna("").astype(str).str.strip() != "").to_numpy()
+            else:
+                mask &= col.notna().to_numpy()
+        if not mask.all():
+            print(f"🧹 {int((~mask).sum())} lignes supprimées (clé {', '.join(key_cols)} incomplète).")
+            if stats is not None:
+                stats["sans_cle"] += int((~mask).sum())
+            chunk = chunk[mask]
+        chunk = chunk.assign(**{ROW_NUMBER_COL: np.arange(offset, offset + len(chunk))})
+        offset += len(chunk)
+        yield chunk
+
+
+def build_merge_sql(target_table, temp_table, schema, key_cols):
+    """
+    MERGE conditionnel généré à partir du schéma de la table :
+      - dernière ligne du fichier gagnante en cas de clé en double
+      - valeur cible conservée si la source est NULL (ou vide pour les textes)
+    """
+    columns = [f.name for f in schema]
+    partition = ", ".join(key_cols)
+    on_clause = "\n              AND ".join(f"T.{k} = S.{k}" for k in key_cols)
+
+    sets = []
+    for f in schema:
+        if f.name in key_cols:
+            continue
+        if f.field_type == "STRING":
+            sets.append(f"T.{f.name} = IFNULL(NULLIF(S.{f.name}, ''), T.{f.name})")
+        else:
+            sets.append(f"T.{f.name} = COALESCE(S.{f.name}, T.{f.name})")
+
+    matched = ""
+    if sets:
+        matched = "\n            WHEN MATCHED THEN\n              UPDATE SET\n                " + \
+            ",\n                ".join(sets)
+
+    return f"""
+            MERGE `{target_table}` AS T
+            USING (
+              SELECT * EXCEPT({ROW_NUMBER_COL})
+              FROM `{temp_table}`
+              QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY {partition}
+                ORDER BY {ROW_NUMBER_COL} DESC
+              ) = 1
+            ) AS S
+            ON {on_clause}
+{matched}
+            WHEN NOT MATCHED BY TARGET THEN
+              INSERT ({", ".join(columns)})
+              VALUES ({", ".join(f"S.{c}" for c in columns)})
+        """
+
+
+def upsert_staged_file(client, staged_file, target_table, temp_table, key_cols, delta=False, report=None):
+    """
+    Synchronise un fichier de transit (colonnes de la table + _Ligne) dans la table cible :
+      - mode delta : seules les lignes nouvelles / modifiées sont envoyées
+      - chargement dans la table temporaire du job, MERGE généré, suppression
+    report : fonction de progression (cf. progress.py).
+    Retourne {"lignes", "envoyees", "delta"} (delta : compteurs ou None).
+    """
+    table_name = target_table.split(".")[-1]
+    report = report or (lambda *args, **kwargs: None)
+    with _table_lock(table_name):
+        target = client.get_table(target_table)
+
+        # 🔸 Empreintes du fichier et comparaison au manifeste de la dernière synchro
+        fingerprints = fingerprint_staged(staged_file, key_cols)
+        manifest = load_manifest(table_name, target.modified) if delta else None
+        lignes, counts = diff_against_manifest(fingerprints, manifest, key_cols)
+        nb_fichier = len(fingerprints)
+
+        load_file = staged_file
+        if counts is not None:
+            print(f"🔁 Delta {table_name} : {counts['inseres']} nouvelles, {counts['modifies']} modifiées, "
+                  f"{counts['inchanges']} inchangées.")
+            load_file = staged_file.replace(".parquet", "_delta.parquet")
+            write_delta_file(staged_file, lignes, load_file)
+        report("delta", f"{len(lignes)} ligne(s) à envoyer sur {nb_fichier}",
+               lignes=nb_fichier, envoyees=int(len(lignes)), compteurs=counts)
+
+        if len(lignes) == 0:
+            print(f"✅ {table_name} : aucune ligne nouvelle ou modifiée, MERGE inutile.")
+            if load_file != staged_file:
+                os.remove(load_file)
+            return {"lignes": nb_fichier, "envoyees": 0, "delta": counts}
+
+        try:
+            # 🔸 Table temporaire du job (expire seule si le job est interrompu)
+            temp_schema = list(target.schema) + [bigquery.SchemaField(ROW_NUMBER_COL, "INTEGER")]
+            try:
+                load_staged_file(client, load_file, temp_table, temp_schema)
+            finally:
+                if load_file != staged_file:
+                    os.remove(load_file)   # extrait du fichier de transit, propre à cette exécution
+            report("chargement", "Fichier chargé dans la table temporaire", lignes=int(len(lignes)))
+            temp = client.get_table(temp_table)
+            temp.expires = datetime.now(timezone.utc) + timedelta(hours=TEMP_TABLE_TTL_HOURS)
+            client.update_table(temp, ["expires"])
+
+            print(f"⚙️ Exécution du MERGE sur {table_name} (clé {', '.join(key_cols)})...")
+            merge_job = client.query(build_merge_sql(target_table, temp_table, target.schema, key_cols))
+            merge_job.result()
+            # Chaque ligne envoyée (dédoublonnée) est soit mise à jour, soit insérée
+            nb_envoyees = merge_job.num_dml_affected_rows or 0
+            print(f"✅ MERGE exécuté avec succès ({nb_envoyees} lignes).")
+            report("merge", f"MERGE exécuté sur {table_name}", lignes=nb_envoyees)
+            sent = fingerprints[ROW_NUMBER_COL].isin(lignes).to_numpy()
+            table_changed(table_name, keys=fingerprints.loc[sent, key_cols].itertuples(index=False, name=None))
+        finally:
+            client.delete_table(temp_table, not_found_ok=True)
+            print("🧹 Table temporaire supprimée.")
+
+        # 🔸 Manifeste pour le prochain import différentiel (versionné sur la date de modification)
+        save_manifest(table_name, fingerprints, manifest, key_cols, client.get_table(target_table).modified)
+        return {"lignes": nb_fichier, "envoyees": nb_envoyees, "delta": counts}
+
+
+# ============================================================
+# 🧰 MISE À JOUR EN MASSE PAR TABLE DE TRANSIT
+# ============================================================
+def bulk_update_from_frame(client, frame, schema, target_table, temp_table, match_sql, set_sql):
+    """
+    Applique une grande liste de modifications (DataFrame typé selon schema) :
+    fichier Parquet chargé dans une table temporaire, puis un seul MERGE
+    ... WHEN MATCHED THEN UPDATE SET set_sql (alias T : cible, N : modifications).
+    Le texte SQL ne dépend pas du nombre de lignes. Retourne les lignes modifiées.
+    """
+    staged_file = staging_path(temp_table.split(".")[-1])
+    try:
+        stage_chunks([frame], schema, staged_file)
+        load_staged_file(client, staged_file, temp_table, schema)
+        temp = client.get_table(temp_table)
+        temp.expires = datetime.now(timezone.utc) + timedelta(hours=TEMP_TABLE_TTL_HOURS)
+        client.update_table(temp, ["expires"])
+
+        job = client.query(f"""
+            MERGE `{target_table}` AS T
+            USING `{temp_table}` AS N
+            ON {match_sql}
+            WHEN MATCHED THEN UPDATE SET {set_sql}
+        """)
+        job.result()
+        return job.num_dml_affected_rows or 0
+    finally:
+        client.delete_table(temp_table, not_found_ok=True)
+        if os.path.exists(staged_file):
+            os.remove(staged_file)
+
+
+# ============================================================
+# 🔔 TABLES MODIFIÉES (invalidation des caches en mémoire)
+# ============================================================
+# Les écritures faites par l'application (import, MERGE, mise à jour en masse)
+# préviennent les modules qui gardent des données dérivées d'une table
+# (comptages, bornes de pages...). Les modifications faites hors de
+# l'application ne sont vues qu'à l'expiration de ces caches.
+
+_change_listeners = []
+
+
+def on_table_change(listener):
+    """
+    Enregistre listener(table_name, keys), appelé après chaque écriture d'une table.
+    keys : clés métier touchées (tuples dans l'ordre de UPSERT_KEYS), ou None si
+    toute la table a pu changer (remplacement complet).
+    """
+    _change_listeners.append(listener)
+    return listener
+
+
+def table_changed(table_name, keys=None):
+    keys = None if keys is None else list(keys)
+    for listener in list(_change_listeners):
+        try:
+            listener(table_name, keys)
+        except Exception as e:
+            print(f"⚠️ Invalidation après modification de {table_name} : {e}")
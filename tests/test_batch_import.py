@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from google.cloud import bigquery
+
+from batch_import import expand_uploads, in_upload_order, match_table, unique_path
+
+
+# ============================================================
+# 🧪 IMPORT PAR LOT (fichiers du lot, rattachement, ordre de chargement)
+# ============================================================
+
+class ExpandUploadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="lot_")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, name, content="a;b\n1;2\n"):
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def archive(self, name, members):
+        path = os.path.join(self.folder, name)
+        with zipfile.ZipFile(path, "w") as z:
+            for member, content in members.items():
+                z.writestr(member, content)
+        return path
+
+    def test_unique_path_never_reuses_a_name(self):
+        self.write("a.csv")
+        self.write("1_a.csv")
+        self.assertEqual(unique_path(self.folder, "a.csv"), os.path.join(self.folder, "2_a.csv"))
+        self.assertEqual(unique_path(self.folder, "b.csv"), os.path.join(self.folder, "b.csv"))
+
+    def test_zip_members_colliding_with_other_files_keep_their_content(self):
+        plain = self.write("stock.csv", "uploadé\n")
+        # Nom que l'ancien renommage (index_nom) aurait produit
+        self.write("1_stock.csv", "déjà là\n")
+        first = self.archive("lot1.zip", {"stock.csv": "zip 1\n", "dossier/": "", "__MACOSX/stock.csv": "x",
+                                          "notes.pdf": "x"})
+        second = self.archive("lot2.zip", {"sous/stock.csv": "zip 2\n"})
+        entries = expand_uploads([(plain, "stock.csv"), (first, "lot1.zip"), (second, "lot2.zip")], self.folder)
+
+        self.assertEqual([name for _, name in entries], ["stock.csv"] * 3)
+        paths = [path for path, _ in entries]
+        self.assertEqual(len(set(paths)), 3)
+        contents = []
+        for path in paths:
+            with open(path) as f:
+                contents.append(f.read())
+        self.assertEqual(contents, ["uploadé\n", "zip 1\n", "zip 2\n"])
+        with open(os.path.join(self.folder, "1_stock.csv")) as f:
+            self.assertEqual(f.read(), "déjà là\n")
+        self.assertFalse(os.path.exists(first) or os.path.exists(second))
+
+
+class InUploadOrderTest(unittest.TestCase):
+
+    def tasks(self, *tables):
+        return [{"id": f"f{i}", "table": table} for i, table in enumerate(tables)]
+
+    def test_same_table_files_are_released_in_upload_order(self):
+        tasks = self.tasks("Stock", "Article", "Stock", "Stock")
+        parsed = [(tasks[i], {"n": i}) for i in (2, 1, 3, 0)]
+        out = [(table, [task["id"] for task, _ in ready]) for table, ready in in_upload_order(parsed, tasks)]
+        # Article indépendant : rendu dès qu'il est prêt ; Stock attend son premier fichier
+        self.assertEqual(out, [("Article", ["f1"]), ("Stock", ["f0", "f2", "f3"])])
+
+    def test_files_in_order_are_released_one_by_one(self):
+        tasks = self.tasks("Stock", "Stock")
+        out = [[task["id"] for task, _ in ready] for _, ready in in_upload_order([(t, {}) for t in tasks], tasks)]
+        self.assertEqual(out, [["f0"], ["f1"]])
+
+
+class MatchTableTest(unittest.TestCase):
+
+    schemas = {
+        "TblArticle": [bigquery.SchemaField("CodeArticle", "STRING"), bigquery.SchemaField("Poids", "FLOAT64")],
+        "TblArticleStock": [bigquery.SchemaField("CodeArticle", "STRING"), bigquery.SchemaField("Qte", "INT64")],
+    }
+
+    def test_longest_table_name_in_filename_wins(self):
+        self.assertEqual(match_table("export_tblarticlestock_2024.csv", [], self.schemas),
+                         ("TblArticleStock", "nom"))
+
+    def test_header_match(self):
+        self.assertEqual(match_table("extraction.csv", ["CodeArticle", "Qte"], self.schemas),
+                         ("TblArticleStock", "en-tête"))
+        self.assertEqual(match_table("extraction.csv", ["A", "B", "Qte"], self.schemas), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
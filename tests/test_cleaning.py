@@ -0,0 +1,135 @@
+import unittest
+
+import pandas as pd
+from google.cloud import bigquery
+
+from cleaning import (
+    CleaningPlan, normalize_columns, parse_bools, parse_dates, parse_integers, parse_number,
+    parse_numbers,
+)
+
+
+# ============================================================
+# 🧪 NETTOYAGE (conversions typées et plan de nettoyage)
+# ============================================================
+
+def texts(*values):
+    return pd.Series(list(values), dtype=object)
+
+
+class ParseNumbersTest(unittest.TestCase):
+
+    def test_standard_values_are_not_counted_as_converted(self):
+        values, converted, rejected = parse_numbers(texts("12.5", "-3", "1e3", "", None))
+        self.assertEqual(values.tolist()[:3], [12.5, -3.0, 1000.0])
+        self.assertTrue(values[3:].isna().all())
+        self.assertEqual((converted, rejected), (0, 0))
+
+    def test_french_and_grouped_values_are_converted(self):
+        values, converted, rejected = parse_numbers(
+            texts("12,3", "1 234,5", "1 234", "1.234,5", "1,234.5", "0,125", "1234,567"))
+        self.assertEqual(values.tolist(), [12.3, 1234.5, 1234.0, 1234.5, 1234.5, 0.125, 1234.567])
+        self.assertEqual((converted, rejected), (7, 0))
+
+    def test_single_comma_before_three_digits_is_ambiguous(self):
+        values, converted, rejected = parse_numbers(texts("1,234", "-12,345", "1.234"))
+        self.assertTrue(values[:2].isna().all())
+        # Point seul : décimale (lecture standard)
+        self.assertEqual(values[2], 1.234)
+        self.assertEqual((converted, rejected), (0, 2))
+
+    def test_garbage_is_rejected(self):
+        values, _, rejected = parse_numbers(texts("abc", "1,2,3", "12 kg"))
+        self.assertTrue(values.isna().all())
+        self.assertEqual(rejected, 3)
+
+    def test_parse_number_for_frontend_edits(self):
+        self.assertEqual(parse_number("2,5"), 2.5)
+        self.assertIsNone(parse_number(""))
+        self.assertIsNone(parse_number("1,234"))
+
+
+class ParseIntegersTest(unittest.TestCase):
+
+    def test_integers_are_exact_beyond_float_precision(self):
+        values, converted, rejected = parse_integers(texts("9007199254740993", "-5", "9223372036854775807"))
+        self.assertEqual(values.dtype, "Int64")
+        self.assertEqual(values.tolist(), [9007199254740993, -5, 9223372036854775807])
+        self.assertEqual((converted, rejected), (0, 0))
+
+    def test_out_of_int64_range_is_rejected(self):
+        values, _, rejected = parse_integers(texts("99999999999999999999", "7"))
+        self.assertTrue(pd.isna(values[0]))
+        self.assertEqual(values[1], 7)
+        self.assertEqual(rejected, 1)
+
+    def test_grouped_integers_are_converted(self):
+        values, converted, rejected = parse_integers(texts("1 234", "12 345 678"))
+        self.assertEqual(values.tolist(), [1234, 12345678])
+        self.assertEqual((converted, rejected), (2, 0))
+
+    def test_non_integer_writings(self):
+        values, _, rejected = parse_integers(texts("12,0", "1e3", "12.5", "1,234", "1e17", "", "x"))
+        self.assertEqual(values[:2].tolist(), [12, 1000])
+        # Décimale, ambiguë, au-delà de 2**53 via float, texte : rejetées ; vide : NULL sans rejet
+        self.assertTrue(values[2:].isna().all())
+        self.assertEqual(rejected, 4)
+
+
+class OtherParsersTest(unittest.TestCase):
+
+    def test_bools(self):
+        values, _, rejected = parse_bools(texts("Oui", "non", "X", "", "peut-être"))
+        self.assertEqual(values[:3].tolist(), [True, False, True])
+        self.assertTrue(values[3:].isna().all())
+        self.assertEqual(rejected, 1)
+
+    def test_dates_iso_then_french(self):
+        values, converted, rejected = parse_dates(texts("2024-03-01", "01/03/2024", "31/02/2024", ""))
+        self.assertEqual(values[0], pd.Timestamp("2024-03-01"))
+        self.assertEqual(values[1], pd.Timestamp("2024-03-01"))
+        self.assertTrue(pd.isna(values[2]))
+        self.assertEqual((converted, rejected), (1, 1))
+
+    def test_normalize_columns(self):
+        self.assertEqual(list(normalize_columns([" Poids Limite (kg) ", "Allée"])), ["Poids_Limite_kg", "All_e"])
+
+
+class CleaningPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = CleaningPlan([
+            bigquery.SchemaField("Code", "STRING"),
+            bigquery.SchemaField("Quantite", "INT64"),
+            bigquery.SchemaField("Poids_kg", "FLOAT64"),
+            bigquery.SchemaField("Actif", "BOOL"),
+        ])
+
+    def test_clean_maps_raw_columns_and_drops_unknown_ones(self):
+        raw = pd.DataFrame({"Code ": [" A1", "B2"], "Quantité": ["3", "4"], "Quantite": ["1 000", "x"],
+                            "Poids (kg)": ["2,5", "1,234"], "Actif": ["oui", ""], "Autre": ["?", "?"]})
+        df = self.plan.clean(raw)
+        self.assertEqual(list(df.columns), ["Code", "Quantite", "Poids_kg", "Actif"])
+        self.assertEqual(df["Code"].tolist(), ["A1", "B2"])
+        self.assertEqual(df["Quantite"].tolist()[0], 1000)
+        self.assertTrue(pd.isna(df["Quantite"][1]))
+        self.assertEqual(df["Poids_kg"][0], 2.5)
+        self.assertTrue(pd.isna(df["Poids_kg"][1]))
+
+    def test_stats_accumulate_across_chunks(self):
+        self.plan.clean(pd.DataFrame({"Quantite": ["1 000", "x"]}))
+        self.plan.clean(pd.DataFrame({"Quantite": ["2 000", "y"], "Poids_kg": ["1,5", "2"]}))
+        self.assertEqual(self.plan.stats["Quantite"], {"convertis": 2, "rejetes": 2})
+        self.assertEqual((self.plan.nb_convertis, self.plan.nb_rejetes), (3, 2))
+        self.assertEqual(
+            self.plan.summary(),
+            "Quantite : 2 convertie(s), 2 rejetée(s) ; Poids_kg : 1 convertie(s), 0 rejetée(s)",
+        )
+
+    def test_summary_is_none_when_nothing_changed(self):
+        self.plan.clean(pd.DataFrame({"Quantite": ["1"], "Poids_kg": ["2.5"]}))
+        self.assertIsNone(self.plan.summary())
+
+
+if __name__ == "__main__":
+    unittest.main()
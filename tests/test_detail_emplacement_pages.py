@@ -0,0 +1,130 @@
+import unittest
+from types import SimpleNamespace
+
+import detail_emplacement as de
+from sync_engine import table_changed
+
+
+# ============================================================
+# 🧪 PAGINATION PAR CLÉ DE LA GRILLE (bornes, comptages, curseurs)
+# ============================================================
+# Client BigQuery factice : répond aux requêtes de comptage et de calcul des
+# bornes, et compte les jobs lancés.
+
+TABLE = "projet.dataset.TblEmplacement"
+V1, V2 = "2024-01-01T00:00:00#1", "2024-01-01T00:00:00#2"
+
+
+class FakeClient:
+
+    def __init__(self, keys, filtered=None):
+        self.keys = sorted(keys)
+        self.filtered = len(self.keys) if filtered is None else filtered
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        if "COUNTIF" in query:
+            rows = [SimpleNamespace(total=len(self.keys), filtered=self.filtered)]
+        else:
+            length = {p.name: p.value for p in job_config.query_parameters}["page_length"]
+            rows = [dict(zip(de.PAGE_KEY, key), rn=rn)
+                    for rn, key in enumerate(self.keys, start=1) if rn % length == 0]
+        return SimpleNamespace(result=lambda: rows)
+
+
+def keys(n):
+    return [["A", 1, d, 0] for d in range(1, n + 1)]
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        de.invalidate_page_cache()
+        self.signature = de._filter_signature(de._filters_from_args({"zone": "A"}))
+
+    def tearDown(self):
+        de.invalidate_page_cache()
+
+    def resolve(self, client, start, length=10, version=V1, cursor=""):
+        return de._resolve_page(client, TABLE, [], [], self.signature, version, start, length, cursor)
+
+    # ------------------------------------------------------------
+    # Comptages
+    # ------------------------------------------------------------
+    def test_counts_are_cached_per_version(self):
+        client = FakeClient(keys(30), filtered=12)
+        self.assertEqual(de._page_counts(client, TABLE, [], [], self.signature, V1), (30, 12))
+        self.assertEqual(de._page_counts(client, TABLE, [], [], self.signature, V1), (30, 12))
+        self.assertEqual(len(client.queries), 1)
+        # Nouvelle version de la table : recompté
+        de._page_counts(client, TABLE, [], [], self.signature, V2)
+        self.assertEqual(len(client.queries), 2)
+
+    def test_unreadable_version_disables_cache(self):
+        client = FakeClient(keys(5))
+        de._page_counts(client, TABLE, [], [], self.signature, None)
+        de._page_counts(client, TABLE, [], [], self.signature, None)
+        self.assertEqual(len(client.queries), 2)
+        de._remember_bounds(self.signature, None, {10: ["A", 1, 10, 0]})
+        self.assertEqual(de._cached_bounds(self.signature, None), {})
+
+    def test_table_change_clears_cache(self):
+        client = FakeClient(keys(5))
+        de._page_counts(client, TABLE, [], [], self.signature, V1)
+        de._remember_bounds(self.signature, V1, {10: ["A", 1, 10, 0]})
+        table_changed("TblEmplacement")
+        self.assertEqual(de._cached_bounds(self.signature, V1), {})
+        de._page_counts(client, TABLE, [], [], self.signature, V1)
+        self.assertEqual(len(client.queries), 2)
+
+    def test_case_insensitive_filters_share_signature(self):
+        upper = de._filter_signature(de._filters_from_args({"zone": "A", "type1": "PICKING"}))
+        lower = de._filter_signature(de._filters_from_args({"zone": "a ", "type1": "picking"}))
+        self.assertEqual(upper, lower)
+        self.assertNotEqual(upper, de._filter_signature(de._filters_from_args({"zone": "B"})))
+
+    # ------------------------------------------------------------
+    # Bornes
+    # ------------------------------------------------------------
+    def test_first_page_and_known_bound_seek_directly(self):
+        client = FakeClient(keys(100))
+        self.assertEqual(self.resolve(client, 0), (None, 0))
+        de._remember_bounds(self.signature, V1, {20: ["A", 1, 20, 0]})
+        self.assertEqual(self.resolve(client, 20), (["A", 1, 20, 0], 0))
+        self.assertEqual(self.resolve(client, 40), (["A", 1, 20, 0], 20))
+        self.assertEqual(client.queries, [])
+
+    def test_bounds_of_another_version_are_ignored(self):
+        de._remember_bounds(self.signature, V1, {20: ["A", 1, 20, 0]})
+        self.assertEqual(self.resolve(FakeClient(keys(100)), 20, version=V2), (None, 20))
+
+    def test_far_jump_scans_all_bounds_once(self):
+        client = FakeClient(keys(1000))
+        gap = (de.PAGE_SCAN_MIN_GAP + 5) * 10
+        self.assertEqual(self.resolve(client, gap), (["A", 1, gap, 0], 0))
+        self.assertEqual(len(client.queries), 1)
+        self.assertEqual(self.resolve(client, 500), (["A", 1, 500, 0], 0))
+        self.assertEqual(len(client.queries), 1)
+
+    def test_cursor_wins_and_is_bound_to_filters_and_position(self):
+        cursor = de.encode_cursor(self.signature, 50, ["A", 1, 50, 0])
+        self.assertEqual(self.resolve(FakeClient([]), 50, cursor=cursor), (["A", 1, 50, 0], 0))
+        self.assertIsNone(de.decode_cursor(cursor, self.signature, 60))
+        self.assertIsNone(de.decode_cursor(cursor, "autre-signature", 50))
+        self.assertIsNone(de.decode_cursor("pas-un-curseur", self.signature, 50))
+
+    def test_seek_condition_expands_composite_key(self):
+        sql, params = de._seek_condition(["A", 1, 20, 0])
+        self.assertEqual(
+            sql,
+            "(e.Zone > @k_zone OR (e.Zone = @k_zone AND (e.Allee > @k_allee OR "
+            "(e.Allee = @k_allee AND (e.Deplacement > @k_dep OR (e.Deplacement = @k_dep AND e.Niveau > @k_niv))))))",
+        )
+        self.assertEqual([(p.name, p.type_, p.value) for p in params],
+                         [("k_zone", "STRING", "A"), ("k_allee", "INT64", 1),
+                          ("k_dep", "INT64", 20), ("k_niv", "INT64", 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
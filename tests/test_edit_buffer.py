@@ -0,0 +1,222 @@
+import os
+import signal
+import threading
+import time
+import unittest
+
+import edit_buffer
+from edit_buffer import EditBuffer, MemoryEditJournal
+
+
+# ============================================================
+# 🧪 ÉCRITURE DIFFÉRÉE (EditBuffer + MemoryEditJournal)
+# ============================================================
+# Fusion, ordre des lots, journal (marquage / retrait par Version), reprise des
+# saisies orphelines, settle avant écriture directe et vidage sur SIGTERM ;
+# intervalles courts, aucun PostgreSQL ni BigQuery nécessaire.
+
+OTHER = "instance-arretee:1"
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class EditBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []          # lots écrits (listes de saisies)
+        self.fail = False
+        self.gate = None           # threading.Event : bloque l'écriture tant qu'il n'est pas levé
+        self.entered = threading.Event()
+        self.journal = MemoryEditJournal()
+        self.buffer = EditBuffer(self.write, lambda rec: rec["id"], interval=60, max_rows=1000)
+
+    def write(self, records):
+        self.entered.set()
+        if self.gate is not None:
+            self.gate.wait(3)
+        if self.fail:
+            raise RuntimeError("BigQuery indisponible")
+        self.written.append(sorted(records, key=lambda r: r["id"]))
+
+    def own_rows(self):
+        return {k: row for (k, owner), row in self.journal.rows().items() if owner == self.buffer.instance}
+
+    def start(self):
+        self.buffer.start(self.journal)
+
+    # ------------------------------------------------------------
+    # Fusion et lots
+    # ------------------------------------------------------------
+    def test_edits_merge_per_key_none_means_unchanged(self):
+        self.buffer.add([{"id": "A1", "x": 1, "y": 2}])
+        self.buffer.add([{"id": "A1", "x": None, "y": 5}, {"id": "B1", "x": 3, "y": None}])
+        self.assertEqual(self.buffer.pending(), {"A1": {"id": "A1", "x": 1, "y": 5},
+                                                 "B1": {"id": "B1", "x": 3, "y": None}})
+        self.buffer.flush()
+        self.assertEqual(self.written, [[{"id": "A1", "x": 1, "y": 5}, {"id": "B1", "x": 3, "y": None}]])
+        self.assertEqual(self.buffer.pending(), {})
+
+    def test_edit_during_write_goes_in_next_batch(self):
+        self.start()
+        self.gate = threading.Event()
+        self.buffer.add([{"id": "A1", "x": 1}])
+        flusher = threading.Thread(target=self.buffer.flush)
+        flusher.start()
+        self.assertTrue(self.entered.wait(3))
+        self.buffer.add([{"id": "A1", "x": 2}])
+        # Lecture pendant l'écriture : la file gagne sur le lot en cours
+        self.assertEqual(self.buffer.pending()["A1"]["x"], 2)
+        self.gate.set()
+        flusher.join(3)
+        self.assertEqual(self.written, [[{"id": "A1", "x": 1}]])
+        # Saisie arrivée pendant l'écriture : Version changée, la ligne reste journalisée
+        self.assertEqual(self.own_rows()["A1"]["saisie"], {"id": "A1", "x": 2})
+        self.assertFalse(self.own_rows()["A1"]["ecriture"])
+        self.buffer.flush()
+        self.assertEqual(self.written[-1], [{"id": "A1", "x": 2}])
+        self.assertEqual(self.own_rows(), {})
+
+    def test_flush_waits_for_batch_in_flight(self):
+        self.gate = threading.Event()
+        self.buffer.add([{"id": "A1", "x": 1}])
+        first = threading.Thread(target=self.buffer.flush)
+        first.start()
+        self.assertTrue(self.entered.wait(3))
+        self.buffer.add([{"id": "A1", "x": 2}])
+        second = threading.Thread(target=self.buffer.flush)
+        second.start()
+        time.sleep(0.1)
+        self.assertEqual(self.written, [])
+        self.gate.set()
+        first.join(3)
+        second.join(3)
+        self.assertEqual([batch[0]["x"] for batch in self.written], [1, 2])
+
+    def test_failed_write_is_requeued_under_newer_edits(self):
+        self.start()
+        self.buffer.add([{"id": "A1", "x": 1, "y": 1}])
+        self.fail = True
+        self.buffer.flush()
+        self.assertIsNotNone(self.buffer.status()["dernier_envoi"]["erreur"])
+        self.assertIn("A1", self.own_rows())
+        self.assertFalse(self.own_rows()["A1"]["ecriture"])
+        self.buffer.add([{"id": "A1", "y": 2}])
+        self.fail = False
+        self.buffer.flush()
+        self.assertEqual(self.written, [[{"id": "A1", "x": 1, "y": 2}]])
+        self.assertEqual(self.own_rows(), {})
+
+    def test_background_worker_flushes_at_max_rows(self):
+        self.buffer.max_rows = 2
+        self.buffer.add([{"id": "A1", "x": 1}])
+        self.buffer.add([{"id": "B1", "x": 1}])
+        self.assertTrue(wait_for(lambda: self.written))
+        self.assertEqual([r["id"] for r in self.written[0]], ["A1", "B1"])
+
+    # ------------------------------------------------------------
+    # Journal
+    # ------------------------------------------------------------
+    def test_edit_is_journaled_before_ack(self):
+        self.start()
+        self.buffer.add([{"id": "A1", "x": 1, "y": None}])
+        # Champs à None (inchangés) absents du journal
+        self.assertEqual(self.own_rows()["A1"]["saisie"], {"id": "A1", "x": 1})
+
+    def test_unreachable_journal_rejects_edit(self):
+        self.start()
+
+        def down(*args, **kwargs):
+            raise ConnectionError("PostgreSQL injoignable")
+
+        self.journal.add = down
+        with self.assertRaises(ConnectionError):
+            self.buffer.add([{"id": "A1", "x": 1}])
+        self.assertEqual(self.buffer.pending(), {})
+
+    def test_orphans_are_claimed_under_local_edits(self):
+        self.journal.add(OTHER, {"A1": {"id": "A1", "x": 1, "y": 1}, "B1": {"id": "B1", "x": 7}})
+        self.start()
+        # Instance vivante (battement récent) : rien n'est repris
+        self.assertEqual(self.buffer.pending(), {})
+        self.buffer.add([{"id": "A1", "y": 2}])
+        claimed = self.journal.claim_orphans(self.buffer.instance, orphan_s=-1)
+        self.assertEqual(set(claimed), {"A1", "B1"})
+        self.assertEqual(self.own_rows()["A1"]["saisie"], {"id": "A1", "x": 1, "y": 2})
+        self.assertFalse(any(owner == OTHER for _, owner in self.journal.rows()))
+
+    def test_sweep_requeues_orphans(self):
+        self.journal.add(OTHER, {"B1": {"id": "B1", "x": 7}})
+        old, edit_buffer.EDIT_ORPHAN_S = edit_buffer.EDIT_ORPHAN_S, -1
+        try:
+            self.start()
+        finally:
+            edit_buffer.EDIT_ORPHAN_S = old
+        self.assertEqual(self.buffer.pending(), {"B1": {"id": "B1", "x": 7}})
+        self.buffer.flush()
+        self.assertEqual(self.written, [[{"id": "B1", "x": 7}]])
+        self.assertEqual(self.journal.rows(), {})
+
+    # ------------------------------------------------------------
+    # settle (avant une écriture directe)
+    # ------------------------------------------------------------
+    def test_settle_writes_local_and_other_instances_edits(self):
+        self.start()
+        self.journal.add(OTHER, {"A1": {"id": "A1", "x": 1}, "C1": {"id": "C1", "x": 9}})
+        self.buffer.add([{"id": "B1", "x": 2}])
+        self.buffer.settle(["A1", "B1"])
+        written = [rec for batch in self.written for rec in batch]
+        self.assertIn({"id": "A1", "x": 1}, written)
+        self.assertIn({"id": "B1", "x": 2}, written)
+        # Clé hors du périmètre : laissée à son instance
+        self.assertEqual(set(self.journal.rows()), {("C1", OTHER)})
+
+    def test_settle_waits_for_batch_written_by_other_instance(self):
+        self.start()
+        self.journal.add(OTHER, {"A1": {"id": "A1", "x": 1}})
+        marked = self.journal.mark(OTHER, ["A1"])
+        self.journal.add(OTHER, {"A1": {"id": "A1", "x": 2}})
+        done = threading.Event()
+        settler = threading.Thread(target=lambda: (self.buffer.settle(["A1"]), done.set()))
+        settler.start()
+        time.sleep(0.3)
+        self.assertFalse(done.is_set())
+        # Fin du lot de l'autre instance : Version changée pendant l'écriture, la ligne reste
+        self.journal.release(OTHER, marked, written=True)
+        self.assertTrue(done.wait(3))
+        self.assertEqual(self.written, [[{"id": "A1", "x": 2}]])
+        self.assertEqual(self.journal.rows(), {})
+
+    def test_settle_keeps_claimed_edits_when_write_fails(self):
+        self.start()
+        self.journal.add(OTHER, {"A1": {"id": "A1", "x": 1}})
+        self.fail = True
+        self.buffer.settle(["A1"])
+        self.assertEqual(self.own_rows()["A1"]["saisie"], {"id": "A1", "x": 1})
+        self.assertEqual(self.buffer.pending(), {"A1": {"id": "A1", "x": 1}})
+
+    # ------------------------------------------------------------
+    # Arrêt
+    # ------------------------------------------------------------
+    def test_sigterm_flushes_then_calls_previous_handler(self):
+        calls = []
+        original = signal.signal(signal.SIGTERM, lambda signum, frame: calls.append(len(self.written)))
+        try:
+            self.buffer.flush_on_sigterm()
+            self.buffer.add([{"id": "A1", "x": 1}])
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertTrue(wait_for(lambda: calls))
+        finally:
+            signal.signal(signal.SIGTERM, original)
+        self.assertEqual(self.written, [[{"id": "A1", "x": 1}]])
+        self.assertEqual(calls, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
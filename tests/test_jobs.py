@@ -0,0 +1,183 @@
+import threading
+import time
+import unittest
+from datetime import timedelta
+
+import jobs
+from jobs import (
+    EN_ATTENTE, EN_COURS, ERREUR, INTERROMPU, JOB_FIELDS, MAX_TENTATIVES, SUCCES,
+    JobQueue, MemoryJobStore, _now,
+)
+
+
+# ============================================================
+# 🧪 FILE DE JOBS (JobQueue + MemoryJobStore)
+# ============================================================
+# Réclamation, battement de cœur, reprise et nouvelles tentatives, avec des
+# intervalles courts ; aucun PostgreSQL nécessaire.
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def orphan(store, kind, statut=EN_COURS, tentatives=1, age_s=600, payload=None):
+    """Job laissé par une instance arrêtée (dernier battement il y a age_s secondes)."""
+    old = _now() - timedelta(seconds=age_s)
+    job = dict.fromkeys(JOB_FIELDS)
+    job.update(IdJob=f"orphelin-{kind}-{time.monotonic_ns()}", TypeJob=kind, Statut=statut,
+               Payload=payload or {}, Tentatives=tentatives, DateCreation=old, Heartbeat=old,
+               Instance="instance-arretee:1")
+    store.create(job)
+    return job["IdJob"]
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryJobStore()
+        self.queue = JobQueue(workers=2, heartbeat_s=0.05, stale_after_s=0.5, sweep_s=0.1)
+        self.gate = threading.Event()
+        self.calls = []
+        self.abandoned = []
+
+        @self.queue.task("ok")
+        def ok(payload, job_id):
+            self.calls.append(("ok", job_id))
+            return {"n": payload.get("n")}
+
+        @self.queue.task("ko")
+        def ko(payload, job_id):
+            raise ValueError("fichier illisible")
+
+        @self.queue.task("lent", max_concurrent=1,
+                         on_abandon=lambda payload, job_id: self.abandoned.append((job_id, payload)))
+        def lent(payload, job_id):
+            self.calls.append(("lent", job_id))
+            self.gate.wait(3)
+            return None
+
+    def tearDown(self):
+        self.gate.set()
+        self.queue.stop()
+
+    def status(self, job_id):
+        return self.store.get(job_id)["Statut"]
+
+    # ------------------------------------------------------------
+    # Exécution
+    # ------------------------------------------------------------
+    def test_submit_runs_and_stores_result(self):
+        self.queue.start(self.store)
+        job_id = self.queue.submit("ok", {"n": 3})
+        self.assertTrue(wait_for(lambda: self.status(job_id) == SUCCES))
+        job = self.store.get(job_id)
+        self.assertEqual(job["Resultat"], {"n": 3})
+        self.assertEqual(job["Tentatives"], 1)
+        self.assertEqual(self.queue.owned(), set())
+
+    def test_handler_error_is_recorded(self):
+        self.queue.start(self.store)
+        job_id = self.queue.submit("ko")
+        self.assertTrue(wait_for(lambda: self.status(job_id) == ERREUR))
+        self.assertIn("fichier illisible", self.store.get(job_id)["Erreur"])
+
+    def test_submit_before_start_is_rejected(self):
+        with self.assertRaises(RuntimeError):
+            self.queue.submit("ok")
+
+    def test_unknown_kind_is_rejected(self):
+        self.queue.start(self.store)
+        with self.assertRaises(ValueError):
+            self.queue.submit("inconnu")
+
+    def test_limited_kind_does_not_hold_pool_threads(self):
+        self.queue.start(self.store)
+        first = self.queue.submit("lent")
+        self.assertTrue(wait_for(lambda: self.status(first) == EN_COURS))
+        second = self.queue.submit("lent")
+        # Le second "lent" attend sa place sans thread : le second worker reste libre
+        other = self.queue.submit("ok")
+        self.assertTrue(wait_for(lambda: self.status(other) == SUCCES))
+        self.assertEqual(self.status(second), EN_ATTENTE)
+
+        self.gate.set()
+        self.assertTrue(wait_for(lambda: self.status(second) == SUCCES))
+        self.assertEqual([c for c in self.calls if c[0] == "lent"], [("lent", first), ("lent", second)])
+
+    # ------------------------------------------------------------
+    # Battement de cœur / réclamation
+    # ------------------------------------------------------------
+    def test_heartbeat_covers_queued_jobs(self):
+        self.queue.start(self.store)
+        running = self.queue.submit("lent")
+        self.assertTrue(wait_for(lambda: self.status(running) == EN_COURS))
+        queued = self.queue.submit("lent")
+        self.assertEqual(self.queue.owned(), {running, queued})
+
+        # Battements anciens, puis un battement de la file : plus rien à réclamer
+        old = _now() - timedelta(seconds=600)
+        for job_id in (running, queued):
+            self.store.update(job_id, Heartbeat=old)
+        self.queue.heartbeat()
+        self.assertEqual(self.store.claim_stale("autre:1", _now() - timedelta(seconds=1)), [])
+
+    def test_claim_stale_only_takes_silent_unfinished_jobs(self):
+        stale = orphan(self.store, "ok")
+        fresh = orphan(self.store, "ok", age_s=0)
+        done = orphan(self.store, "ok", statut=SUCCES)
+        claimed = self.store.claim_stale("autre:1", _now() - timedelta(seconds=60))
+        self.assertEqual([job["IdJob"] for job in claimed], [stale])
+        self.assertEqual(self.store.get(stale)["Instance"], "autre:1")
+        # Réclamé = battement remis à jour : une seconde instance ne le prend pas
+        self.assertEqual(self.store.claim_stale("troisieme:1", _now() - timedelta(seconds=60)), [])
+        self.assertEqual(self.store.get(fresh)["Instance"], "instance-arretee:1")
+        self.assertEqual(self.store.get(done)["Statut"], SUCCES)
+
+    # ------------------------------------------------------------
+    # Reprise / nouvelles tentatives
+    # ------------------------------------------------------------
+    def test_recover_reruns_orphan_with_next_attempt(self):
+        job_id = orphan(self.store, "ok", tentatives=1, payload={"n": 7})
+        self.queue.start(self.store)   # start() balaie une première fois
+        self.assertTrue(wait_for(lambda: self.status(job_id) == SUCCES))
+        job = self.store.get(job_id)
+        self.assertEqual(job["Tentatives"], 2)
+        self.assertEqual(job["Instance"], jobs.INSTANCE_ID)
+        self.assertEqual(job["Resultat"], {"n": 7})
+
+    def test_recover_abandons_after_max_attempts(self):
+        job_id = orphan(self.store, "lent", tentatives=MAX_TENTATIVES, payload={"lot": "a1"})
+        self.queue.start(self.store)
+        self.assertEqual(self.status(job_id), INTERROMPU)
+        self.assertEqual(self.abandoned, [(job_id, {"lot": "a1"})])
+        self.assertEqual(self.calls, [])
+
+    def test_recover_abandons_unknown_kind(self):
+        job_id = orphan(self.store, "supprime")
+        self.queue.start(self.store)
+        self.assertEqual(self.status(job_id), INTERROMPU)
+
+    def test_periodic_sweep_picks_up_late_orphans(self):
+        self.queue.start(self.store)
+        job_id = orphan(self.store, "ok")   # orphelin apparu alors que l'instance tourne
+        self.assertTrue(wait_for(lambda: self.status(job_id) == SUCCES))
+
+    def test_recover_does_not_rerun_own_jobs(self):
+        self.queue.start(self.store)
+        job_id = self.queue.submit("lent")
+        self.assertTrue(wait_for(lambda: self.status(job_id) == EN_COURS))
+        # Battement en retard (base lente...) : le balayage ne doit pas lancer un doublon
+        self.store.update(job_id, Heartbeat=_now() - timedelta(seconds=600))
+        self.queue.recover()
+        self.gate.set()
+        self.assertTrue(wait_for(lambda: self.status(job_id) == SUCCES))
+        self.assertEqual(self.calls, [("lent", job_id)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+
+import pandas as pd
+
+from location_grid import GRID_MAX_CELLS, LocationGrid, preview_coordinates
+
+
+# ============================================================
+# 🧱 GRILLE DENSE PAR ALLÉE (tranches, mises à jour, aperçu des coordonnées)
+# ============================================================
+# Allée A-1 : déplacements 1..3, niveaux 0..1, case (2, 1) absente.
+# Dimensions en cm ; largeur nulle en (2, 0) : DEFAULT_SIZE_M dans l'aperçu.
+
+def frame(rows):
+    return pd.DataFrame(rows, columns=["Zone", "Allee", "Deplacement", "Niveau",
+                                       "Largeur", "Hauteur", "Type1"])
+
+
+ROWS = [
+    ("A", 1, 1, 0, 100, 150, "Picking"),
+    ("A", 1, 1, 1, 100, 150, None),
+    ("A", 1, 2, 0, 0, 150, None),
+    ("A", 1, 3, 0, 120, 150, None),
+    ("A", 1, 3, 1, 120, 150, None),
+    ("a ", 2, 5, 0, 80, 100, None),
+    # Numérotation éclatée : trop de cases pour une matrice dense
+    ("B", 1, 1, 0, 80, 100, None),
+    ("B", 1, GRID_MAX_CELLS + 1, 0, 80, 100, None),
+]
+
+
+class LocationGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = frame(ROWS)
+        self.grid = LocationGrid.build(self.frame)
+
+    def cells(self, window):
+        deps, nivs, _ = window.cells()
+        return list(zip(deps.tolist(), nivs.tolist()))
+
+    def test_aisles_are_keyed_case_and_space_insensitive(self):
+        self.assertEqual(len(self.grid), 2)
+        self.assertEqual(self.cells(self.grid.window(" a", 2, 0, 9, 0, 9)), [(5, 0)])
+
+    def test_window_is_clipped_to_the_aisle(self):
+        window = self.grid.window("A", 1, -5, 50, 0, 9)
+        self.assertEqual(len(window), 5)
+        self.assertEqual(self.cells(window), [(1, 0), (1, 1), (2, 0), (3, 0), (3, 1)])
+        self.assertEqual(window.types["Type1"][0, 0], "Picking")
+
+    def test_window_slices_a_range(self):
+        window = self.grid.window("A", 1, 2, 3, 1, 1)
+        self.assertEqual(self.cells(window), [(3, 1)])
+        self.assertEqual(len(self.grid.window("A", 1, 7, 9, 0, 1)), 0)
+        self.assertEqual(len(self.grid.window("A", 1, 3, 2, 0, 1)), 0)
+
+    def test_dimensions_in_meters(self):
+        dims = self.grid.window("A", 1, 2, 2, 0, 0).dimensions()
+        self.assertEqual(dims, [{"Zone": "A", "Allee": 1, "Deplacement": 2, "Niveau": 0,
+                                 "profondeur": None, "largeur": 0.0, "hauteur": 1.5}])
+
+    def test_unknown_and_sparse_aisles(self):
+        self.assertEqual(len(self.grid.window("Z", 9, 0, 9, 0, 9)), 0)
+        self.assertIsNone(self.grid.window("B", 1, 0, 9, 0, 9))
+
+    def test_updated_rebuilds_only_listed_aisles(self):
+        changed = frame(ROWS[:5] + [("A", 1, 4, 0, 100, 150, None)])
+        new = self.grid.updated(changed, [("a", 1), ("a", 2)])
+        self.assertEqual(len(new.window("A", 1, 0, 9, 0, 9)), 6)
+        # Allée absente du nouveau cadre : retirée
+        self.assertEqual(len(new.window("a", 2, 0, 9, 0, 9)), 0)
+        self.assertIsNone(new.window("B", 1, 0, 9, 0, 9))
+        # Grille d'origine intacte
+        self.assertEqual(len(self.grid.window("A", 1, 0, 9, 0, 9)), 5)
+        self.assertEqual(len(self.grid.window("a", 2, 0, 9, 0, 9)), 1)
+
+
+class PreviewCoordinatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = LocationGrid.build(frame(ROWS)).window("A", 1, 1, 3, 0, 1)
+
+    def xyz(self, rows):
+        return {(r["Deplacement"], r["Niveau"]): (r["X"], r["Y"], r["Z"]) for r in rows}
+
+    def test_steps_along_x_and_up_levels(self):
+        rows = preview_coordinates(self.window, x_ref=10, y_ref=0, z_ref=0, espacement=0.1,
+                                   hauteur_lisse=0.05, orientation="X", niv_from=0)
+        # Pas : espacement + largeur de la 1re case du déplacement (2 : largeur nulle -> 0,8 m)
+        self.assertEqual(self.xyz(rows), {
+            (1, 0): (10.0, 0.0, 0.0), (1, 1): (10.0, 0.0, 1.55),
+            (2, 0): (10.9, 0.0, 0.0),
+            (3, 0): (12.2, 0.0, 0.0), (3, 1): (12.2, 0.0, 1.55),
+        })
+        self.assertEqual(rows[2]["largeur"], 0.8)
+
+    def test_orientation_y_and_parity(self):
+        rows = preview_coordinates(self.window, parity="impair", x_ref=5, y_ref=2, z_ref=1,
+                                   espacement=0.0, orientation="Y", niv_from=0)
+        self.assertEqual(self.xyz(rows), {
+            (1, 0): (5.0, 2.0, 1.0), (1, 1): (5.0, 2.0, 2.5),
+            (3, 0): (5.0, 3.2, 1.0), (3, 1): (5.0, 3.2, 2.5),
+        })
+        even = preview_coordinates(self.window, parity="pair", x_ref=5, y_ref=2, z_ref=1, niv_from=0)
+        self.assertEqual(self.xyz(even), {(2, 0): (5.0, 2.0, 1.0)})
+
+    def test_without_reference_point_only_dimensions(self):
+        rows = preview_coordinates(self.window)
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(r["X"] is None and r["Z"] is None for r in rows))
+        self.assertEqual(rows[0]["profondeur"], 0.8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from location_search import LocationSearchIndex
+
+
+# ============================================================
+# 🔎 INDEX DE RECHERCHE DES EMPLACEMENTS (suffixes, types, delta)
+# ============================================================
+
+def found(index, term, prefix=False):
+    return sorted(index.lookup(term, prefix=prefix).tolist())
+
+
+class LocationSearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LocationSearchIndex.build(
+            [10, 11, 12, 13],
+            ["A-001-0001-00", "A-001-0002-10", "B-010-0001-00", "C-100-0101-01"],
+            [["Picking", "Réserve", "picking", None], [None, "Froid", None, "Masse"]],
+        )
+
+    def test_substring_of_labels_case_insensitive(self):
+        self.assertEqual(found(self.index, "0001"), [10, 12])
+        self.assertEqual(found(self.index, "a-001"), [10, 11])
+        self.assertEqual(found(self.index, "-10"), [11, 13])
+        self.assertEqual(found(self.index, "Z-"), [])
+
+    def test_prefix_only_matches_label_start(self):
+        self.assertEqual(found(self.index, "b-", prefix=True), [12])
+        self.assertEqual(found(self.index, "001", prefix=True), [])
+        # Types ignorés en recherche par préfixe
+        self.assertEqual(found(self.index, "pick", prefix=True), [])
+
+    def test_types_match_by_substring(self):
+        self.assertEqual(found(self.index, "PICK"), [10, 12])
+        self.assertEqual(found(self.index, "froid"), [11])
+        self.assertEqual(found(self.index, "ss"), [13])
+
+    def test_blank_term_finds_nothing(self):
+        self.assertEqual(found(self.index, "  "), [])
+        self.assertEqual(found(self.index, None), [])
+
+    def test_updated_index_leaves_original_untouched(self):
+        # Ligne 10 modifiée (retirée puis rajoutée), ligne 12 supprimée, ligne 14 ajoutée
+        new = self.index.updated([10, 12], [10, 14], ["A-001-0001-00", "D-002-0003-00"],
+                                 [["Masse", None], [None, "Froid"]])
+        self.assertEqual(found(new, "0001"), [10])
+        self.assertEqual(found(new, "masse"), [10, 13])
+        self.assertEqual(found(new, "picking"), [])
+        self.assertEqual(found(new, "froid"), [11, 14])
+        self.assertEqual(found(new, "d-", prefix=True), [14])
+        self.assertEqual(new.delta_size, 4)
+
+        self.assertEqual(found(self.index, "0001"), [10, 12])
+        self.assertEqual(found(self.index, "picking"), [10, 12])
+        self.assertEqual(self.index.delta_size, 0)
+
+    def test_removing_a_delta_row(self):
+        new = self.index.updated([], [14], ["D-002-0003-00"], [[None]])
+        newer = new.updated([14], [], [], [])
+        self.assertEqual(found(new, "d-"), [14])
+        self.assertEqual(found(newer, "d-"), [])
+        self.assertEqual(newer.delta_size, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
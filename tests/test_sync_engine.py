@@ -0,0 +1,94 @@
+import re
+import unittest
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from sync_engine import (
+    ROW_NUMBER_COL, UPSERT_KEYS, build_merge_sql, describe_dropped, keyed_chunks, temp_table_id,
+    upsert_key,
+)
+
+
+# ============================================================
+# 🧪 UPSERT PAR CLÉ (MERGE généré, numérotation des lignes)
+# ============================================================
+
+def squash(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class BuildMergeSqlTest(unittest.TestCase):
+
+    schema = [
+        bigquery.SchemaField("Zone", "STRING"),
+        bigquery.SchemaField("Allee", "INT64"),
+        bigquery.SchemaField("Libelle", "STRING"),
+        bigquery.SchemaField("Poids", "FLOAT64"),
+    ]
+
+    def test_merge_keeps_last_file_row_and_target_values_on_empty_source(self):
+        sql = squash(build_merge_sql("p.d.TblEmplacement", "p.d._Temp_x", self.schema, ["Zone", "Allee"]))
+        self.assertIn("MERGE `p.d.TblEmplacement` AS T", sql)
+        self.assertIn(f"SELECT * EXCEPT({ROW_NUMBER_COL}) FROM `p.d._Temp_x`", sql)
+        self.assertIn(f"PARTITION BY Zone, Allee ORDER BY {ROW_NUMBER_COL} DESC ) = 1", sql)
+        self.assertIn("ON T.Zone = S.Zone AND T.Allee = S.Allee", sql)
+        # Texte vide ou NULL : valeur cible conservée ; autres types : NULL seulement
+        self.assertIn("T.Libelle = IFNULL(NULLIF(S.Libelle, ''), T.Libelle)", sql)
+        self.assertIn("T.Poids = COALESCE(S.Poids, T.Poids)", sql)
+        self.assertNotIn("T.Zone = COALESCE", sql)
+        self.assertIn("INSERT (Zone, Allee, Libelle, Poids) VALUES (S.Zone, S.Allee, S.Libelle, S.Poids)", sql)
+
+    def test_key_only_table_has_no_update_branch(self):
+        sql = squash(build_merge_sql("t", "tmp", self.schema[:2], ["Zone", "Allee"]))
+        self.assertNotIn("WHEN MATCHED", sql)
+        self.assertIn("WHEN NOT MATCHED BY TARGET THEN INSERT (Zone, Allee)", sql)
+
+    def test_temp_table_is_unique_per_job(self):
+        a = temp_table_id("p", "d", "TblProduit", "0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0")
+        b = temp_table_id("p", "d", "TblProduit", "1f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0")
+        self.assertEqual(a, "p.d._Temp_TblProduit_0f1e2d3c4b5a")
+        self.assertNotEqual(a, b)
+
+    def test_upsert_keys(self):
+        self.assertEqual(upsert_key("TblProduit"), ["Reference"])
+        self.assertIsNone(upsert_key("TblInconnue"))
+        self.assertEqual(UPSERT_KEYS["TblEmplacement"], ["Zone", "Allee", "Deplacement", "Niveau"])
+
+
+class KeyedChunksTest(unittest.TestCase):
+
+    def test_rows_without_key_are_dropped_and_rows_numbered_across_chunks(self):
+        chunks = [
+            pd.DataFrame({"Zone": ["A", " ", None], "Allee": pd.array([1, 2, 3], dtype="Int64"), "v": [1, 2, 3]}),
+            pd.DataFrame({"Zone": ["B", "C"], "Allee": pd.array([None, 5], dtype="Int64"), "v": [4, 5]}),
+        ]
+        stats = {}
+        out = list(keyed_chunks(chunks, ["Zone", "Allee"], stats=stats))
+        self.assertEqual([c["v"].tolist() for c in out], [[1], [5]])
+        self.assertEqual(np.concatenate([c[ROW_NUMBER_COL].to_numpy() for c in out]).tolist(), [0, 1])
+        self.assertEqual(stats, {"sans_cle": 3})
+        self.assertEqual(describe_dropped(stats["sans_cle"], ["Zone", "Allee"]),
+                         "3 ligne(s) écartée(s) : clé Zone, Allee vide ou incomplète")
+        self.assertIsNone(describe_dropped(0, ["Zone"]))
+
+    def test_missing_key_column_is_an_error(self):
+        with self.assertRaises(ValueError):
+            list(keyed_chunks([pd.DataFrame({"Zone": ["A"]})], ["Zone", "Allee"]))
+
+    def test_chunks_are_consumed_lazily(self):
+        seen = []
+
+        def source():
+            for i in range(3):
+                seen.append(i)
+                yield pd.DataFrame({"Reference": [f"R{i}"]})
+
+        gen = keyed_chunks(source(), ["Reference"])
+        next(gen)
+        self.assertEqual(seen, [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import math
+import unittest
+
+from travel_graph import ACCESS, MAIN, PARALLEL, TRAVEL_ATTACH_M, TravelGraph, _segment
+
+
+# ============================================================
+# 🧭 GRAPHE DE DÉPLACEMENT (coupes, raccords, sens uniques, engins)
+# ============================================================
+# Route principale à sens unique (0,0) -> (10,0) ; accès perpendiculaire
+# (4,0.3) -> (4,3), dont l'extrémité à 30 cm de la route la coupe en (4,0)
+# avec un raccord de 0,3 m.
+
+def route(x0, y0, x1, y1, kind=MAIN, one_way=False, direction=None, engin=None, reverse=False):
+    row = {"xdeb": x0, "ydeb": y0, "xfin": x1, "yfin": y1, "sensunique": one_way,
+           "sensdirection": direction, "typeengin": engin}
+    return _segment(row, kind, reverse)
+
+
+class TravelGraphTest(unittest.TestCase):
+
+    def build(self, *segments):
+        return TravelGraph(list(segments), {"chariot": 6.0}, version=1)
+
+    def node(self, graph, x, y):
+        found = graph.locate(x, y)
+        self.assertIsNotNone(found)
+        self.assertEqual(found[1], 0.0)
+        return found[0]
+
+    def distance(self, graph, a, b, engin=None):
+        return graph.astar(self.node(graph, *a), self.node(graph, *b), engin)[0]
+
+    def one_way_with_stub(self, direction="croissant", reverse=False):
+        return self.build(
+            route(0, 0, 10, 0, one_way=True, direction=direction, reverse=reverse),
+            # Sens unique ignoré pour un accès : on en ressort par où l'on est entré
+            route(4, 0.3, 4, 3, kind=ACCESS, one_way=True),
+        )
+
+    def test_main_route_is_split_where_the_stub_joins(self):
+        graph = self.one_way_with_stub()
+        self.assertEqual(graph.node_count, 5)
+        self.assertAlmostEqual(self.distance(graph, (0, 0), (4, 0)), 4.0)
+        self.assertAlmostEqual(self.distance(graph, (4, 0), (4, 0.3)), 0.3)
+        self.assertAlmostEqual(self.distance(graph, (4, 0.3), (4, 0)), 0.3)
+        self.assertAlmostEqual(self.distance(graph, (0, 0), (4, 3)), 7.0)
+        self.assertAlmostEqual(self.distance(graph, (4, 3), (10, 0)), 9.0)
+
+    def test_path_goes_through_the_connector(self):
+        graph = self.one_way_with_stub()
+        dist, path = graph.astar(self.node(graph, 0, 0), self.node(graph, 4, 3))
+        self.assertAlmostEqual(dist, 7.0)
+        self.assertEqual([tuple(xy) for xy in graph.node_xy[path].round(3).tolist()],
+                         [(0.0, 0.0), (4.0, 0.0), (4.0, 0.3), (4.0, 3.0)])
+
+    def test_one_way_route_is_unreachable_against_its_direction(self):
+        graph = self.one_way_with_stub()
+        self.assertEqual(self.distance(graph, (10, 0), (0, 0)), math.inf)
+        self.assertEqual(self.distance(graph, (4, 3), (0, 0)), math.inf)
+        self.assertEqual(graph.astar(self.node(graph, 10, 0), self.node(graph, 0, 0)), (math.inf, []))
+
+    def test_reversed_route(self):
+        for graph in (self.one_way_with_stub(direction="decroissant"), self.one_way_with_stub(reverse=True)):
+            self.assertAlmostEqual(self.distance(graph, (10, 0), (0, 0)), 10.0)
+            self.assertAlmostEqual(self.distance(graph, (4, 3), (0, 0)), 7.0)
+            self.assertEqual(self.distance(graph, (0, 0), (10, 0)), math.inf)
+
+    def test_route_reserved_to_an_engin(self):
+        graph = self.build(
+            route(0, 0, 10, 0, one_way=True),
+            route(10, 0, 10, -2, kind=PARALLEL, engin="chariot"),
+            route(10, -2, 0, -2, kind=PARALLEL, engin="chariot"),
+            route(0, -2, 0, 0, kind=PARALLEL, engin="chariot"),
+        )
+        self.assertAlmostEqual(self.distance(graph, (10, 0), (0, 0), "chariot"), 14.0)
+        self.assertAlmostEqual(self.distance(graph, (10, 0), (0, 0)), 14.0)
+        # Engin sans route réservée : routes sans engin seulement
+        self.assertEqual(self.distance(graph, (10, 0), (0, 0), "transpalette"), math.inf)
+
+    def test_tree_matches_astar_and_is_cached(self):
+        graph = self.one_way_with_stub()
+        src, dst = self.node(graph, 0, 0), self.node(graph, 10, 0)
+        dist, _ = graph.tree(src)
+        self.assertAlmostEqual(dist[dst], 10.0)
+        self.assertIs(graph.cached_tree(src), graph.tree(src))
+        self.assertEqual(graph.astar(src, dst)[0], dist[dst])
+
+    def test_duplicate_segments_give_one_arc(self):
+        single = self.build(route(0, 0, 10, 0))
+        double = self.build(route(0, 0, 10, 0), route(0, 0, 10, 0))
+        self.assertEqual(len(single.src), 2)
+        self.assertEqual(len(double.src), 2)
+
+    def test_locate_attaches_nearby_points_only(self):
+        graph = self.one_way_with_stub()
+        node, attach = graph.locate(4, 4)
+        self.assertEqual(graph.node_xy[node].tolist(), [4.0, 3.0])
+        self.assertAlmostEqual(attach, 1.0)
+        self.assertIsNone(graph.locate(4, 3 + TRAVEL_ATTACH_M + 1))
+        self.assertIsNone(graph.locate(None, 1))
+
+    def test_incomplete_or_empty_segments_are_ignored(self):
+        self.assertIsNone(route(0, 0, None, 0))
+        graph = self.build(route(1, 1, 1, 1))
+        self.assertEqual((graph.node_count, len(graph.src)), (0, 0))
+        self.assertEqual(self.build().node_count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,461 @@
+import heapq
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from flask import Blueprint, jsonify, request
+from psycopg2.extras import RealDictCursor
+
+from db import get_pg_connection, release_pg_connection
+from emplacement_snapshot import emplacement_snapshot, LABEL_COL
+from sync_engine import on_table_change
+
+
+# ============================================================
+# 🧭 GRAPHE DE DÉPLACEMENT DE L'ENTREPÔT (plus courts chemins)
+# ============================================================
+# Construit à partir des routes principales (TblRouteSimple) et secondaires
+# (TblRouteSecondaire) : chaque route est un segment XY, à sens unique si
+# SensUnique (SensDirection : sens des déplacements croissants / décroissants).
+#  - les routes principales sont coupées là où une autre route les touche
+#    (à moins de TRAVEL_JOIN_M, avec un court raccord) : les accès
+#    perpendiculaires et les croisements s'y raccrochent
+#  - les extrémités à moins de TRAVEL_SNAP_M (grille) sont un même nœud
+#  - circulation au sol : Z est ignoré, les niveaux d'une colonne partagent
+#    le nœud du sol ; un emplacement hors réseau est raccordé en ligne droite
+#    au nœud le plus proche (au plus TRAVEL_ATTACH_M)
+#  - une route réservée à un TypeEngin n'est empruntée que par cet engin ;
+#    durée = distance / TblEngin.VitesseKmH
+# Graphe en tableaux (CSR), figé ; chemins par A* (heuristique : distance à vol
+# d'oiseau), matrices par Dijkstra depuis chaque source. Les arbres de Dijkstra
+# sont gardés (LRU) : une source déjà calculée répond en quelques microsecondes.
+# Après une modification de route, seules ses lignes sont relues dans PostgreSQL.
+
+TRAVEL_SNAP_M = 0.05            # extrémités confondues à 5 cm près
+TRAVEL_JOIN_M = 0.5             # une extrémité à moins de 50 cm d'une route principale la coupe
+TRAVEL_ATTACH_M = 5.0           # raccordement d'un emplacement hors réseau
+TRAVEL_MAX_AGE_S = 300          # rechargement complet au plus tard toutes les 5 min (autres instances)
+TRAVEL_TREE_CACHE = 64          # arbres de plus courts chemins gardés par graphe
+MAIN, PARALLEL, ACCESS = "principale", "parallele", "perpendiculaire"
+
+bp_travel = Blueprint("travel", __name__)
+
+
+def _grid_key(x, y):
+    """Case de TRAVEL_SNAP_M de côté contenant chaque point, en un entier (tri et dict rapides)."""
+    kx = np.round(np.asarray(x) / TRAVEL_SNAP_M).astype(np.int64)
+    ky = np.round(np.asarray(y) / TRAVEL_SNAP_M).astype(np.int64)
+    return (kx << 32) + (ky + (1 << 31))
+
+
+def _segment(row, kind, reverse):
+    """Ligne de route -> (x0, y0, x1, y1, aller, retour, engin, principale)."""
+    coords = [row.get(c) for c in ("xdeb", "ydeb", "xfin", "yfin")]
+    if any(c is None for c in coords):
+        return None
+    one_way = bool(row.get("sensunique")) and kind != ACCESS   # on entre et sort d'un emplacement par le même accès
+    croissant = (row.get("sensdirection") or "croissant") != "decroissant"
+    forward = croissant != reverse
+    return (
+        float(coords[0]), float(coords[1]), float(coords[2]), float(coords[3]),
+        forward or not one_way, (not forward) or not one_way,
+        str(row.get("typeengin") or "").strip().lower(), kind == MAIN,
+    )
+
+
+class TravelGraph:
+    """Graphe figé : nœuds (coordonnées XY), arcs orientés (longueur, engin), CSR par engin."""
+
+    def __init__(self, segments, speeds, version):
+        t0 = time.perf_counter()
+        self.version = version
+        self.speeds = speeds
+        self._lock = threading.Lock()
+        self._csr = {}
+        self._trees = OrderedDict()
+
+        pieces = self._split(segments)
+        ends = np.concatenate([pieces[:, 0:2], pieces[:, 2:4]]) if len(pieces) else np.empty((0, 2))
+        uniq, first, inverse = np.unique(_grid_key(ends[:, 0], ends[:, 1]), return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.node_xy = ends[first] if len(ends) else np.empty((0, 2))
+        self._node_of_key = dict(zip(uniq.tolist(), range(len(uniq))))
+
+        n = len(pieces)
+        u, v = inverse[:n], inverse[n:]
+        length = np.hypot(pieces[:, 2] - pieces[:, 0], pieces[:, 3] - pieces[:, 1])
+        fwd, bwd, engin = pieces[:, 4] > 0, pieces[:, 5] > 0, pieces[:, 6].astype(np.int64)
+        src = np.concatenate([u[fwd], v[bwd]])
+        dst = np.concatenate([v[fwd], u[bwd]])
+        length = np.concatenate([length[fwd], length[bwd]])
+        engin = np.concatenate([engin[fwd], engin[bwd]])
+        # Arcs en double (un par niveau d'une même colonne) : le plus court par (origine, destination, engin)
+        order = np.lexsort((length, engin, dst, src))
+        src, dst, length, engin = src[order], dst[order], length[order], engin[order]
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1]) | (engin[1:] != engin[:-1])
+        keep = first & (src != dst)
+        self.src, self.dst, self.length, self.engin = src[keep], dst[keep], length[keep], engin[keep]
+        self.build_s = time.perf_counter() - t0
+
+    # ------------------------------------------------------------
+    # Construction
+    # ------------------------------------------------------------
+    def _split(self, segments):
+        """Segments -> tronçons [x0, y0, x1, y1, aller, retour, code engin] ;
+        les routes principales sont coupées aux points où les autres routes les touchent."""
+        self.engin_codes = {"": 0}
+        if not segments:
+            return np.empty((0, 7))
+        x0, y0, x1, y1, fwd, bwd, engins, main = zip(*segments)
+        geo = np.column_stack([x0, y0, x1, y1]).astype(float)
+        flags = np.column_stack([fwd, bwd]).astype(float)
+        codes = np.array([self.engin_codes.setdefault(e, len(self.engin_codes)) for e in engins], dtype=float)
+        main = np.array(main, dtype=bool)
+        ok = np.isfinite(geo).all(axis=1) & (np.hypot(geo[:, 2] - geo[:, 0], geo[:, 3] - geo[:, 1]) > 0)
+
+        rows = np.column_stack([geo, flags, codes])
+        out = [rows[ok & ~main]]
+        ends = np.unique(np.concatenate([geo[ok, 0] + 1j * geo[ok, 1], geo[ok, 2] + 1j * geo[ok, 3]]))
+        points = np.column_stack([ends.real, ends.imag])   # une fois par position
+        for i in np.flatnonzero(ok & main):
+            a, b = geo[i, 0:2], geo[i, 2:4]
+            d = b - a
+            t = np.clip((points - a) @ d / (d @ d), 0.0, 1.0)
+            proj = a + t[:, None] * d
+            gap = np.hypot(*(points - proj).T)
+            near = gap <= TRAVEL_JOIN_M
+            inner = near & (t > 1e-9) & (t < 1 - 1e-9)
+            cuts = np.concatenate([[0.0], np.unique(t[inner]), [1.0]])
+            at = a + cuts[:, None] * d
+            out.append(np.column_stack([at[:-1], at[1:], np.tile(rows[i, 4:], (len(cuts) - 1, 1))]))
+            # Raccord (double sens, sans engin) de l'extrémité voisine à son projeté sur la route
+            link = near & (gap > TRAVEL_SNAP_M / 2)
+            if link.any():
+                out.append(np.column_stack([proj[link], points[link], np.ones((link.sum(), 2)), np.zeros(link.sum())]))
+        return np.concatenate(out)
+
+    @property
+    def node_count(self):
+        return len(self.node_xy)
+
+    def csr(self, engin=None):
+        """(indptr, voisins, longueurs) en listes Python (parcours rapide), pour un engin
+        (nom en minuscules, cf. _engin) ou tous."""
+        # None : tous les arcs ; engin sans route réservée (code -1) : arcs sans engin seulement
+        code = None if engin is None else self.engin_codes.get(engin, -1)
+        with self._lock:
+            if code in self._csr:
+                return self._csr[code]
+        mask = np.ones(len(self.src), dtype=bool) if code is None else (self.engin == 0) | (self.engin == code)
+        order = np.argsort(self.src[mask], kind="stable")
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(self.src[mask], minlength=self.node_count))])
+        csr = (indptr.tolist(), self.dst[mask][order].tolist(), self.length[mask][order].tolist())
+        with self._lock:
+            self._csr[code] = csr
+        return csr
+
+    # ------------------------------------------------------------
+    # Emplacements -> nœuds
+    # ------------------------------------------------------------
+    def locate(self, x, y):
+        """(nœud, distance de raccordement) d'un point XY ; None s'il est trop loin du réseau."""
+        if x is None or y is None or not (math.isfinite(x) and math.isfinite(y)) or not self.node_count:
+            return None
+        node = self._node_of_key.get(int(_grid_key(np.array([x]), np.array([y]))[0]))
+        if node is not None:
+            return node, 0.0
+        d = np.hypot(self.node_xy[:, 0] - x, self.node_xy[:, 1] - y)
+        node = int(d.argmin())
+        return (node, float(d[node])) if d[node] <= TRAVEL_ATTACH_M else None
+
+    # ------------------------------------------------------------
+    # Plus courts chemins
+    # ------------------------------------------------------------
+    def tree(self, source, engin=None):
+        """Dijkstra depuis source : (distances, prédécesseurs), gardé en cache (LRU)."""
+        key = (source, engin)
+        with self._lock:
+            if key in self._trees:
+                self._trees.move_to_end(key)
+                return self._trees[key]
+        indptr, nbrs, lengths = self.csr(engin)
+        dist = [math.inf] * self.node_count
+        pred = [-1] * self.node_count
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            du, u = heapq.heappop(heap)
+            if du > dist[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v, nd = nbrs[k], du + lengths[k]
+                if nd < dist[v]:
+                    dist[v], pred[v] = nd, u
+                    heapq.heappush(heap, (nd, v))
+        with self._lock:
+            self._trees[key] = (dist, pred)
+            while len(self._trees) > TRAVEL_TREE_CACHE:
+                self._trees.popitem(last=False)
+        return dist, pred
+
+    def cached_tree(self, source, engin=None):
+        with self._lock:
+            return self._trees.get((source, engin))
+
+    def astar(self, source, target, engin=None):
+        """(distance, chemin de nœuds) de source à target ; (inf, []) sans chemin."""
+        tree = self.cached_tree(source, engin)
+        if tree is not None:
+            dist, pred = tree
+            return dist[target], self._walk(pred, target) if math.isfinite(dist[target]) else []
+
+        indptr, nbrs, lengths = self.csr(engin)
+        xs, ys = self.node_xy[:, 0].tolist(), self.node_xy[:, 1].tolist()
+        tx, ty = xs[target], ys[target]
+        best = {source: 0.0}
+        pred = {source: -1}
+        heap = [(math.hypot(xs[source] - tx, ys[source] - ty), 0.0, source)]
+        while heap:
+            _, du, u = heapq.heappop(heap)
+            if u == target:
+                return du, self._walk(pred, target)
+            if du > best[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v, nd = nbrs[k], du + lengths[k]
+                if nd < best.get(v, math.inf):
+                    best[v], pred[v] = nd, u
+                    heapq.heappush(heap, (nd + math.hypot(xs[v] - tx, ys[v] - ty), nd, v))
+        return math.inf, []
+
+    @staticmethod
+    def _walk(pred, target):
+        path = [target]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+        return path[::-1]
+
+
+class TravelNetwork:
+    """Graphe courant + segments par route (rechargement partiel après une modification)."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.graph = None
+        self._routes = {}         # IdRoute principale -> [segments] (route + ses routes secondaires)
+        self._speeds = {}
+        self._dirty = None        # IdRoute à relire ; None : tout relire
+        self._loaded_at = 0.0
+        self._version = 0
+        self._locations = (None, {})   # (version de l'instantané, libellé -> (x, y))
+
+    def get(self):
+        with self._lock:
+            if self.graph is None or self._dirty is None or time.monotonic() - self._loaded_at > TRAVEL_MAX_AGE_S:
+                self._reload()
+            elif self._dirty:
+                self._reload(self._dirty)
+            return self.graph
+
+    def invalidate(self, route_ids=None):
+        with self._lock:
+            if route_ids is None or self._dirty is None:
+                self._dirty = None
+            else:
+                self._dirty.update(str(r) for r in route_ids)
+
+    def _reload(self, route_ids=None):
+        t0 = time.perf_counter()
+        routes, speeds = _load_routes(route_ids)
+        if route_ids is None:
+            self._routes = routes
+            self._loaded_at = time.monotonic()
+        else:
+            for rid in route_ids:
+                self._routes.pop(rid, None)
+            self._routes.update(routes)
+        self._speeds = speeds
+        self._dirty = set()
+        self._version += 1
+        segments = [s for segs in self._routes.values() for s in segs]
+        self.graph = TravelGraph(segments, speeds, self._version)
+        what = "complet" if route_ids is None else f"{len(route_ids)} route(s) relue(s)"
+        print(f"🧭 Graphe de déplacement v{self._version} ({what}) : {self.graph.node_count} nœuds, "
+              f"{len(self.graph.src)} arcs en {time.perf_counter() - t0:.2f} s")
+
+    def location_xy(self, label):
+        """(x, y) d'un emplacement Z-AAA-DDDD-NN, lu dans l'instantané TblEmplacement."""
+        frame, version = emplacement_snapshot.get()
+        with self._lock:
+            if self._locations[0] != version:
+                xs = frame["X"].astype(float).to_numpy()
+                ys = frame["Y"].astype(float).to_numpy()
+                labels = frame[LABEL_COL].str.upper().tolist()
+                self._locations = (version, dict(zip(labels, zip(xs.tolist(), ys.tolist()))))
+            return self._locations[1].get(str(label).strip().upper())
+
+
+def _load_routes(route_ids=None):
+    """Segments des routes (toutes, ou celles de route_ids) et vitesses des engins, lus dans PostgreSQL."""
+    conn = None
+    try:
+        conn = get_pg_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        where_main = "WHERE IdRoute = ANY(%s)" if route_ids is not None else ""
+        where_sec = "WHERE IdRoutePrincipale = ANY(%s)" if route_ids is not None else ""
+        params = (list(route_ids),) if route_ids is not None else None
+
+        cur.execute(f"""
+            SELECT IdRoute, XDeb, YDeb, XFin, YFin, DeplacementDeb, DeplacementFin,
+                   TypeEngin, SensUnique, SensDirection
+            FROM TblRouteSimple {where_main}
+        """, params)
+        routes = {}
+        for r in cur.fetchall():
+            # « croissant » : sens des déplacements croissants, quel que soit l'ordre Deb / Fin
+            deb, fin = r.get("deplacementdeb"), r.get("deplacementfin")
+            reverse = deb is not None and fin is not None and fin < deb
+            seg = _segment(r, MAIN, reverse)
+            routes.setdefault(str(r["idroute"]), [])
+            if seg:
+                routes[str(r["idroute"])].append(seg)
+
+        cur.execute(f"""
+            SELECT IdRoutePrincipale, TypeRoute, XDeb, YDeb, XFin, YFin,
+                   TypeEngin, SensUnique, SensDirection
+            FROM TblRouteSecondaire {where_sec}
+        """, params)
+        for r in cur.fetchall():
+            kind = ACCESS if r.get("typeroute") == ACCESS else PARALLEL
+            seg = _segment(r, kind, False)   # parallèles générées source -> cible par déplacement croissant
+            if seg:
+                routes.setdefault(str(r["idrouteprincipale"]), []).append(seg)
+
+        cur.execute("SELECT TypeEngin, VitesseKmH FROM TblEngin")
+        speeds = {str(r["typeengin"]).strip().lower(): float(r["vitessekmh"])
+                  for r in cur.fetchall() if r.get("typeengin") and r.get("vitessekmh")}
+        return routes, speeds
+    finally:
+        if conn:
+            cur.close()
+            release_pg_connection(conn)
+
+
+travel_network = TravelNetwork()
+
+
+@on_table_change
+def _on_table_change(table_name, keys=None):
+    # keys : IdRoute principales concernées (routes secondaires : IdRoutePrincipale)
+    if table_name in ("TblRouteSimple", "TblRouteSecondaire"):
+        travel_network.invalidate(keys)
+    elif table_name == "TblEngin":
+        travel_network.invalidate()
+
+
+# ============================================================
+# 🔎 API : distance et durée entre emplacements
+# ============================================================
+def _endpoint(graph, label):
+    xy = travel_network.location_xy(label)
+    if xy is None:
+        raise LookupError(f"Emplacement inconnu : {label}")
+    found = graph.locate(*xy)
+    if found is None:
+        raise LookupError(f"Emplacement {label} à plus de {TRAVEL_ATTACH_M} m du réseau de routes")
+    return found
+
+
+def _engin(value):
+    return str(value or "").strip().lower() or None
+
+
+def _speed(graph, engin):
+    if not engin:
+        return None
+    speed = graph.speeds.get(engin)
+    if speed is None:
+        raise LookupError(f"Engin inconnu : {engin}")
+    return speed
+
+
+@bp_travel.route("/api/routes/trajet", methods=["GET"])
+def api_trajet():
+    """?from=A-001-0001-00&to=B-002-0010-00&engin=Transpalette&chemin=1"""
+    t0 = time.perf_counter()
+    try:
+        graph = travel_network.get()
+        engin = _engin(request.args.get("engin"))
+        speed = _speed(graph, engin)
+        (src, attach_src), (dst, attach_dst) = (_endpoint(graph, request.args.get(k, "")) for k in ("from", "to"))
+        dist, nodes = graph.astar(src, dst, engin)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": f"Erreur graphe de déplacement : {e}"}), 500
+
+    if not math.isfinite(dist):
+        return jsonify({"error": "Aucun chemin (sens uniques / engin)"}), 404
+    total = dist + attach_src + attach_dst
+    out = {
+        "distance_m": round(total, 3),
+        "duree_s": round(total / (speed / 3.6), 3) if speed else None,
+        "vitesse_kmh": speed,
+        "version": graph.version,
+        "calcul_us": int((time.perf_counter() - t0) * 1e6),
+    }
+    if request.args.get("chemin") in ("1", "true"):
+        out["chemin"] = graph.node_xy[nodes].round(3).tolist()
+    return jsonify(out)
+
+
+@bp_travel.route("/api/routes/distances", methods=["POST"])
+def api_distances():
+    """{"sources": [libellés], "cibles": [libellés], "engin": "..."} -> distances (m) et durées (s)."""
+    t0 = time.perf_counter()
+    data = request.get_json(silent=True) or {}
+    sources, targets = data.get("sources") or [], data.get("cibles") or []
+    if not sources or not targets:
+        return jsonify({"error": "sources et cibles obligatoires"}), 400
+    try:
+        graph = travel_network.get()
+        engin = _engin(data.get("engin"))
+        speed = _speed(graph, engin)
+        src = [_endpoint(graph, s) for s in sources]
+        dst = [_endpoint(graph, t) for t in targets]
+        dist = np.full((len(src), len(dst)), np.inf)
+        for i, (s, attach_s) in enumerate(src):
+            tree, _ = graph.tree(s, engin)
+            for j, (t, attach_t) in enumerate(dst):
+                dist[i, j] = tree[t] + attach_s + attach_t
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": f"Erreur graphe de déplacement : {e}"}), 500
+
+    def as_json(m):
+        return [[round(float(v), 3) if np.isfinite(v) else None for v in row] for row in m]
+    return jsonify({
+        "distances_m": as_json(dist),
+        "durees_s": as_json(dist / (speed / 3.6)) if speed else None,
+        "version": graph.version,
+        "calcul_us": int((time.perf_counter() - t0) * 1e6),
+    })
+
+
+@bp_travel.route("/api/routes/graphe", methods=["GET"])
+def api_graphe():
+    try:
+        graph = travel_network.get()
+    except Exception as e:
+        return jsonify({"error": f"Erreur graphe de déplacement : {e}"}), 500
+    return jsonify({
+        "version": graph.version,
+        "noeuds": graph.node_count,
+        "arcs": int(len(graph.src)),
+        "engins": graph.speeds,
+        "construction_s": round(graph.build_s, 3),
+    })